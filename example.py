@@ -10,6 +10,8 @@ from pyrat.torrent_file import TorrentInfo
 from pyrat.bencode_parser import Decoder
 from pyrat.tracker_client import TrackerClient
 from pyrat.torrent_client import TorrentClient
+from pyrat.sharded import ShardedClient
+from pyrat import events
 
 
 # async def work():
@@ -21,23 +23,26 @@ from pyrat.torrent_client import TorrentClient
     # tracker.close()
     # print(response) if response else print("Server doesn't respond")
 
-async def work():
+async def work(torrent_file, shards=None):
     exception = None
-    torrent = TorrentClient(sys.argv[1])
+    torrent = ShardedClient(torrent_file, shards) if shards \
+        else TorrentClient(torrent_file)
     try:
         await torrent.start()
     except Exception as e:
-        print("Something went wrong")
+        events.BUS.error('example.failed', error=repr(e))
         exception = e
     finally:
         torrent.stop()
         if exception: raise exception
 
 
-def torrent():
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(work())
-    loop.close()
+def torrent(torrent_file, shards=None):
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(work(torrent_file, shards))
+    finally:
+        loop.close()
 
 # a = TorrentInfo(sys.argv[1])
 # pprint(list(a.pieces_hashes))
@@ -53,6 +58,13 @@ def init_parser():
     parser.add_argument("-f", "--log-output", action="store", dest="log_output",
                         default="NONE", help="Additional logging " \
                         "output. If NONE, program will do logging only to stdin.")
+    parser.add_argument("-t", "--trace", action="store_true", dest="trace",
+                        help="Log how long parsing, hashing, writing and " \
+                             "announcing take, at the TRACE level.")
+    parser.add_argument("-s", "--shards", action="store", dest="shards",
+                        type=int, default=None,
+                        help="Download from that many processes, each " \
+                             "with its own peers.")
     return parser
 
 
@@ -62,7 +74,13 @@ def main():
         parser.print_help()
         sys.exit(0)
     args = parser.parse_args()
-    print(args)
+    events.configure(args.log_lvl,
+                     None if args.log_output == "NONE" else args.log_output,
+                     trace=args.trace)
+    try:
+        torrent(args.sourse_file, args.shards)
+    finally:
+        events.shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,113 @@
+import asyncio
+import time
+
+from .events import BUS
+
+
+
+class TrackerState:
+    def __init__(self, url: str):
+        self.url = url
+        self.interval = None
+        self.failures = 0
+        self.next_announce = 0 # time.monotonic() of the next allowed try
+        self.started = False # The tracker accepted our 'started' event
+
+    def __str__(self):
+        return self.url
+
+
+class Announcer:
+    """
+    Announces to all tiers of the torrent concurrently.
+
+    Within a tier trackers are tried in order and the one which answers
+    is moved to the front (BEP 12). Each tracker has its own timeout, its
+    interval is honoured after a success and failures back off
+    exponentially, so a dead tracker only delays its own tier. Responses
+    are reported as they arrive.
+    """
+
+    TIMEOUT = 20
+    MIN_BACKOFF = 15
+    MAX_BACKOFF = 30 * 60
+    DEFAULT_INTERVAL = 30 * 60
+
+    def __init__(self, tracker_client, tiers: list, stats, on_response):
+        self._client = tracker_client
+        self._tiers = [[TrackerState(url) for url in tier] for tier in tiers]
+        self._stats = stats # Callable returning (uploaded, downloaded)
+        self._on_response = on_response # Called with (url, response)
+        self._futures = []
+
+    @property
+    def trackers(self):
+        for tier in self._tiers:
+            yield from tier
+
+    def start(self):
+        if not self._futures:
+            self._futures = [asyncio.ensure_future(self._tier_loop(tier))
+                             for tier in self._tiers]
+
+    def stop(self):
+        for future in self._futures:
+            if not future.done():
+                future.cancel()
+        self._futures = []
+
+    async def completed(self):
+        """
+        Send the 'completed' event to the current tracker of each tier
+        which knows about us
+        """
+        await asyncio.gather(*(self._announce(tier[0], 'completed')
+                               for tier in self._tiers if tier[0].started))
+
+    async def _tier_loop(self, tier):
+        while True:
+            await asyncio.sleep(await self._announce_tier(tier))
+
+    async def _announce_tier(self, tier) -> float:
+        """
+        Returns the delay until the tier should be announced again
+        """
+        for tracker in list(tier):
+            if tracker.next_announce > time.monotonic():
+                continue
+            if await self._announce(tracker):
+                tier.remove(tracker)
+                tier.insert(0, tracker)
+                return tracker.interval
+        return max(1, min(t.next_announce for t in tier) - time.monotonic())
+
+    async def _announce(self, tracker, event: str = None) -> bool:
+        if event is None and not tracker.started:
+            event = 'started'
+        uploaded, downloaded = self._stats()
+        try:
+            response = await asyncio.wait_for(
+                self._client.announce(tracker.url, uploaded=uploaded,
+                                      downloaded=downloaded, event=event),
+                self.TIMEOUT)
+        except asyncio.TimeoutError:
+            response = None
+        except Exception as e:
+            # Whatever the tracker sent, its tier keeps announcing
+            BUS.warning('tracker.error', tracker=tracker, error=repr(e))
+            response = None
+        if response is None or response.failure:
+            tracker.failures += 1
+            tracker.next_announce = time.monotonic() + min(
+                self.MAX_BACKOFF,
+                self.MIN_BACKOFF * 2 ** (tracker.failures - 1))
+            if response:
+                BUS.warning('tracker.failure', tracker=tracker,
+                            reason=response.failure)
+            return False
+        tracker.failures = 0
+        tracker.started = True
+        tracker.interval = response.interval or self.DEFAULT_INTERVAL
+        tracker.next_announce = time.monotonic() + tracker.interval
+        self._on_response(tracker.url, response)
+        return True
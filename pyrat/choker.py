@@ -0,0 +1,105 @@
+import asyncio
+import math
+import random
+import time
+
+
+
+class RateMeter:
+    """
+    Exponentially decaying transfer rate in bytes per second
+    """
+    def __init__(self, window: float = 20.0):
+        self._window = window
+        self._rate = 0.0
+        self._last = time.monotonic()
+        self.total = 0
+
+    def _decay(self, now):
+        elapsed = now - self._last
+        if elapsed > 0:
+            self._rate *= math.exp(-elapsed / self._window)
+            self._last = now
+
+    def update(self, amount: int):
+        self._decay(time.monotonic())
+        self._rate += amount / self._window
+        self.total += amount
+
+    @property
+    def rate(self) -> float:
+        self._decay(time.monotonic())
+        return self._rate
+
+
+class Choker:
+    """
+    Tit-for-tat choking: every `interval` seconds the interested peers
+    which gave us the best download rate (or took the best upload rate
+    once we are seeding) are unchoked. One more slot is handed to a random
+    choked peer and rotated every `optimistic_interval` seconds so new
+    peers get a chance to prove themselves.
+    """
+
+    NEW_PEER_TIME = 60 # Seconds a connection is considered new
+    NEW_PEER_WEIGHT = 3 # New peers are that much likelier to be picked
+
+    def __init__(self, connections, piece_manager, upload_slots: int = 4,
+                 interval: float = 10, optimistic_interval: float = 30):
+        self._connections = connections # Callable returning connections
+        self._piece_manager = piece_manager
+        self._upload_slots = upload_slots
+        self._interval = interval
+        self._optimistic_interval = optimistic_interval
+        self._optimistic = None
+        self._optimistic_at = 0
+        self._future = None
+
+    def start(self):
+        if not self._future:
+            self._future = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._future and not self._future.done():
+            self._future.cancel()
+        self._future = None
+
+    async def _run(self):
+        while True:
+            self.rechoke()
+            await asyncio.sleep(self._interval)
+
+    def _rate(self, conn):
+        if self._piece_manager.complete:
+            return conn.upload_rate.rate
+        return conn.download_rate.rate
+
+    def rechoke(self):
+        conns = [c for c in self._connections() if c.connected]
+        interested = [c for c in conns if c.peer_interested]
+        interested.sort(key=self._rate, reverse=True)
+        unchoked = set(interested[:self._upload_slots])
+
+        now = time.monotonic()
+        if self._optimistic not in conns or self._optimistic in unchoked or \
+                self._optimistic_at + self._optimistic_interval <= now:
+            self._optimistic = self._pick_optimistic(
+                [c for c in interested if c not in unchoked], now)
+            self._optimistic_at = now
+        if self._optimistic:
+            unchoked.add(self._optimistic)
+
+        for conn in conns:
+            if conn in unchoked:
+                conn.unchoke()
+            else:
+                conn.choke()
+
+    def _pick_optimistic(self, candidates, now):
+        if not candidates:
+            return None
+        weights = [self.NEW_PEER_WEIGHT
+                   if c.connected_at and now - c.connected_at <
+                   self.NEW_PEER_TIME else 1
+                   for c in candidates]
+        return random.choices(candidates, weights)[0]
@@ -0,0 +1,613 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from hashlib import sha1
+from socket import inet_aton, inet_ntoa
+from struct import pack, iter_unpack
+
+from .bencode_parser import Decoder, Encoder
+from .tracker_client import parse_compact_peers
+
+
+
+K = 8 # Nodes per bucket and nodes kept by a lookup
+ALPHA = 3 # Queries in flight during a lookup
+ID_LENGTH = 20
+BOOTSTRAP_NODES = (('router.bittorrent.com', 6881),
+                   ('dht.transmissionbt.com', 6881),
+                   ('router.utorrent.com', 6881))
+
+ERROR_GENERIC = 201
+ERROR_PROTOCOL = 203
+ERROR_METHOD = 204
+
+
+class DHTError(Exception):
+    def __init__(self, code: int, message: str):
+        super().__init__("{} {}".format(code, message))
+        self.code = code
+
+
+def distance(a: bytes, b: bytes) -> int:
+    return int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')
+
+
+def _sorted(obj):
+    # Bencoded dictionaries must have their keys sorted
+    if isinstance(obj, dict):
+        return {key: _sorted(obj[key]) for key in sorted(obj)}
+    if isinstance(obj, list):
+        return [_sorted(item) for item in obj]
+    return obj
+
+
+def encode_message(msg: dict) -> bytes:
+    return bytes(Encoder.encode(_sorted(msg)))
+
+
+def encode_nodes(nodes) -> bytes:
+    """
+    Compact node info: 20 bytes id, 4 bytes IPv4 and 2 bytes port
+    """
+    data = bytearray()
+    for node in nodes:
+        try:
+            data += node.id + inet_aton(node.ip) + pack('>H', node.port)
+        except OSError:
+            continue
+    return bytes(data)
+
+
+def decode_nodes(data: bytes) -> list:
+    if not isinstance(data, bytes):
+        return []
+    view = memoryview(data)[:len(data) - len(data) % 26]
+    return [Node(bytes(node_id), inet_ntoa(ip), port)
+            for node_id, ip, port in iter_unpack('>20s4sH', view) if port]
+
+
+class Node:
+    GOOD_FOR = 15 * 60 # Seconds a node is trusted after it answered
+
+    def __init__(self, node_id: bytes, ip: str, port: int):
+        self.id = node_id
+        self.ip = ip
+        self.port = port
+        self.last_seen = 0 # Last query or response received, unix time
+        self.failures = 0 # Queries in a row left unanswered
+
+    @property
+    def addr(self):
+        return (self.ip, self.port)
+
+    @property
+    def good(self) -> bool:
+        return not self.failures and \
+            self.last_seen + self.GOOD_FOR > time.time()
+
+    def __repr__(self):
+        return "Node({}, {}:{})".format(self.id.hex()[:8], self.ip, self.port)
+
+
+class RoutingTable:
+    """
+    Kademlia routing table, bucket `i` holds up to `k` nodes whose distance
+    to our id has `i + 1` significant bits. Buckets are kept least recently
+    seen first.
+    """
+
+    BAD_FAILURES = 2 # Unanswered queries making a node replaceable
+
+    def __init__(self, node_id: bytes, k: int = K):
+        self._id = node_id
+        self._k = k
+        self._buckets = [[] for _ in range(ID_LENGTH * 8)]
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self._buckets)
+
+    def nodes(self):
+        for bucket in self._buckets:
+            yield from bucket
+
+    def _bucket(self, node_id: bytes):
+        dist = distance(self._id, node_id)
+        return self._buckets[dist.bit_length() - 1] if dist else None
+
+    def get(self, node_id: bytes) -> Node:
+        for node in self._bucket(node_id) or ():
+            if node.id == node_id:
+                return node
+        return None
+
+    def add(self, node: Node) -> Node:
+        """
+        Insert or refresh a node. When its bucket is full of live nodes the
+        least recently seen one is returned, the caller should check it
+        before replacing it.
+        """
+        bucket = self._bucket(node.id)
+        if bucket is None:
+            return None
+        for idx, known in enumerate(bucket):
+            if known.id == node.id:
+                if node.last_seen:
+                    known.ip, known.port = node.ip, node.port
+                    known.last_seen = node.last_seen
+                    known.failures = 0
+                    bucket.append(bucket.pop(idx))
+                return None
+        if len(bucket) < self._k:
+            bucket.append(node)
+            return None
+        for idx, known in enumerate(bucket):
+            if known.failures >= self.BAD_FAILURES:
+                del bucket[idx]
+                bucket.append(node)
+                return None
+        return bucket[0]
+
+    def remove(self, node_id: bytes):
+        bucket = self._bucket(node_id)
+        if bucket:
+            bucket[:] = [node for node in bucket if node.id != node_id]
+
+    def failed(self, addr):
+        for node in self.nodes():
+            if node.addr == addr:
+                node.failures += 1
+
+    def closest(self, target: bytes, count: int = K) -> list:
+        nodes = [node for node in self.nodes()
+                 if node.failures < self.BAD_FAILURES]
+        nodes.sort(key=lambda node: distance(node.id, target))
+        return nodes[:count]
+
+
+class TokenManager:
+    """
+    Tokens given with get_peers answers, valid for one to two rotation
+    intervals
+    """
+
+    INTERVAL = 5 * 60
+
+    def __init__(self):
+        self._secrets = [os.urandom(8), os.urandom(8)]
+        self._rotated = time.monotonic()
+
+    def _rotate(self):
+        if self._rotated + self.INTERVAL < time.monotonic():
+            self._rotated = time.monotonic()
+            self._secrets = [os.urandom(8), self._secrets[0]]
+
+    def token(self, ip: str) -> bytes:
+        self._rotate()
+        return sha1(self._secrets[0] + ip.encode('utf-8')).digest()[:8]
+
+    def check(self, ip: str, token) -> bool:
+        self._rotate()
+        return any(sha1(secret + ip.encode('utf-8')).digest()[:8] == token
+                   for secret in self._secrets)
+
+
+class _KRPCProtocol(asyncio.DatagramProtocol):
+    def __init__(self, node):
+        self._node = node
+
+    def datagram_received(self, data, addr):
+        self._node.datagram_received(data, addr[:2])
+
+    def error_received(self, exc):
+        # The query will time out
+        pass
+
+
+class DHTNode:
+    """
+    Mainline DHT node (BEP 5).
+
+    Answers ping, find_node, get_peers and announce_peer queries and runs
+    iterative lookups keeping `ALPHA` queries in flight. The node id and
+    the good nodes of the routing table are saved to `state_path`, so a
+    restarted node does not need the bootstrap routers.
+    """
+
+    TIMEOUT = 5
+    REFRESH_INTERVAL = 15 * 60
+    MAX_LOOKUP_QUERIES = 16 * K
+    PEER_TTL = 30 * 60 # Announced peers are forgotten after it
+    MAX_STORED_PEERS = 100 # Per info hash
+    MAX_STORED_HASHES = 2000
+
+    def __init__(self, port: int = 6881, node_id: bytes = None,
+                 bootstrap=BOOTSTRAP_NODES, state_path: str = None,
+                 host: str = '0.0.0.0'):
+        self._port = port
+        self._host = host
+        self._bootstrap_nodes = list(bootstrap)
+        self._state_path = state_path
+        saved_id, saved_nodes = self._load()
+        self._id = node_id or saved_id or os.urandom(ID_LENGTH)
+        self._table = RoutingTable(self._id)
+        for node in saved_nodes:
+            self._table.add(node)
+        self._tokens = TokenManager()
+        self._stored = dict() # info hash => {(ip, port): announce time}
+        self._pending = dict() # transaction id => (future, address)
+        self._tid = 0
+        self._checking = set() # Nodes being pinged before an eviction
+        self._transport = None
+        self._own_transport = False
+        self._bootstrapping = None
+        self._maintenance = None
+
+    @property
+    def node_id(self) -> bytes:
+        return self._id
+
+    @property
+    def port(self) -> int:
+        if self._transport:
+            return self._transport.get_extra_info('sockname')[1]
+        return self._port
+
+    @property
+    def routing_table(self) -> RoutingTable:
+        return self._table
+
+    async def start(self, transport=None):
+        """
+        `transport` is an UDP transport shared with uTP, which then passes
+        the DHT datagrams to `datagram_received`
+        """
+        if transport is None:
+            loop = asyncio.get_event_loop()
+            self._transport, _ = await loop.create_datagram_endpoint(
+                lambda: _KRPCProtocol(self),
+                local_addr=(self._host, self._port))
+            self._own_transport = True
+        else:
+            self._transport = transport
+        self._bootstrapping = asyncio.ensure_future(self.bootstrap())
+        self._maintenance = asyncio.ensure_future(self._maintain())
+
+    def close(self):
+        for future in (self._bootstrapping, self._maintenance):
+            if future and not future.done():
+                future.cancel()
+        for future, _ in self._pending.values():
+            if not future.done():
+                future.cancel()
+        if self._transport and self._own_transport:
+            self._transport.close()
+        self._transport = None
+        self.save()
+
+    def _load(self):
+        if not self._state_path:
+            return None, []
+        try:
+            with open(self._state_path, 'rb') as f:
+                state = Decoder(f.read()).parse()
+        except FileNotFoundError:
+            return None, []
+        except (OSError, RuntimeError, IndexError, EOFError, ValueError):
+            logging.warning('Unable to read the DHT state {}'.format(
+                self._state_path))
+            return None, []
+        node_id = state.get(b'id')
+        if not isinstance(node_id, bytes) or len(node_id) != ID_LENGTH:
+            node_id = None
+        return node_id, decode_nodes(state.get(b'nodes', b''))
+
+    def save(self):
+        if not self._state_path:
+            return
+        nodes = [node for node in self._table.nodes() if not node.failures]
+        try:
+            os.makedirs(os.path.dirname(self._state_path), exist_ok=True)
+            tmp_path = self._state_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(encode_message({b'id': self._id,
+                                        b'nodes': encode_nodes(nodes)}))
+            os.replace(tmp_path, self._state_path)
+        except OSError:
+            logging.warning('Unable to write the DHT state {}'.format(
+                self._state_path))
+
+    async def bootstrap(self):
+        """
+        Fill the routing table with a lookup of our own id, the bootstrap
+        routers are only asked when the saved table is too small
+        """
+        seeds = []
+        if len(self._table) < K:
+            addrs = await self._resolve(self._bootstrap_nodes)
+            responses = await asyncio.gather(
+                *(self._query(addr, b'find_node', {b'target': self._id})
+                  for addr in addrs))
+            for response in responses:
+                if response:
+                    seeds += decode_nodes(response.get(b'nodes', b''))
+        await self._lookup(self._id, b'find_node', seeds)
+
+    async def _resolve(self, hosts) -> list:
+        loop = asyncio.get_event_loop()
+        addrs = []
+        for host, port in hosts:
+            try:
+                infos = await loop.getaddrinfo(host, port,
+                                               type=socket.SOCK_DGRAM,
+                                               family=socket.AF_INET)
+            except OSError:
+                continue
+            addrs.append(infos[0][4][:2])
+        return addrs
+
+    async def _maintain(self):
+        while True:
+            await asyncio.sleep(self.REFRESH_INTERVAL)
+            if len(self._table) < K:
+                await self.bootstrap()
+            else:
+                await self._lookup(os.urandom(ID_LENGTH), b'find_node')
+            self.save()
+
+    async def ping(self, addr) -> bool:
+        return await self._query(addr, b'ping', {}) is not None
+
+    async def get_peers(self, info_hash: bytes) -> set:
+        await self._wait_bootstrap()
+        peers, _ = await self._lookup(info_hash, b'get_peers')
+        return peers
+
+    async def announce(self, info_hash: bytes, port: int) -> set:
+        """
+        Look the torrent up, announce ourselves on `port` to the closest
+        nodes and return the peers found
+        """
+        await self._wait_bootstrap()
+        peers, nodes = await self._lookup(info_hash, b'get_peers')
+        await asyncio.gather(
+            *(self._query(node.addr, b'announce_peer',
+                          {b'info_hash': info_hash, b'port': port,
+                           b'token': token, b'implied_port': 0})
+              for node, token in nodes if isinstance(token, bytes)))
+        return peers
+
+    async def _wait_bootstrap(self):
+        if self._bootstrapping and not self._bootstrapping.done():
+            try:
+                await asyncio.shield(self._bootstrapping)
+            except asyncio.CancelledError:
+                if not self._bootstrapping.cancelled():
+                    raise
+
+    async def _lookup(self, target: bytes, method: bytes, seeds=()) -> tuple:
+        """
+        Iterative lookup of `target`. Returns the peers found and the `K`
+        closest nodes which answered with the token they gave.
+        """
+        key = b'target' if method == b'find_node' else b'info_hash'
+        candidates = {node.addr: node for node in self._table.closest(target)}
+        for node in seeds:
+            if node.id != self._id:
+                candidates.setdefault(node.addr, node)
+        queried = set()
+        answered = dict() # address => (node, token)
+        peers = set()
+        inflight = dict() # future => node
+        try:
+            while True:
+                closest = sorted(candidates.values(),
+                                 key=lambda node: distance(node.id, target))
+                for node in closest[:K]:
+                    if len(inflight) >= ALPHA or \
+                            len(queried) >= self.MAX_LOOKUP_QUERIES:
+                        break
+                    if node.addr in queried:
+                        continue
+                    queried.add(node.addr)
+                    inflight[asyncio.ensure_future(
+                        self._query(node.addr, method, {key: target}))] = node
+                if not inflight:
+                    break
+                done, _ = await asyncio.wait(
+                    inflight, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    node = inflight.pop(future)
+                    response = future.result()
+                    if response is None:
+                        candidates.pop(node.addr, None)
+                        continue
+                    node = Node(response[b'id'], node.ip, node.port)
+                    candidates[node.addr] = node
+                    answered[node.addr] = (node, response.get(b'token'))
+                    for found in decode_nodes(response.get(b'nodes', b'')):
+                        if found.id != self._id and found.addr not in queried:
+                            candidates.setdefault(found.addr, found)
+                    values = response.get(b'values')
+                    for value in values if isinstance(values, list) else ():
+                        if isinstance(value, bytes):
+                            peers.update(parse_compact_peers(value))
+        finally:
+            for future in inflight:
+                future.cancel()
+        nodes = sorted(answered.values(),
+                       key=lambda item: distance(item[0].id, target))
+        return peers, nodes[:K]
+
+    def _next_tid(self) -> bytes:
+        while True:
+            self._tid = (self._tid + 1) % 2**16
+            tid = pack('>H', self._tid)
+            if tid not in self._pending:
+                return tid
+
+    async def _query(self, addr, method: bytes, args: dict) -> dict:
+        """
+        Send a query and wait for its response, None on timeout or error
+        """
+        if self._transport is None:
+            return None
+        tid = self._next_tid()
+        args[b'id'] = self._id
+        future = asyncio.get_event_loop().create_future()
+        self._pending[tid] = (future, addr)
+        try:
+            self._send(addr, {b't': tid, b'y': b'q', b'q': method,
+                              b'a': args})
+            response = await asyncio.wait_for(future, self.TIMEOUT)
+        except asyncio.TimeoutError:
+            self._table.failed(addr)
+            return None
+        except DHTError:
+            return None
+        finally:
+            self._pending.pop(tid, None)
+        node_id = response.get(b'id')
+        if not isinstance(node_id, bytes) or len(node_id) != ID_LENGTH:
+            return None
+        self._seen(Node(node_id, addr[0], addr[1]))
+        return response
+
+    def _send(self, addr, msg: dict):
+        if self._transport:
+            self._transport.sendto(encode_message(msg), addr)
+
+    def _seen(self, node: Node):
+        node.last_seen = time.time()
+        oldest = self._table.add(node)
+        if oldest and oldest.id not in self._checking:
+            self._checking.add(oldest.id)
+            asyncio.ensure_future(self._check(oldest, node))
+
+    async def _check(self, oldest: Node, node: Node):
+        # A full bucket keeps its old nodes as long as they answer
+        try:
+            if not await self.ping(oldest.addr):
+                self._table.remove(oldest.id)
+                self._table.add(node)
+        finally:
+            self._checking.discard(oldest.id)
+
+    def datagram_received(self, data: bytes, addr):
+        try:
+            msg = Decoder(data).parse()
+        except (RuntimeError, IndexError, EOFError, ValueError, TypeError):
+            return
+        if not isinstance(msg, dict):
+            return
+        kind = msg.get(b'y')
+        if kind == b'q':
+            self._on_query(msg, addr)
+        elif kind in (b'r', b'e'):
+            tid = msg.get(b't')
+            if not isinstance(tid, bytes):
+                return # Malformed, a list or dict would not even hash
+            pending = self._pending.get(tid)
+            if pending is None or pending[1] != addr or pending[0].done():
+                return
+            future = pending[0]
+            if kind == b'r' and isinstance(msg.get(b'r'), dict):
+                future.set_result(msg[b'r'])
+            else:
+                error = msg.get(b'e')
+                if not isinstance(error, list) or len(error) < 2 or \
+                        not isinstance(error[1], bytes):
+                    error = [ERROR_GENERIC, b'']
+                future.set_exception(DHTError(
+                    error[0], error[1].decode('utf-8', 'replace')))
+
+    def _on_query(self, msg: dict, addr):
+        tid = msg.get(b't', b'')
+        args = msg.get(b'a')
+        method = msg.get(b'q')
+        if not isinstance(args, dict) or not self._valid_id(args.get(b'id')):
+            return self._error(addr, tid, ERROR_PROTOCOL, "Bad query")
+        self._seen(Node(args[b'id'], addr[0], addr[1]))
+        if method == b'ping':
+            response = {}
+        elif method == b'find_node':
+            target = args.get(b'target')
+            if not self._valid_id(target):
+                return self._error(addr, tid, ERROR_PROTOCOL, "Bad target")
+            response = {b'nodes': encode_nodes(self._table.closest(target))}
+        elif method == b'get_peers':
+            info_hash = args.get(b'info_hash')
+            if not self._valid_id(info_hash):
+                return self._error(addr, tid, ERROR_PROTOCOL,
+                                   "Bad info_hash")
+            response = {b'token': self._tokens.token(addr[0])}
+            values = self._stored_peers(info_hash)
+            if values:
+                response[b'values'] = values
+            else:
+                response[b'nodes'] = encode_nodes(
+                    self._table.closest(info_hash))
+        elif method == b'announce_peer':
+            info_hash = args.get(b'info_hash')
+            port = addr[1] if args.get(b'implied_port') else args.get(b'port')
+            if not self._valid_id(info_hash) or not isinstance(port, int) \
+                    or not 0 < port < 65536:
+                return self._error(addr, tid, ERROR_PROTOCOL,
+                                   "Bad announce")
+            if not self._tokens.check(addr[0], args.get(b'token')):
+                return self._error(addr, tid, ERROR_PROTOCOL, "Bad token")
+            self._store_peer(info_hash, (addr[0], port))
+            response = {}
+        else:
+            return self._error(addr, tid, ERROR_METHOD, "Method Unknown")
+        response[b'id'] = self._id
+        self._send(addr, {b't': tid, b'y': b'r', b'r': response})
+
+    def _error(self, addr, tid, code: int, message: str):
+        self._send(addr, {b't': tid, b'y': b'e',
+                          b'e': [code, message.encode('utf-8')]})
+
+    @staticmethod
+    def _valid_id(node_id) -> bool:
+        return isinstance(node_id, bytes) and len(node_id) == ID_LENGTH
+
+    def _expire_peers(self, info_hash: bytes):
+        """
+        Forget the peers announced more than PEER_TTL ago, and the info hash
+        once none is left
+        """
+        peers = self._stored[info_hash]
+        oldest = time.monotonic() - self.PEER_TTL
+        # Kept in announce order, the expired ones come first
+        while peers and next(iter(peers.values())) < oldest:
+            del peers[next(iter(peers))]
+        if not peers:
+            del self._stored[info_hash]
+
+    def _store_peer(self, info_hash: bytes, peer):
+        peers = self._stored.get(info_hash)
+        if peers is None:
+            if len(self._stored) >= self.MAX_STORED_HASHES:
+                for stored in list(self._stored):
+                    self._expire_peers(stored)
+            if len(self._stored) >= self.MAX_STORED_HASHES:
+                return
+            peers = self._stored[info_hash] = dict()
+        peers.pop(peer, None)
+        peers[peer] = time.monotonic()
+        if len(peers) > self.MAX_STORED_PEERS:
+            del peers[next(iter(peers))] # The least recently announced
+
+    def _stored_peers(self, info_hash: bytes) -> list:
+        if info_hash not in self._stored:
+            return []
+        self._expire_peers(info_hash)
+        peers = self._stored.get(info_hash, ())
+        values = []
+        for ip, port in peers:
+            try:
+                values.append(inet_aton(ip) + pack('>H', port))
+            except OSError:
+                continue
+        return values
@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+
+class WriteJob:
+    def __init__(self, write, pos: int, data: bytes, callback=None):
+        self.write = write # Blocking callable: (pos, data) -> None
+        self.pos = pos
+        self.data = data
+        self.callback = callback
+        self.failed = False # Set once written if the write raised
+
+    @property
+    def end(self):
+        return self.pos + len(self.data)
+
+
+class DiskIO:
+    """
+    Write-back queue drained by a small thread pool.
+
+    Verified pieces are queued with `submit` and written off the event loop,
+    pieces adjacent on disk are merged into one sequential write. Once the
+    queued data passes `high_watermark` bytes `backpressure` is raised until
+    the queue drops below `low_watermark`, so the request scheduler can
+    stop asking for blocks instead of buffering them without bound.
+    """
+    def __init__(self, threads: int = 2, high_watermark: int = 64 * 2**20,
+                 low_watermark: int = None, merge_limit: int = 8 * 2**20):
+        self._threads = threads
+        self._executor = ThreadPoolExecutor(threads)
+        self._high = high_watermark
+        self._low = low_watermark if low_watermark is not None \
+            else high_watermark // 2
+        self._merge_limit = merge_limit
+        self._queue = deque()
+        self._queued_bytes = 0 # Submitted and not yet written
+        self._busy = dict() # write callable => jobs in queue or in flight
+        self._running = 0 # Drain loops running in the pool
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._throttled = False
+        self._room = None
+        self._loop = None
+        self._closed = False
+        self.writes = 0 # Disk writes issued, after merging
+        self.jobs = 0 # Jobs written
+
+    @property
+    def queued_bytes(self) -> int:
+        return self._queued_bytes
+
+    @property
+    def backpressure(self) -> bool:
+        return self._throttled
+
+    async def wait_for_room(self):
+        while self._throttled:
+            if self._room is None:
+                self._room = asyncio.Event()
+            self._room.clear()
+            await self._room.wait()
+
+    def submit(self, write, pos: int, data: bytes,
+               callback=None) -> WriteJob:
+        """
+        Queue `data` to be written at `pos` by `write`. The callback is
+        run on the event loop once the write is done, the returned job
+        tells whether it failed.
+        """
+        if self._closed:
+            raise RuntimeError("Disk I/O pool is closed")
+        if self._loop is None:
+            try:
+                self._loop = asyncio.get_running_loop()
+            except RuntimeError:
+                pass
+        job = WriteJob(write, pos, data, callback)
+        with self._lock:
+            self._queue.append(job)
+            self._queued_bytes += len(data)
+            self._busy[write] = self._busy.get(write, 0) + 1
+            if self._queued_bytes >= self._high:
+                self._throttled = True
+            start = self._running < self._threads
+            if start:
+                self._running += 1
+        if start:
+            self._executor.submit(self._drain)
+        return job
+
+    def _take_batch(self):
+        # Called with the lock held
+        batch = [self._queue.popleft()]
+        size = len(batch[0].data)
+        merged = True
+        while merged and size < self._merge_limit:
+            merged = False
+            for job in self._queue:
+                if job.write != batch[0].write:
+                    continue
+                if job.pos == batch[-1].end:
+                    batch.append(job)
+                elif job.end == batch[0].pos:
+                    batch.insert(0, job)
+                else:
+                    continue
+                self._queue.remove(job)
+                size += len(job.data)
+                merged = True
+                break
+        return batch
+
+    def _drain(self):
+        while True:
+            with self._lock:
+                if not self._queue:
+                    self._running -= 1
+                    return
+                batch = self._take_batch()
+            data = batch[0].data if len(batch) == 1 \
+                else b''.join(job.data for job in batch)
+            try:
+                batch[0].write(batch[0].pos, data)
+            except Exception:
+                logging.exception('Unable to write {} bytes at {}'.format(
+                    len(data), batch[0].pos))
+                for job in batch:
+                    job.failed = True
+            with self._lock:
+                self.writes += 1
+                self.jobs += len(batch)
+                self._queued_bytes -= len(data)
+                for job in batch:
+                    self._busy[job.write] -= 1
+                    if not self._busy[job.write]:
+                        del self._busy[job.write]
+                released = self._throttled and \
+                    self._queued_bytes <= self._low
+                if released:
+                    self._throttled = False
+                self._idle.notify_all()
+            self._notify([job.callback for job in batch if job.callback],
+                         released)
+
+    def _notify(self, callbacks, released):
+        if self._loop is None:
+            for callback in callbacks:
+                callback()
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._on_written, callbacks,
+                                            released)
+        except RuntimeError: # Loop is closed, nobody is waiting anymore
+            pass
+
+    def _on_written(self, callbacks, released):
+        for callback in callbacks:
+            callback()
+        if released and self._room:
+            self._room.set()
+
+    def flush(self, write=None):
+        """
+        Block until everything (or everything queued for `write`) is on disk
+        """
+        with self._lock:
+            if write is None:
+                self._idle.wait_for(lambda: not self._busy)
+            else:
+                self._idle.wait_for(lambda: write not in self._busy)
+
+    async def wait_flushed(self, write=None):
+        """
+        Like `flush` without blocking the event loop, returns once nothing
+        (or nothing for `write`) is queued
+        """
+        loop = asyncio.get_running_loop()
+        while self._pending(write):
+            await loop.run_in_executor(None, self.flush, write)
+
+    def _pending(self, write) -> bool:
+        with self._lock:
+            return bool(self._busy) if write is None else write in self._busy
+
+    def close(self):
+        self.flush()
+        self._closed = True
+        self._executor.shutdown(wait=True)
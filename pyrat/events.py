@@ -0,0 +1,154 @@
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from contextlib import nullcontext
+
+
+
+TRACE = 5 # Below DEBUG, spans of traced operations
+logging.addLevelName(TRACE, 'TRACE')
+
+
+class EventBus:
+    """
+    Structured events on top of the `pyrat` logger. The level is checked
+    before a record is built and records are only formatted by the
+    handlers, so a filtered out event costs one method call.
+    """
+
+    def __init__(self, name: str = 'pyrat'):
+        self._logger = logging.getLogger(name)
+        self._tracer = logging.getLogger(name + '.trace')
+        self.tracing = False # Spans are recorded
+
+    def enabled(self, level: int) -> bool:
+        return self._logger.isEnabledFor(level)
+
+    def emit(self, level: int, event: str, **fields):
+        if self._logger.isEnabledFor(level):
+            self._logger.log(level, event, extra={'fields': fields})
+
+    def debug(self, event: str, **fields):
+        self.emit(logging.DEBUG, event, **fields)
+
+    def info(self, event: str, **fields):
+        self.emit(logging.INFO, event, **fields)
+
+    def warning(self, event: str, **fields):
+        self.emit(logging.WARNING, event, **fields)
+
+    def error(self, event: str, **fields):
+        self.emit(logging.ERROR, event, **fields)
+
+    def trace(self, name: str, duration: float, **fields):
+        """
+        Record a span which took `duration` seconds, for operations which
+        do not fit a `with` block
+        """
+        if self.tracing:
+            fields['duration'] = duration
+            self._tracer.log(TRACE, name, extra={'fields': fields})
+
+    def span(self, name: str, **fields):
+        """
+        Context manager recording how long its block took
+        """
+        if not self.tracing:
+            return _NO_SPAN
+        return _Span(self, name, fields)
+
+
+class _Span:
+    __slots__ = ('_bus', '_name', '_fields', '_start')
+
+    def __init__(self, bus, name, fields):
+        self._bus = bus
+        self._name = name
+        self._fields = fields
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._bus.trace(self._name, time.perf_counter() - self._start,
+                        **self._fields)
+        return False
+
+
+_NO_SPAN = nullcontext()
+
+
+class EventFormatter(logging.Formatter):
+    """
+    `time level logger event key=value...`
+    """
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s %(message)s')
+
+    def format(self, record):
+        text = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            text += ' ' + ' '.join('{}={}'.format(key, value)
+                                   for key, value in fields.items())
+        return text
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    # The stock handler formats in the emitting thread, here the listener
+    # thread does it
+    def prepare(self, record):
+        return record
+
+
+BUS = EventBus()
+_listener = None
+_handler = None
+
+
+def configure(level='WARNING', output: str = None, trace: bool = False,
+              stream=None):
+    """
+    Write the events of `level` and above to `stream` (stdout by default)
+    and to the `output` file if given, from a background thread.
+    """
+    global _listener, _handler
+    shutdown()
+    logger = logging.getLogger('pyrat')
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+    logger.setLevel(level)
+    logger.propagate = False
+    handlers = [logging.StreamHandler(stream or sys.stdout)]
+    if output:
+        handlers.append(logging.FileHandler(output))
+    for handler in handlers:
+        handler.setFormatter(EventFormatter())
+    records = queue.SimpleQueue()
+    _handler = _DeferredQueueHandler(records)
+    logger.addHandler(_handler)
+    BUS.tracing = trace
+    logging.getLogger('pyrat.trace').setLevel(TRACE if trace else
+                                              logging.NOTSET)
+    _listener = logging.handlers.QueueListener(records, *handlers)
+    _listener.start()
+
+
+def shutdown():
+    """
+    Write the queued events and stop the writer thread
+    """
+    global _listener, _handler
+    if _listener:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+    if _handler:
+        logging.getLogger('pyrat').removeHandler(_handler)
+        _handler = None
@@ -0,0 +1,167 @@
+import asyncio
+import os
+import socket
+import struct
+import time
+
+from .events import BUS
+
+
+
+LSD_GROUP = '239.192.152.143'
+LSD_PORT = 6771
+ANNOUNCE_INTERVAL = 5 * 60 # Between announces of a torrent
+MIN_INTERVAL = 60 # BEP 14 allows one announce of a torrent a minute
+MAX_HASHES = 20 # Info hashes in one datagram, keeps it under 1400 bytes
+
+
+def encode_announce(port: int, info_hashes, cookie: str,
+                    group: str = LSD_GROUP, lsd_port: int = LSD_PORT) -> bytes:
+    lines = ['BT-SEARCH * HTTP/1.1',
+             'Host: {}:{}'.format(group, lsd_port),
+             'Port: {}'.format(port)]
+    lines.extend('Infohash: {}'.format(info_hash.hex())
+                 for info_hash in info_hashes)
+    lines.append('cookie: {}'.format(cookie))
+    return ('\r\n'.join(lines) + '\r\n\r\n\r\n').encode('ascii')
+
+
+def decode_announce(data: bytes):
+    """
+    (port, info hashes, cookie) of an announce, None if it is not one
+    """
+    try:
+        lines = data.decode('ascii').split('\r\n')
+    except UnicodeDecodeError:
+        return None
+    if not lines or not lines[0].startswith('BT-SEARCH * HTTP/1.'):
+        return None
+    port = None
+    cookie = None
+    info_hashes = []
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        name = name.strip().lower()
+        value = value.strip()
+        try:
+            if name == 'port':
+                port = int(value)
+            elif name == 'infohash' and len(value) == 40:
+                info_hashes.append(bytes.fromhex(value))
+            elif name == 'cookie':
+                cookie = value
+        except ValueError:
+            return None
+    if port is None or not 0 < port < 65536 or not info_hashes:
+        return None
+    return port, info_hashes, cookie
+
+
+class _LSDProtocol(asyncio.DatagramProtocol):
+    def __init__(self, discovery):
+        self._discovery = discovery
+
+    def datagram_received(self, data, addr):
+        self._discovery.datagram_received(data, addr[:2])
+
+    def error_received(self, exc):
+        pass
+
+
+class LocalDiscovery:
+    """
+    Local Service Discovery (BEP 14): the torrents are announced on a
+    multicast group every ANNOUNCE_INTERVAL and the announces of other
+    hosts reach the torrents registered with `add`. Our own announces,
+    looped back by the group, are told apart by their cookie.
+    """
+
+    def __init__(self, port: int, group: str = LSD_GROUP,
+                 lsd_port: int = LSD_PORT):
+        self._port = port # Where peers can connect to us
+        self._group = group
+        self._lsd_port = lsd_port
+        self._cookie = os.urandom(4).hex()
+        self._torrents = dict() # info hash => on_peers callback
+        self._announced = dict() # info hash => time.monotonic()
+        self._transport = None
+        self._future = None
+
+    def _socket(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Every client of the host listens on the same port
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('', self._lsd_port))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                        struct.pack('4s4s', socket.inet_aton(self._group),
+                                    socket.inet_aton('0.0.0.0')))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        sock.setblocking(False)
+        return sock
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        try:
+            self._transport, _ = await loop.create_datagram_endpoint(
+                lambda: _LSDProtocol(self), sock=self._socket())
+        except OSError as e:
+            # No multicast route, LAN peers are simply not found
+            BUS.warning('lsd.unavailable', error=repr(e))
+            return
+        self._future = asyncio.ensure_future(self._announce_loop())
+        self.announce(list(self._torrents))
+
+    def close(self):
+        if self._future and not self._future.done():
+            self._future.cancel()
+        self._future = None
+        if self._transport:
+            self._transport.close()
+        self._transport = None
+
+    def add(self, info_hash: bytes, on_peers):
+        """
+        Announce the torrent, `on_peers` gets the (ip, port) of the LAN
+        peers which announce it
+        """
+        self._torrents[info_hash] = on_peers
+        self.announce([info_hash])
+
+    def remove(self, info_hash: bytes):
+        self._torrents.pop(info_hash, None)
+        self._announced.pop(info_hash, None)
+
+    def announce(self, info_hashes):
+        if self._transport is None:
+            return
+        now = time.monotonic()
+        due = [info_hash for info_hash in info_hashes
+               if self._announced.get(info_hash, -MIN_INTERVAL) +
+               MIN_INTERVAL <= now]
+        for start in range(0, len(due), MAX_HASHES):
+            batch = due[start:start + MAX_HASHES]
+            self._transport.sendto(
+                encode_announce(self._port, batch, self._cookie,
+                                self._group, self._lsd_port),
+                (self._group, self._lsd_port))
+            for info_hash in batch:
+                self._announced[info_hash] = now
+
+    async def _announce_loop(self):
+        while True:
+            await asyncio.sleep(ANNOUNCE_INTERVAL)
+            self.announce(list(self._torrents))
+
+    def datagram_received(self, data: bytes, addr):
+        announce = decode_announce(data)
+        if announce is None:
+            return
+        port, info_hashes, cookie = announce
+        if cookie == self._cookie:
+            return
+        for info_hash in info_hashes:
+            on_peers = self._torrents.get(info_hash)
+            if on_peers:
+                on_peers([(addr[0], port)])
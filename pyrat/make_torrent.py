@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+"""
+Create .torrent files, hashing pieces on every core:
+
+    python -m pyrat.make_torrent DATA -a http://tracker/announce -o out.torrent
+"""
+
+import mmap
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha1
+from itertools import repeat
+
+from .bencode_parser import Encoder
+
+
+
+MIN_PIECE_LENGTH = 2**14
+MAX_PIECE_LENGTH = 2**24
+TARGET_PIECES = 1500 # Piece length is picked for about that many pieces
+TASK_SIZE = 32 * 2**20 # Bytes hashed by one task of the pool
+
+
+def piece_length_for(total_size: int) -> int:
+    length = MIN_PIECE_LENGTH
+    while length < MAX_PIECE_LENGTH and total_size / length > TARGET_PIECES:
+        length *= 2
+    return length
+
+
+def _walk(path: str):
+    """
+    (path, relative path parts, length) of the files to share, in the
+    order they are laid out in the torrent
+    """
+    if os.path.isfile(path):
+        return [(path, [os.path.basename(path)], os.path.getsize(path))]
+    files = []
+    for root, _, names in os.walk(path):
+        for name in names:
+            full = os.path.join(root, name)
+            if os.path.isfile(full):
+                parts = os.path.relpath(full, path).split(os.sep)
+                files.append((full, parts, os.path.getsize(full)))
+    return sorted(files, key=lambda item: item[1])
+
+
+def _hash_pieces(files, piece_length: int, start: int, end: int) -> bytes:
+    """
+    Digests of the pieces in the torrent byte range [start, end), which
+    begins on a piece boundary. `files` are the (path, torrent offset,
+    length) of the files overlapping it. Runs in a pool process.
+    """
+    maps = []
+    try:
+        views = []
+        for path, offset, length in files:
+            with open(path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            maps.append(data)
+            views.append((offset, length, memoryview(data)))
+        digests = []
+        for pos in range(start, end, piece_length):
+            piece_end = min(pos + piece_length, end)
+            digest = sha1()
+            for offset, length, view in views:
+                lo = max(pos, offset)
+                hi = min(piece_end, offset + length)
+                if lo < hi:
+                    digest.update(view[lo - offset:hi - offset])
+            digests.append(digest.digest())
+        for _, _, view in views:
+            view.release()
+        return b''.join(digests)
+    finally:
+        for data in maps:
+            data.close()
+
+
+def _tasks(files, piece_length: int, total_size: int):
+    task_size = max(1, TASK_SIZE // piece_length) * piece_length
+    for start in range(0, total_size, task_size):
+        end = min(start + task_size, total_size)
+        overlapping = [(path, offset, length) for path, offset, length
+                       in files if length and offset < end and
+                       offset + length > start]
+        yield overlapping, start, end
+
+
+def _canonical(value):
+    # Bencoded dictionaries are sorted by key
+    if isinstance(value, dict):
+        return {key: _canonical(value[key]) for key in sorted(value)}
+    if isinstance(value, list):
+        return [_canonical(item) for item in value]
+    return value
+
+
+def make_torrent(path: str, announce=None, output: str = None,
+                 piece_length: int = None, private: bool = False,
+                 comment: str = None, workers: int = None,
+                 progress=None, web_seeds: list = None) -> bytes:
+    """
+    Build the metainfo of a file or a directory and write it to `output`
+    if given. `announce` is a tracker URL or a list of tiers (lists of
+    URLs), `web_seeds` are HTTP servers holding the content (BEP 19).
+    `progress(hashed bytes, total bytes)` is called as pieces are hashed,
+    in order.
+    """
+    path = os.path.abspath(path)
+    layout = _walk(path)
+    total_size = sum(length for _, _, length in layout)
+    if not total_size:
+        raise ValueError("Nothing to share in {}".format(path))
+    piece_length = piece_length or piece_length_for(total_size)
+    files = []
+    offset = 0
+    for full, _, length in layout:
+        files.append((full, offset, length))
+        offset += length
+
+    pieces = bytearray()
+    hashed = 0
+    tasks = list(_tasks(files, piece_length, total_size))
+    task_files, starts, ends = zip(*tasks)
+    with ProcessPoolExecutor(workers) as pool:
+        # map yields the digests in task order whatever order they end in
+        for start, end, digests in zip(starts, ends, pool.map(
+                _hash_pieces, task_files, repeat(piece_length), starts,
+                ends)):
+            pieces += digests
+            hashed += end - start
+            if progress:
+                progress(hashed, total_size)
+
+    info = {b'name': os.path.basename(path).encode('utf-8'),
+            b'piece length': piece_length,
+            b'pieces': bytes(pieces)}
+    if os.path.isfile(path):
+        info[b'length'] = total_size
+    else:
+        info[b'files'] = [{b'length': length,
+                           b'path': [part.encode('utf-8') for part in parts]}
+                          for _, parts, length in layout]
+    if private:
+        info[b'private'] = 1
+    metainfo = {b'info': info, b'created by': b'pyrat',
+                b'creation date': int(time.time())}
+    if announce:
+        tiers = [[announce]] if isinstance(announce, str) else announce
+        metainfo[b'announce'] = tiers[0][0].encode('utf-8')
+        if len(tiers) > 1 or len(tiers[0]) > 1:
+            metainfo[b'announce-list'] = [[url.encode('utf-8')
+                                           for url in tier]
+                                          for tier in tiers]
+    if comment:
+        metainfo[b'comment'] = comment.encode('utf-8')
+    if web_seeds:
+        metainfo[b'url-list'] = [url.encode('utf-8') for url in web_seeds]
+    data = bytes(Encoder.encode(_canonical(metainfo)))
+    if output:
+        with open(output, 'wb') as f:
+            f.write(data)
+    return data
+
+
+def init_parser():
+    parser = ArgumentParser(description="Create a torrent file.")
+    parser.add_argument("path", help="File or directory to share.")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Torrent file, PATH.torrent by default.")
+    parser.add_argument("-a", "--announce", action="append", default=[],
+                        help="Tracker URL, one tier each, may be repeated.")
+    parser.add_argument("-l", "--piece-length", type=int, default=None,
+                        help="Piece length in KB, picked from the size if "
+                             "unset.")
+    parser.add_argument("-p", "--private", action="store_true")
+    parser.add_argument("-c", "--comment", default=None)
+    parser.add_argument("-u", "--web-seed", action="append", default=[],
+                        help="URL of an HTTP server holding the content, "
+                             "may be repeated.")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="Hashing processes, one per core by default.")
+    return parser
+
+
+def main():
+    args = init_parser().parse_args()
+    output = args.output or \
+        os.path.basename(os.path.abspath(args.path)) + '.torrent'
+    start = time.monotonic()
+    def progress(hashed, total):
+        elapsed = max(time.monotonic() - start, 1e-6)
+        sys.stderr.write("\r{:5.1f}% {:8.1f} MB/s".format(
+            100 * hashed / total, hashed / elapsed / 2**20))
+        sys.stderr.flush()
+    make_torrent(args.path, [[url] for url in args.announce], output,
+                 args.piece_length * 1024 if args.piece_length else None,
+                 args.private, args.comment, args.workers, progress,
+                 args.web_seed)
+    sys.stderr.write("\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
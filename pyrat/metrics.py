@@ -0,0 +1,337 @@
+import asyncio
+import time
+from bisect import bisect_left
+
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS_PORT = 9464
+
+
+class _Value:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _HistogramValue:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # The last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._children = dict() # label values => value
+
+    def _new(self):
+        raise NotImplementedError()
+
+    def child(self, *labels):
+        """
+        The value of one label set, hot paths keep it to skip the lookup
+        """
+        value = self._children.get(labels)
+        if value is None:
+            if len(labels) != len(self.labels):
+                raise ValueError("{} expects labels {}".format(self.name,
+                                                               self.labels))
+            value = self._children[labels] = self._new()
+        return value
+
+    def remove(self, *labels):
+        self._children.pop(labels, None)
+
+    def items(self):
+        return list(self._children.items())
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new(self):
+        return _Value()
+
+    def inc(self, amount, *labels):
+        self.child(*labels).value += amount
+
+
+class Gauge(_Metric):
+    """
+    A value which is set, or read from a function when collected
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, labels=()):
+        super().__init__(name, help, labels)
+        self._functions = dict() # label values => callable
+
+    def _new(self):
+        return _Value()
+
+    def set(self, value, *labels):
+        self.child(*labels).value = value
+
+    def set_function(self, function, *labels):
+        self.child(*labels)
+        self._functions[labels] = function
+
+    def remove(self, *labels):
+        super().remove(*labels)
+        self._functions.pop(labels, None)
+
+    def items(self):
+        for labels, function in list(self._functions.items()):
+            self._children[labels].value = function()
+        return super().items()
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value, *labels):
+        self.child(*labels).observe(value)
+
+
+def _format_labels(names, values, extra=None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in pairs) + '}'
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """
+    Holds the metrics of the process. Updating one is an attribute
+    increment on a cached child, the cost is paid when collecting.
+    """
+
+    def __init__(self):
+        self._metrics = dict() # name => metric
+
+    def _register(self, metric):
+        known = self._metrics.get(metric.name)
+        if known is not None:
+            if type(known) is not type(metric):
+                raise ValueError("Metric {} is already registered".format(
+                    metric.name))
+            return known
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels=()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels=()) -> Gauge:
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels=(),
+                  buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def get(self, name: str):
+        return self._metrics.get(name)
+
+    def stats(self) -> dict:
+        """
+        Snapshot of every metric: {name: {label values: value}}, histograms
+        give {'count', 'sum', 'buckets': {upper bound: cumulative count}}
+        """
+        snapshot = dict()
+        for name, metric in self._metrics.items():
+            values = dict()
+            for labels, value in metric.items():
+                if metric.kind == 'histogram':
+                    cumulative = 0
+                    buckets = dict()
+                    for bound, count in zip(value.bounds + (float('inf'),),
+                                            value.counts):
+                        cumulative += count
+                        buckets[bound] = cumulative
+                    values[labels] = {'count': value.count,
+                                      'sum': value.sum,
+                                      'buckets': buckets}
+                else:
+                    values[labels] = value.value
+            snapshot[name] = values
+        return snapshot
+
+    def prometheus(self) -> str:
+        """
+        All metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for name, values in self.stats().items():
+            metric = self._metrics[name]
+            lines.append('# HELP {} {}'.format(name, metric.help))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            for labels, value in values.items():
+                if metric.kind != 'histogram':
+                    lines.append('{}{} {}'.format(
+                        name, _format_labels(metric.labels, labels),
+                        _format_value(value)))
+                    continue
+                for bound, count in value['buckets'].items():
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _format_labels(metric.labels, labels,
+                                             ('le', _format_value(bound))),
+                        count))
+                lines.append('{}_sum{} {}'.format(
+                    name, _format_labels(metric.labels, labels),
+                    _format_value(value['sum'])))
+                lines.append('{}_count{} {}'.format(
+                    name, _format_labels(metric.labels, labels),
+                    value['count']))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """
+    Serves `registry.prometheus()` at /metrics, meant to listen on
+    localhost only
+    """
+
+    def __init__(self, registry: MetricsRegistry, port: int = METRICS_PORT,
+                 host: str = '127.0.0.1'):
+        self._registry = registry
+        self._port = port
+        self._host = host
+        self._server = None
+
+    @property
+    def port(self) -> int:
+        if self._server:
+            return self._server.sockets[0].getsockname()[1]
+        return self._port
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._on_client,
+                                                  self._host, self._port)
+
+    def close(self):
+        if self._server:
+            self._server.close()
+            self._server = None
+
+    async def _on_client(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            while (await asyncio.wait_for(reader.readline(), 10)).strip():
+                pass # Headers are not used
+            parts = request.split()
+            if len(parts) >= 2 and parts[1].split(b'?')[0] == b'/metrics':
+                status = b'200 OK'
+                body = self._registry.prometheus().encode('utf-8')
+            else:
+                status = b'404 Not Found'
+                body = b'Not found\n'
+            writer.write(b'HTTP/1.1 ' + status + b'\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() +
+                         b'\r\nConnection: close\r\n\r\n' + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop wakes a sleeping task, a busy loop
+    delays every peer
+    """
+
+    def __init__(self, histogram: Histogram, interval: float = 0.5):
+        self._histogram = histogram
+        self._interval = interval
+        self._future = None
+
+    def start(self):
+        if self._future is None:
+            self._future = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._future and not self._future.done():
+            self._future.cancel()
+        self._future = None
+
+    async def _run(self):
+        value = self._histogram.child()
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self._interval)
+            value.observe(max(0, time.monotonic() - start - self._interval))
+
+
+REGISTRY = MetricsRegistry()
+
+BYTES = REGISTRY.counter(
+    'pyrat_bytes_total', 'Piece payload transferred',
+    ('torrent', 'direction'))
+PIECES = REGISTRY.counter(
+    'pyrat_pieces_total', 'Pieces verified', ('torrent', 'result'))
+REQUEST_RTT = REGISTRY.histogram(
+    'pyrat_request_rtt_seconds', 'Time from a block request to the block',
+    ('torrent',))
+HASH_TIME = REGISTRY.histogram(
+    'pyrat_hash_seconds', 'Time to verify a complete piece', ('torrent',))
+DISK_WRITE_TIME = REGISTRY.histogram(
+    'pyrat_disk_write_seconds', 'Time from queuing a piece to its write',
+    ('torrent',))
+PICKER_TIME = REGISTRY.histogram(
+    'pyrat_picker_seconds', 'Time spent choosing the next block',
+    ('torrent',), buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005,
+                           0.01, 0.05))
+TRACKER_TIME = REGISTRY.histogram(
+    'pyrat_tracker_seconds', 'Tracker announce latency', ('tracker',))
+LOOP_LAG = REGISTRY.histogram(
+    'pyrat_loop_lag_seconds', 'Event loop wake up delay')
+PEERS = REGISTRY.gauge(
+    'pyrat_peers', 'Connected peers', ('torrent',))
+PENDING_REQUESTS = REGISTRY.gauge(
+    'pyrat_pending_requests', 'Blocks requested and not received',
+    ('torrent',))
+UPLOAD_QUEUE = REGISTRY.gauge(
+    'pyrat_upload_queue', 'Blocks requested by peers and not sent',
+    ('torrent',))
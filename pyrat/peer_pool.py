@@ -0,0 +1,144 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import OrderedDict, deque
+
+
+
+PRIORITY_DEFAULT = 0 # Trackers and other sources of unknown peers
+PRIORITY_KNOWN = 10 # Peers which served us well in a previous session
+PRIORITY_LOCAL = 20 # Peers on the local network (BEP 14)
+
+
+class PeerPool:
+    """
+    Candidate peer addresses waiting to be dialed.
+
+    Every source of addresses (trackers, the peer store...) adds them here,
+    they are deduplicated and handed to the connection workers best
+    priority first. A peer is not queued again while a worker is connected
+    to it, nor for `RETRY_INTERVAL` seconds after it was last dialed.
+    """
+
+    RETRY_INTERVAL = 300
+
+    def __init__(self, max_size: int = 5000):
+        self._max_size = max_size
+        self._heap = [] # (-priority, sequence, peer)
+        self._seq = itertools.count()
+        self._queued = dict() # peer => priority
+        self._active = set() # Peers handed to a worker and not released
+        # peer => when it was last handed out, oldest first
+        self._dialed = OrderedDict()
+        self._banned = set() # IPs never dialed again
+        self._getters = deque()
+
+    def __len__(self):
+        return len(self._queued)
+
+    def qsize(self) -> int:
+        return len(self._queued)
+
+    def empty(self) -> bool:
+        return not self._queued
+
+    @property
+    def active(self):
+        return set(self._active)
+
+    def add(self, peers, priority: int = PRIORITY_DEFAULT) -> int:
+        """
+        Queue addresses, returns how many of them are new candidates
+        """
+        now = time.monotonic()
+        self._forget_dialed(now)
+        added = 0
+        for peer in peers:
+            peer = (peer[0], peer[1])
+            if peer in self._active or peer[0] in self._banned:
+                continue
+            queued = self._queued.get(peer)
+            if queued is None:
+                if len(self._queued) >= self._max_size:
+                    continue
+                last = self._dialed.get(peer)
+                if last is not None and last + self.RETRY_INTERVAL > now:
+                    continue
+            elif queued >= priority:
+                continue
+            self._queued[peer] = priority
+            heapq.heappush(self._heap, (-priority, next(self._seq), peer))
+            added += 1
+        self._wakeup(added)
+        return added
+
+    def put_nowait(self, peer):
+        self.add([peer])
+
+    def _wakeup(self, count: int):
+        while count and self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                count -= 1
+
+    def get_nowait(self):
+        while self._heap:
+            priority, _, peer = heapq.heappop(self._heap)
+            if self._queued.get(peer) != -priority:
+                continue # Superseded by a higher priority entry
+            del self._queued[peer]
+            self._active.add(peer)
+            now = time.monotonic()
+            self._dialed[peer] = now
+            self._dialed.move_to_end(peer)
+            self._forget_dialed(now)
+            return peer
+        raise asyncio.QueueEmpty()
+
+    def _forget_dialed(self, now: float):
+        # Peers dialed before the retry interval may be queued again
+        while self._dialed:
+            peer, last = next(iter(self._dialed.items()))
+            if last + self.RETRY_INTERVAL > now:
+                break
+            del self._dialed[peer]
+
+    async def get(self):
+        while self.empty():
+            getter = asyncio.get_event_loop().create_future()
+            self._getters.append(getter)
+            try:
+                await getter
+            except asyncio.CancelledError:
+                if getter in self._getters:
+                    self._getters.remove(getter)
+                elif not self.empty():
+                    self._wakeup(1) # Pass the wakeup to another worker
+                raise
+        return self.get_nowait()
+
+    def release(self, peer):
+        """
+        Called by the worker once it is done with the peer
+        """
+        self._active.discard((peer[0], peer[1]))
+
+    def discard(self, peer):
+        self._queued.pop((peer[0], peer[1]), None)
+
+    def ban(self, ip: str):
+        """
+        Forget the queued addresses of the host and refuse new ones
+        """
+        self._banned.add(ip)
+        for peer in [peer for peer in self._queued if peer[0] == ip]:
+            del self._queued[peer]
+
+    def is_banned(self, ip: str) -> bool:
+        return ip in self._banned
+
+    def clear(self):
+        self._heap.clear()
+        self._queued.clear()
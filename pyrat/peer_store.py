@@ -0,0 +1,143 @@
+import logging
+import os
+import time
+
+from .bencode_parser import Decoder, Encoder
+
+
+
+STATE_DIR = os.path.join(os.path.expanduser('~'), '.pyrat')
+
+
+class PeerRecord:
+    def __init__(self, last_seen: int = 0, rate: int = 0, failures: int = 0,
+                 hash_fails: int = 0):
+        self.last_seen = last_seen # Last successful connection, unix time
+        self.rate = rate # Download rate measured from the peer, bytes/s
+        self.failures = failures # Failed connections in a row
+        self.hash_fails = hash_fails # Pieces failing the hash check
+
+    @property
+    def score(self) -> float:
+        return (1 + self.rate) / (1 + self.failures) / \
+            (1 + 4 * self.hash_fails)
+
+    def to_dict(self):
+        return {b'seen': self.last_seen, b'rate': self.rate,
+                b'fail': self.failures, b'hash': self.hash_fails}
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        return cls(d.get(b'seen', 0), d.get(b'rate', 0), d.get(b'fail', 0),
+                   d.get(b'hash', 0))
+
+
+class PeerStore:
+    """
+    Peers of one torrent kept across restarts with what we learned about
+    them, so the dialer can start with the best ones before any tracker
+    answers. Stored bencoded in `<directory>/peers/<info hash>`.
+    """
+
+    MAX_PEERS = 500
+    MAX_AGE = 7 * 24 * 3600 # Peers not seen for so long are forgotten
+
+    def __init__(self, info_hash: bytes, directory: str = STATE_DIR):
+        self._path = os.path.join(directory, 'peers', info_hash.hex())
+        self._peers = dict() # (ip, port) => PeerRecord
+        self._banned = set() # IPs which sent corrupt data
+
+    def __len__(self):
+        return len(self._peers)
+
+    def __contains__(self, peer):
+        return (peer[0], peer[1]) in self._peers
+
+    @property
+    def banned(self) -> set:
+        return set(self._banned)
+
+    def get(self, peer) -> PeerRecord:
+        return self._peers.get((peer[0], peer[1]))
+
+    def load(self):
+        try:
+            with open(self._path, 'rb') as f:
+                data = Decoder(f.read()).parse()
+        except FileNotFoundError:
+            return
+        except (OSError, RuntimeError, IndexError, EOFError, ValueError):
+            logging.warning('Unable to read the peer store {}'.format(
+                self._path))
+            return
+        for peer in data.get(b'peers', []):
+            key = (peer[b'ip'].decode('utf-8'), peer[b'port'])
+            self._peers[key] = PeerRecord.from_dict(peer)
+        self._banned.update(ip.decode('utf-8')
+                            for ip in data.get(b'banned', []))
+
+    def save(self):
+        self._prune()
+        peers = []
+        for (ip, port), record in self._peers.items():
+            peer = record.to_dict()
+            peer[b'ip'] = ip.encode('utf-8')
+            peer[b'port'] = port
+            peers.append(peer)
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            tmp_path = self._path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(Encoder.encode({
+                    b'banned': [ip.encode('utf-8')
+                                for ip in sorted(self._banned)],
+                    b'peers': peers}))
+            os.replace(tmp_path, self._path)
+        except OSError:
+            logging.warning('Unable to write the peer store {}'.format(
+                self._path))
+
+    def _prune(self):
+        oldest = time.time() - self.MAX_AGE
+        peers = [(peer, record) for peer, record in self._peers.items()
+                 if record.last_seen >= oldest and
+                 peer[0] not in self._banned]
+        peers.sort(key=lambda item: item[1].score, reverse=True)
+        self._peers = dict(peers[:self.MAX_PEERS])
+
+    def _record(self, peer) -> PeerRecord:
+        return self._peers.setdefault((peer[0], peer[1]), PeerRecord())
+
+    def connected(self, peer):
+        record = self._record(peer)
+        record.last_seen = int(time.time())
+        record.failures = 0
+
+    def failed(self, peer):
+        # Unknown peers are not worth remembering for failing
+        if peer in self:
+            self._record(peer).failures += 1
+
+    def disconnected(self, peer, rate: float):
+        if peer in self and rate > 0:
+            record = self._record(peer)
+            # Keep some memory of earlier sessions with the peer
+            record.rate = int(rate if not record.rate
+                              else (record.rate + rate) / 2)
+
+    def hash_failed(self, peer):
+        record = self._record(peer)
+        record.hash_fails += 1
+        record.last_seen = record.last_seen or int(time.time())
+
+    def ban(self, ip: str):
+        self._banned.add(ip)
+
+    def ranked(self, limit: int = None) -> list:
+        """
+        Known peers, best first, without the banned ones
+        """
+        peers = sorted((peer for peer in self._peers
+                        if peer[0] not in self._banned),
+                       key=lambda p: self._peers[p].score, reverse=True)
+        return peers[:limit] if limit else peers
@@ -0,0 +1,105 @@
+from socket import inet_aton, inet_pton, AF_INET6
+from struct import pack
+
+from .bencode_parser import Decoder, Encoder
+from .tracker_client import parse_compact_peers
+
+
+
+EXTENSION_HANDSHAKE = 0 # Extended message id of the BEP 10 handshake
+UT_PEX = 1 # Id peers use to send us ut_pex messages
+PEX_INTERVAL = 60 # BEP 11 allows one message per minute
+MAX_PEX_PEERS = 50 # Added or dropped addresses in one message
+CLIENT_NAME = b'pyrat'
+
+
+def encode_compact_peers(peers) -> tuple:
+    """
+    Pack addresses in the compact format, returns (ipv4, ipv6) strings
+    """
+    ipv4, ipv6 = bytearray(), bytearray()
+    for ip, port in peers:
+        try:
+            if ':' in ip:
+                ipv6 += inet_pton(AF_INET6, ip) + pack('>H', port)
+            else:
+                ipv4 += inet_aton(ip) + pack('>H', port)
+        except OSError:
+            continue # Hostnames can't be exchanged
+    return bytes(ipv4), bytes(ipv6)
+
+
+def extension_handshake(port: int = None, reqq: int = None,
+                        pex: bool = True) -> bytes:
+    """
+    Payload of our BEP 10 handshake, keys are kept sorted for bencode.
+    PEX is left out for private torrents (BEP 27).
+    """
+    msg = {b'm': {b'ut_pex': UT_PEX} if pex else {}}
+    if port:
+        msg[b'p'] = port
+    if reqq:
+        msg[b'reqq'] = reqq
+    msg[b'v'] = CLIENT_NAME
+    return bytes(Encoder.encode(msg))
+
+
+def decode_payload(payload: bytes) -> dict:
+    """
+    Bencoded dictionary of an extended message or None if malformed
+    """
+    try:
+        msg = Decoder(payload).parse()
+    except (RuntimeError, IndexError, EOFError, ValueError):
+        return None
+    return msg if isinstance(msg, dict) else None
+
+
+def decode_pex(payload: bytes) -> tuple:
+    """
+    Addresses added by a ut_pex message, at most twice MAX_PEX_PEERS
+    """
+    msg = decode_payload(payload)
+    if msg is None:
+        return tuple()
+    added = msg.get(b'added', b'')
+    added6 = msg.get(b'added6', b'')
+    peers = tuple()
+    if isinstance(added, bytes):
+        peers += parse_compact_peers(added[:6 * 2 * MAX_PEX_PEERS])
+    if isinstance(added6, bytes):
+        peers += parse_compact_peers(added6[:18 * 2 * MAX_PEX_PEERS],
+                                     ipv6=True)
+    return peers
+
+
+class PexState:
+    """
+    Addresses already announced to one peer, ut_pex messages only carry
+    the difference with the previous one
+    """
+
+    def __init__(self):
+        self._sent = set()
+
+    def message(self, peers) -> bytes:
+        """
+        ut_pex payload bringing the peer up to date with `peers`, None if
+        there is nothing new to tell
+        """
+        peers = set((ip, port) for ip, port in peers)
+        added = list(peers - self._sent)[:MAX_PEX_PEERS]
+        dropped = list(self._sent - peers)[:MAX_PEX_PEERS]
+        if not added and not dropped:
+            return None
+        self._sent.update(added)
+        self._sent.difference_update(dropped)
+        added4, added6 = encode_compact_peers(added)
+        dropped4, dropped6 = encode_compact_peers(dropped)
+        return bytes(Encoder.encode({
+            b'added': added4,
+            b'added.f': bytes(len(added4) // 6),
+            b'added6': added6,
+            b'added6.f': bytes(len(added6) // 18),
+            b'dropped': dropped4,
+            b'dropped6': dropped6}))
@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+"""
+Replays a swarm of virtual peers against a PiecesManager, without network
+or disk, and reports the latency of each call:
+
+    python -m pyrat.picker_sim --pieces 1000,10000,100000,1000000
+"""
+
+import asyncio
+import json
+import random
+import time
+from argparse import ArgumentParser
+from bitstring import BitArray
+
+from .piece_manage import PiecesManager
+from .storage import NullStorage
+from .torrent_file import SyntheticTorrent
+
+
+
+# Relative frequency of the simulated events
+WEIGHTS = (('request', 45), ('block', 40), ('have', 10), ('churn', 5))
+
+
+def percentiles(samples: list) -> dict:
+    """
+    Summary of latencies in seconds, reported in microseconds
+    """
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+    def at(fraction):
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))] \
+            * 1e6
+    return {'count': len(samples), 'p50': at(0.5), 'p90': at(0.9),
+            'p99': at(0.99), 'max': samples[-1] * 1e6}
+
+
+class PickerSimulator:
+    """
+    Keeps `connected` virtual peers with random bitfields, a share of them
+    seeds. Peers ask for blocks up to `pipeline` at a time, receive them in
+    random order, announce new pieces and are replaced by new peers, so
+    thousands of peers come and go over a run.
+    """
+
+    def __init__(self, pieces: int, piece_length: int = 2**16,
+                 connected: int = 50, seeds: float = 0.2, pipeline: int = 8,
+                 seed: int = None):
+        self._tinfo = SyntheticTorrent(pieces, piece_length)
+        self._connected = connected
+        self._seeds = seeds
+        self._pipeline = pipeline
+        self._random = random.Random(seed)
+        self._manager = None
+        self._peers = dict() # peer id => BitArray, None for a seed
+        self._outstanding = [] # (peer id, block)
+        self._next_id = 0
+        self.samples = dict() # call => latencies in seconds
+        self.peers_seen = 0
+
+    def _timed(self, name, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.samples.setdefault(name, []).append(time.perf_counter() - start)
+        return result
+
+    def _connect(self):
+        peer_id = self._next_id
+        self._next_id += 1
+        self.peers_seen += 1
+        if self._random.random() < self._seeds:
+            self._peers[peer_id] = None
+            self._timed('add_seed', self._manager.add_seed, peer_id)
+            return
+        pieces = self._tinfo.total_pieces
+        bits = BitArray(bytes=self._random.getrandbits(
+            (pieces + 7) // 8 * 8).to_bytes((pieces + 7) // 8, 'big'))
+        self._peers[peer_id] = bits
+        self._timed('add_peer', self._manager.add_peer, peer_id, bits)
+
+    def _disconnect(self):
+        peer_id = self._random.choice(list(self._peers))
+        del self._peers[peer_id]
+        self._outstanding = [(peer, block) for peer, block
+                             in self._outstanding if peer != peer_id]
+        self._timed('remove_peer', self._manager.remove_peer, peer_id)
+
+    def _request(self):
+        peer_id = self._random.choice(list(self._peers))
+        block = self._timed('next_request', self._manager.next_request,
+                            peer_id)
+        if block:
+            self._outstanding.append((peer_id, block))
+
+    def _block(self):
+        idx = self._random.randrange(len(self._outstanding))
+        self._outstanding[idx], self._outstanding[-1] = \
+            self._outstanding[-1], self._outstanding[idx]
+        peer_id, block = self._outstanding.pop()
+        self._timed('block_received', self._manager.block_received, peer_id,
+                    block.piece_idx, block.offset, bytes(block.length))
+
+    def _have(self):
+        peer_id = self._random.choice(list(self._peers))
+        bits = self._peers[peer_id]
+        if bits is None:
+            return
+        idx = self._random.randrange(len(bits))
+        if idx < self._tinfo.total_pieces and not bits[idx]:
+            bits[idx] = True
+            self._timed('update_peer', self._manager.update_peer, peer_id,
+                        idx)
+
+    async def run(self, operations: int = 10000,
+                  max_seconds: float = None) -> dict:
+        """
+        Replay `operations` events, or until the download completes or
+        `max_seconds` pass
+        """
+        start = time.perf_counter()
+        self._manager = self._timed('init', PiecesManager, self._tinfo,
+                                    storage=NullStorage())
+        try:
+            for _ in range(self._connected):
+                self._connect()
+            names = [name for name, _ in WEIGHTS]
+            weights = [weight for _, weight in WEIGHTS]
+            done = 0
+            while done < operations and not self._manager.complete:
+                if max_seconds and time.perf_counter() - start > max_seconds:
+                    break
+                event = self._random.choices(names, weights)[0]
+                if event == 'request' and len(self._outstanding) >= \
+                        self._pipeline * len(self._peers):
+                    event = 'block'
+                if event == 'block' and not self._outstanding:
+                    event = 'request'
+                if event == 'request':
+                    self._request()
+                elif event == 'block':
+                    self._block()
+                elif event == 'have':
+                    self._have()
+                else:
+                    self._disconnect()
+                    self._connect()
+                done += 1
+                if done % 100 == 0:
+                    await asyncio.sleep(0) # Let written pieces be released
+        finally:
+            self._manager.close()
+        return {
+            'pieces': self._tinfo.total_pieces,
+            'operations': done,
+            'completed_pieces': self._manager.completed_pieces,
+            'peers_seen': self.peers_seen,
+            'seconds': time.perf_counter() - start,
+            'calls': {name: percentiles(samples)
+                      for name, samples in self.samples.items()},
+        }
+
+
+def init_parser():
+    parser = ArgumentParser(description="PyRat piece picker simulator.")
+    parser.add_argument("--pieces", default="1000,10000,100000",
+                        help="Comma separated torrent sizes in pieces.")
+    parser.add_argument("--piece-length", type=int, default=64,
+                        help="Piece length in KB.")
+    parser.add_argument("--operations", type=int, default=10000)
+    parser.add_argument("--connected", type=int, default=50,
+                        help="Peers connected at a time.")
+    parser.add_argument("--seeds", type=float, default=0.2,
+                        help="Share of the peers which are seeds.")
+    parser.add_argument("--pipeline", type=int, default=8,
+                        help="Blocks asked at a time per peer.")
+    parser.add_argument("--max-seconds", type=float, default=None,
+                        help="Time limit of the run of each size.")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser
+
+
+def main():
+    args = init_parser().parse_args()
+    reports = []
+    for pieces in args.pieces.split(','):
+        simulator = PickerSimulator(
+            int(pieces), args.piece_length * 1024, args.connected,
+            args.seeds, args.pipeline, args.seed)
+        reports.append(asyncio.run(simulator.run(args.operations,
+                                                 args.max_seconds)))
+    print(json.dumps(reports, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import asyncio
+import threading
+from collections import OrderedDict
+
+
+
+class PieceCache:
+    """
+    LRU cache of whole pieces read from disk.
+
+    Blocks of one piece are usually requested one after another, and
+    popular pieces by many peers, so reading the whole piece once and
+    serving blocks from memory makes disk reads depend on the number of
+    unique pieces rather than on the number of requests. When pieces are
+    read in order the following `read_ahead` pieces are fetched with the
+    same read.
+    """
+    def __init__(self, read, piece_length: int, total_size: int,
+                 max_bytes: int = 64 * 2**20, read_ahead: int = 4,
+                 executor=None):
+        self._read = read # Blocking callable: (pos, length) -> bytes
+        self._piece_length = piece_length
+        self._total_size = total_size
+        self._max_bytes = max_bytes
+        self._read_ahead = read_ahead
+        self._executor = executor
+        self._pieces = OrderedDict() # piece index => bytes
+        self._size = 0
+        self._lock = threading.Lock()
+        self._loading = dict() # piece index => future of a pending read
+        self._pinned = set() # Pieces not on disk yet, never evicted
+        self._last_miss = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'hit_rate': self.hit_rate,
+                'pieces': len(self._pieces), 'bytes': self._size}
+
+    def _piece_size(self, piece_idx: int) -> int:
+        return min(self._piece_length,
+                   self._total_size - piece_idx * self._piece_length)
+
+    def get(self, piece_idx: int):
+        """
+        Return a cached piece or None, never touches the disk
+        """
+        with self._lock:
+            data = self._pieces.get(piece_idx)
+            if data is not None:
+                self._pieces.move_to_end(piece_idx)
+            return data
+
+    def put(self, piece_idx: int, data: bytes, pin: bool = False):
+        """
+        Store a piece. A pinned piece stays cached until `unpin`, which is
+        how pieces queued for writing are served before they hit the disk.
+        """
+        if len(data) > self._max_bytes and not pin:
+            return
+        with self._lock:
+            old = self._pieces.pop(piece_idx, None)
+            if old is not None:
+                self._size -= len(old)
+            self._pieces[piece_idx] = data
+            self._size += len(data)
+            if pin:
+                self._pinned.add(piece_idx)
+            self._evict()
+
+    def unpin(self, piece_idx: int):
+        with self._lock:
+            self._pinned.discard(piece_idx)
+            self._evict()
+
+    def _evict(self):
+        # Called with the lock held
+        if self._size <= self._max_bytes:
+            return
+        for idx in list(self._pieces):
+            if idx in self._pinned:
+                continue
+            self._size -= len(self._pieces.pop(idx))
+            self.evictions += 1
+            if self._size <= self._max_bytes:
+                break
+
+    def invalidate(self, piece_idx: int):
+        with self._lock:
+            old = self._pieces.pop(piece_idx, None)
+            if old is not None:
+                self._size -= len(old)
+            self._pinned.discard(piece_idx)
+
+    def clear(self):
+        with self._lock:
+            self._pieces.clear()
+            self._pinned.clear()
+            self._size = 0
+
+    def load(self, piece_idx: int, count: int = 1) -> bytes:
+        """
+        Blocking read of `count` consecutive pieces with a single disk
+        read. Returns the first one.
+        """
+        last_idx = min(piece_idx + count,
+                       -(-self._total_size // self._piece_length))
+        pos = piece_idx * self._piece_length
+        length = sum(self._piece_size(i) for i in range(piece_idx, last_idx))
+        data = memoryview(self._read(pos, length))
+        first = None
+        for idx in range(piece_idx, last_idx):
+            size = self._piece_size(idx)
+            if len(data) < size:
+                break # Short read, the rest is not on disk yet
+            piece = self._put_absent(idx, bytes(data[:size]))
+            data = data[size:]
+            if first is None:
+                first = piece
+        return first
+
+    def _put_absent(self, piece_idx: int, data: bytes) -> bytes:
+        # A piece stored while we were reading the disk is newer than ours
+        with self._lock:
+            cached = self._pieces.get(piece_idx)
+            if cached is not None:
+                return cached
+            self._pieces[piece_idx] = data
+            self._size += len(data)
+            self._evict()
+            return data
+
+    async def piece(self, piece_idx: int):
+        """
+        Return the piece data, reading it off the event loop on a miss.
+        Concurrent misses of the same piece share one read.
+        """
+        data = self.get(piece_idx)
+        if data is not None:
+            self.hits += 1
+            return data
+        self.misses += 1
+        future = self._loading.get(piece_idx)
+        if future is None:
+            count = 1
+            if self._last_miss is not None and \
+                    piece_idx == self._last_miss + 1:
+                count += self._read_ahead
+            self._last_miss = piece_idx + count - 1
+            loop = asyncio.get_event_loop()
+            future = loop.run_in_executor(self._executor, self.load,
+                                          piece_idx, count)
+            self._loading[piece_idx] = future
+            try:
+                return await future
+            finally:
+                del self._loading[piece_idx]
+        return await asyncio.shield(future)
@@ -1,15 +1,30 @@
 
 from hashlib import sha1
 from collections import defaultdict
+from functools import partial
+import asyncio
 import time
 import logging
 import math
-import os
 
 from .protocol import REQUEST_SIZE
+from .piece_cache import PieceCache
+from .disk_io import DiskIO
+from .storage import FileStorage
+from . import metrics
+from .events import BUS
 
 
 
+STREAM_WINDOW = 16 # Pieces ahead of the read cursor while streaming
+# File priorities, a piece gets the highest one of its files
+FILE_SKIP = 0
+FILE_LOW = 1
+FILE_NORMAL = 4
+FILE_HIGH = 7
+MAX_STRIKES = 2 # Pieces failing the hash check a peer is blamed for
+
+
 class Block:
     Missing = 0
     Pending = 1
@@ -21,6 +36,43 @@ class Block:
         self.length = length
         self.status = Block.Missing
         self.data = None
+        self.peer_id = None # Who sent the data
+
+
+class _AllPieces:
+    """
+    Pieces of a seed, every index without storing them
+    """
+    def __init__(self, count: int):
+        self._count = count
+
+    def __contains__(self, piece_idx):
+        return 0 <= piece_idx < self._count
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return iter(range(self._count))
+
+
+class _Without:
+    """
+    Pieces of a peer except the `excluded` ones
+    """
+    def __init__(self, pieces, excluded: set):
+        self._pieces = pieces
+        self._excluded = excluded
+
+    def __contains__(self, piece_idx):
+        return piece_idx not in self._excluded and piece_idx in self._pieces
+
+
+class PendingRequest:
+    def __init__(self, block: Block, added: int, peer_id=None):
+        self.block = block
+        self.added = added
+        self.peer_id = peer_id
 
 
 class Piece:
@@ -33,9 +85,30 @@ class Piece:
     def index(self):
         return self._idx
 
+    @property
+    def blocks(self):
+        return self._blocks
+
+    @property
+    def hash(self):
+        return self._hash
+
+    @property
+    def length(self):
+        return sum(b.length for b in self._blocks)
+
     def reset(self):
         for block in self._blocks:
             block.status = Block.Missing
+            block.data = None
+            block.peer_id = None
+
+    def release(self):
+        """
+        Drop the block data once the piece is stored on disk
+        """
+        for block in self._blocks:
+            block.data = None
 
     def next_req(self):
         missing = [b for b in self.blocks if b.status is Block.Missing]
@@ -44,19 +117,20 @@ class Piece:
             return missing[0]
         return None
 
-    def block_received(self, offset: int, data: bytes):
+    def block_received(self, offset: int, data: bytes, peer_id=None):
         matches = [b for b in self.blocks if b.offset == offset]
         block = matches[0] if matches else None
         if block:
             block.status = Block.Retrieved
             block.data = data
+            block.peer_id = peer_id
         else:
             logging.warning('Trying to complete a non-existing block {offset}'
                             .format(offset=offset))
 
     @property
     def is_complete(self):
-        not_complete = [b for b in self._blocks if b.status == Block.Retrieved]
+        not_complete = [b for b in self._blocks if b.status != Block.Retrieved]
         return not not_complete
 
     @property
@@ -71,50 +145,98 @@ class Piece:
         return b''.join(blocks_data)
     
 
+def _digest(data: bytes) -> bytes:
+    return sha1(data).digest()
+
+
 class PiecesManager:
-    def __init__(self, torrent_info):
+    def __init__(self, torrent_info, cache_size: int = 64 * 2**20,
+                 disk_io: DiskIO = None, max_buffer: int = 256 * 2**20,
+                 hash_pool=None, on_complete=None, download_dir: str = '.',
+                 storage=None, file_priorities: list = None, claims=None,
+                 on_corrupt=None):
         self._tinfo = torrent_info
-        self._peers_maps = dict() # peer_id => pieces_map: bitfield
+        # Piece ownership shared with other processes downloading the
+        # torrent (a sharded.ShardTable), a piece is only opened once
+        # claimed and published complete once written, as the other
+        # processes read it from disk
+        self._claims = claims
+        self._unwritten = dict() # piece index => disk_io.WriteJob
+        self._hash_pool = hash_pool # Executor hashing pieces off the loop
+        self._on_complete = on_complete # Called with verified piece index
+        # Called with a peer blamed for a piece failing the hash check and
+        # whether it is banned for it
+        self._on_corrupt = on_corrupt
+        self._strikes = defaultdict(int) # peer_id => pieces blamed for
+        self._banned = set() # peer_ids
+        # Failed pieces several peers contributed to are downloaded again
+        # from one peer: the digests of the blocks each peer sent, then the
+        # peer downloading it (None until one is picked)
+        self._suspects = dict() # piece index => [(block, peer_id, digest)]
+        self._sources = dict() # piece index => peer_id
+        self._verifying = set()
+        self._closed = False
+        self._peers_maps = dict() # peer_id => set of pieces indexes
         self._pieces_prevalence = defaultdict(int)
         self._pending_blocks_reqs = []
         self._pending_pieces = []
         self._missing_pieces = []
         self._complete_pieces = []
         self._max_pending_time = 300 * 1000 # 5 minutes
+        self._bytes_uploaded = 0
+        self._max_buffer = max_buffer # Budget for pieces kept in memory
+        self._reserved = 0 # Full length of the pieces being downloaded
+        self._blocked = 0 # Length of the last piece refused for the budget
+        self._room = None
 
         self._missing_pieces = self._init_pieces()
-        self._fds = self._init_fds() # file descriptors
+        self._pieces = list(self._missing_pieces) # By index
+        self._priorities = bytearray([FILE_NORMAL]) * len(self._pieces)
+        self._file_priorities = [FILE_NORMAL] * len(list(torrent_info.files))
+        self._wanted_missing = len(self._pieces) # Wanted and not complete
+        # Streaming: the pieces after the read cursor are asked first, in
+        # order of their deadline, and the rest rarest first
+        self._cursor = 0
+        self._window = 0
+        self._piece_time = 0
+        self._deadlines = dict() # piece index => time.monotonic() deadline
+        self._fast_peers = None # Peers trusted with the window, None is all
+        self._piece_waiters = defaultdict(list) # piece index => futures
+        self._have = bytearray(math.ceil(len(self._missing_pieces) / 8))
+        # Where pieces are kept, the torrent files unless given
+        self._storage = storage if storage is not None \
+            else FileStorage(torrent_info, download_dir)
+        self._cache = PieceCache(self._storage.read,
+                                 self._tinfo.piece_length,
+                                 self._tinfo.total_size, cache_size)
+        self._own_disk = disk_io is None
+        self._disk = disk_io if disk_io else DiskIO()
+        label = torrent_info.hex_hash
+        self._hash_time = metrics.HASH_TIME.child(label)
+        self._write_time = metrics.DISK_WRITE_TIME.child(label)
+        self._picker_time = metrics.PICKER_TIME.child(label)
+        self._verified = metrics.PIECES.child(label, 'ok')
+        self._corrupt = metrics.PIECES.child(label, 'failed')
+        if file_priorities is not None:
+            self._set_priorities(file_priorities)
+            self._skip_files() # Nothing is written yet
         
-    def _init_fds(self): # Initialize file descriprors (open files)
-        if not self._tinfo.multi_file:
-            fd = os.open(self._tinfo.filename,  os.O_RDWR | os.O_CREAT)
-            return [fd]
-        fds = list() #  File Descriptors
-        for tfile in self._tinfo.files:
-            fds.append(os.open(tfile.name,  os.O_RDWR | os.O_CREAT))
-        return fds
-
-
     def close(self):
-        for fd in self._fds:
-            os.close(fd)
-
-    def _write(self, piece):   
-        data = piece.data
-        piece_pos = piece.index * self.torrent.piece_length
-        if not self._tinfo.multi_file:
-            os.lseek(self._fds[0], piece_pos, os.SEEK_SET)
-            os.write(self._fds[0], data)
-            return None
-        for file_idx, tfile in enumerate(self._tinfo.files):
-            if tfile.length > piece_pos:
-                bytes_to_write = min(tfile.length - piece_pos, len(data))
-                os.lseek(self._fds[file_idx], piece_pos, os.SEEK_SET)
-                os.write(self._fds[file_idx], data[:bytes_to_write])
-                data = data[bytes_to_write:]
-                piece_pos += bytes_to_write
-            piece_pos -= tfile.length
-            if len(data) == 0: break
+        self._closed = True
+        for waiters in self._piece_waiters.values():
+            for future in waiters:
+                future.cancel()
+        self._piece_waiters.clear()
+        # Queued pieces must reach the files before they are closed
+        if self._own_disk:
+            self._disk.close()
+        else:
+            self._disk.flush(self._storage.write)
+        # Written pieces are published now, their callbacks may not run
+        for piece_idx in list(self._unwritten):
+            self._publish(piece_idx)
+        self._storage.close()
+        self._cache.clear()
 
     def _init_pieces(self):
         pieces = []
@@ -124,8 +246,8 @@ class PiecesManager:
                 blocks = [Block(idx, offset * REQUEST_SIZE, REQUEST_SIZE)
                           for offset in range(number_of_std_block)]
             else:
-                last_piece_length = self._tinfo.total_size % \
-                                        self._tinfo.piece_length
+                last_piece_length = self._tinfo.total_size - \
+                                        idx * self._tinfo.piece_length
                 num_blocks = math.ceil(last_piece_length / REQUEST_SIZE)
                 blocks = [Block(idx, offset * REQUEST_SIZE, REQUEST_SIZE)
                           for offset in range(num_blocks)]
@@ -136,7 +258,85 @@ class PiecesManager:
 
     @property
     def complete(self):
-        return len(self._complete_pieces) == self._tinfo.piece_length
+        """
+        Every wanted piece is downloaded
+        """
+        return self._wanted_missing == 0
+
+    @property
+    def have_all(self) -> bool:
+        return len(self._complete_pieces) == self._tinfo.total_pieces
+
+    @property
+    def file_priorities(self) -> list:
+        return list(self._file_priorities)
+
+    async def set_file_priorities(self, priorities: list):
+        """
+        One of FILE_SKIP, FILE_LOW, FILE_NORMAL and FILE_HIGH per file.
+        A piece shared by several files gets the highest priority among
+        them, so a piece spanning a wanted and a skipped file is still
+        downloaded whole.
+        """
+        self._set_priorities(priorities)
+        # Moves data between files, the pending writes must be done
+        await self._disk.wait_flushed(self._storage.write)
+        self._skip_files()
+
+    def _set_priorities(self, priorities: list):
+        files = list(self._tinfo.files)
+        if len(priorities) != len(files):
+            raise ValueError("Expected {} file priorities, got {}".format(
+                len(files), len(priorities)))
+        piece_length = self._tinfo.piece_length
+        piece_priorities = bytearray(len(self._pieces))
+        file_start = 0
+        for tfile, priority in zip(files, priorities):
+            if tfile.length and priority:
+                first = file_start // piece_length
+                last = (file_start + tfile.length - 1) // piece_length
+                for piece_idx in range(first, last + 1):
+                    if piece_priorities[piece_idx] < priority:
+                        piece_priorities[piece_idx] = priority
+            file_start += tfile.length
+        self._file_priorities = list(priorities)
+        self._priorities = piece_priorities
+        self._wanted_missing = sum(
+            1 for piece_idx, priority in enumerate(piece_priorities)
+            if priority and not self.have(piece_idx))
+        for piece in list(self._pending_pieces):
+            if not piece_priorities[piece.index] and \
+                    piece.index not in self._verifying:
+                self._drop(piece)
+        self.seek(self._cursor)
+
+    def _skip_files(self):
+        # The latest priorities, an earlier call may finish after a later one
+        self._storage.set_skipped(
+            file_idx for file_idx, priority in
+            enumerate(self._file_priorities) if not priority)
+
+    def _drop(self, piece):
+        # The piece goes back with the missing ones and its budget is freed,
+        # the blocks in flight are ignored
+        self._pending_pieces.remove(piece)
+        self._reserved -= piece.length
+        piece.reset()
+        self._missing_pieces.append(piece)
+        if self._claims is not None:
+            self._claims.release(piece.index)
+        self._pending_blocks_reqs = [
+            req for req in self._pending_blocks_reqs
+            if req.block.piece_idx != piece.index]
+        self._release_room()
+
+    @property
+    def total_pieces(self):
+        return self._tinfo.total_pieces
+
+    @property
+    def completed_pieces(self) -> int:
+        return len(self._complete_pieces)
     
     @property
     def bytes_downloaded(self):
@@ -144,83 +344,516 @@ class PiecesManager:
 
     @property
     def bytes_uploaded(self):
-        return 0
-        # TODO add support for sending
+        return self._bytes_uploaded
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def pending_requests(self) -> int:
+        return len(self._pending_blocks_reqs)
+
+    @property
+    def buffered_bytes(self) -> int:
+        """
+        Memory held by pieces being downloaded and pieces queued for writing
+        """
+        return self._reserved + self._disk.queued_bytes
+
+    def _over_budget(self, extra: int = 0) -> bool:
+        return self.buffered_bytes + extra > self._max_buffer
+
+    def _out_of_room(self) -> bool:
+        # A piece refused by _next_missing must fit before asking again,
+        # unless no other piece is being downloaded
+        return self._over_budget(self._blocked if self._pending_pieces else 0)
+
+    @property
+    def backpressure(self) -> bool:
+        """
+        True while the write-back queue is full or the memory budget is
+        spent, new requests should wait for `wait_for_room`
+        """
+        return self._disk.backpressure or self._out_of_room()
+
+    async def wait_for_room(self):
+        await self._disk.wait_for_room()
+        while self._out_of_room():
+            if self._room is None:
+                self._room = asyncio.Event()
+            self._room.clear()
+            await self._room.wait()
+
+    def _release_room(self):
+        if self._room and not self._out_of_room():
+            self._room.set()
+
+    def _written(self, piece_idx: int, queued: float):
+        elapsed = time.monotonic() - queued
+        self._write_time.observe(elapsed)
+        BUS.trace('write', elapsed, piece=piece_idx)
+        self._cache.unpin(piece_idx)
+        self._publish(piece_idx)
+        self._release_room()
+
+    def _publish(self, piece_idx: int):
+        # A piece which could not be written stays claimed, another process
+        # downloads it once the claim times out
+        job = self._unwritten.pop(piece_idx, None)
+        if job and not job.failed and self._claims is not None:
+            self._claims.complete(piece_idx)
+
+    @property
+    def bitfield(self) -> bytes:
+        return bytes(self._have)
+
+    def have(self, piece_idx: int) -> bool:
+        return bool(self._have[piece_idx >> 3] & (0x80 >> (piece_idx & 7)))
+
+    def _mark_complete(self, piece):
+        if piece in self._missing_pieces:
+            self._missing_pieces.remove(piece)
+        if piece in self._pending_pieces:
+            self._pending_pieces.remove(piece)
+            self._reserved -= piece.length
+        piece.release()
+        self._complete_pieces.append(piece)
+        if self._priorities[piece.index]:
+            self._wanted_missing -= 1
+        self._have[piece.index >> 3] |= 0x80 >> (piece.index & 7)
+        self._suspects.pop(piece.index, None)
+        self._sources.pop(piece.index, None)
+        self._deadlines.pop(piece.index, None)
+        for future in self._piece_waiters.pop(piece.index, ()):
+            if not future.done():
+                future.set_result(None)
+
+    def mark_have(self, piece_idx: int):
+        """
+        The piece was verified and stored by another process sharing the
+        storage, the blocks asked for it are given up
+        """
+        if self.have(piece_idx):
+            return
+        self._pending_blocks_reqs = [
+            req for req in self._pending_blocks_reqs
+            if req.block.piece_idx != piece_idx]
+        self._cache.invalidate(piece_idx)
+        self._mark_complete(self._pieces[piece_idx])
+        self._release_room()
+        if self._on_complete:
+            self._on_complete(piece_idx)
+
+    def _on_disk(self, piece) -> bool:
+        return self._storage.has(piece.index * self._tinfo.piece_length,
+                                 piece.length)
+
+    async def recheck(self):
+        """
+        Find pieces which are already stored on disk, e.g. to seed them.
+        Reads go through the cache, so verified pieces are ready to serve.
+        """
+        loop = asyncio.get_event_loop()
+        for piece in list(self._missing_pieces):
+            if not self._on_disk(piece):
+                continue
+            data = await self._cache.piece(piece.index)
+            digest = await loop.run_in_executor(
+                self._hash_pool, _digest, data) if data else None
+            if digest == piece.hash:
+                self._mark_complete(piece)
+                if self._claims is not None:
+                    self._claims.complete(piece.index)
+            else:
+                self._cache.invalidate(piece.index)
+
+    async def read_block(self, piece_idx: int, offset: int, length: int):
+        """
+        Read a block of a complete piece without blocking the event loop.
+        Returns None if the block can not be served.
+        """
+        if not 0 <= piece_idx < self._tinfo.total_pieces or \
+                not self.have(piece_idx):
+            return None
+        piece_length = min(self._tinfo.piece_length, self._tinfo.total_size -
+                           piece_idx * self._tinfo.piece_length)
+        if offset < 0 or length <= 0 or offset + length > piece_length:
+            return None
+        data = await self._cache.piece(piece_idx)
+        if data is None:
+            return None
+        return data[offset:offset + length]
+
+    def block_sent(self, length: int):
+        self._bytes_uploaded += length
 
     def add_peer(self, peer_id, pieces_map: list):
-        self._peers_maps[peer_id] = pieces_map
-        for piece_idx in pieces_map:
+        if peer_id in self._banned:
+            return
+        pieces = {idx for idx, has in enumerate(pieces_map)
+                  if has and idx < self._tinfo.total_pieces}
+        self.remove_peer(peer_id)
+        self._peers_maps[peer_id] = pieces
+        for piece_idx in pieces:
             self._pieces_prevalence[piece_idx] += 1
 
+    def add_seed(self, peer_id):
+        # Seeds don't change which pieces are rarest
+        if peer_id in self._banned:
+            return
+        self.remove_peer(peer_id)
+        self._peers_maps[peer_id] = _AllPieces(self._tinfo.total_pieces)
+
     def update_peer(self, peer_id, piece_idx):
-        if peer_id in self._peers_maps:
-            self._peers_maps[peer_id] = True
-            self._pieces_prevalence[peer_id] += 1
+        if peer_id in self._banned or \
+                not 0 <= piece_idx < self._tinfo.total_pieces:
+            return
+        pieces = self._peers_maps.setdefault(peer_id, set())
+        if piece_idx not in pieces:
+            pieces.add(piece_idx)
+            self._pieces_prevalence[piece_idx] += 1
     
     def remove_peer(self, peer_id):
-        if peer_id in self._peers_maps:
-            for piece_idx in self._pieces_prevalence:
-                if piece_idx in self._peers_maps[peer_id]:
-                    self._pieces_prevalence[piece_idx] -= 1
-            del self._peers_maps[peer_id]
+        pieces = self._peers_maps.pop(peer_id, None)
+        if pieces is not None and not isinstance(pieces, _AllPieces):
+            for piece_idx in pieces:
+                self._pieces_prevalence[piece_idx] -= 1
+        self.release_requests(peer_id)
+        for piece_idx, source in self._sources.items():
+            if source == peer_id:
+                self._sources[piece_idx] = None
+
+    def release_requests(self, peer_id):
+        # Blocks the peer will never send are handed to other peers at once,
+        # so its started pieces get finished instead of holding the budget.
+        # Pieces nothing was received of are given back.
+        pending = []
+        released = set()
+        for req in self._pending_blocks_reqs:
+            if req.peer_id == peer_id:
+                if req.block.status == Block.Pending:
+                    req.block.status = Block.Missing
+                    released.add(req.block.piece_idx)
+            else:
+                pending.append(req)
+        self._pending_blocks_reqs = pending
+        for piece in list(self._pending_pieces):
+            if piece.index in released and all(
+                    block.status == Block.Missing for block in piece.blocks):
+                self._drop(piece)
+
+    def request_rejected(self, peer_id, piece_idx, block_offset) -> bool:
+        """
+        The peer won't send a block it was asked for, returns False if the
+        block was not requested from it
+        """
+        for req in self._pending_blocks_reqs:
+            if req.peer_id == peer_id and req.block.piece_idx == piece_idx \
+                    and req.block.offset == block_offset:
+                self._pending_blocks_reqs.remove(req)
+                if req.block.status == Block.Pending:
+                    req.block.status = Block.Missing
+                return True
+        return False
 
     def block_received(self, peer_id, piece_idx, block_offset, data):
-        for idx, req in enumerate(self._pending_blocks_reqs):
-            if req.block.piece_idx == piece_idx and \
-               req.block.offset == block_offset:
-                del self._pending_blocks_reqs[idx]
+        """
+        Returns the piece index once the piece is complete and stored.
+        With a hash pool the piece is verified asynchronously and only
+        reported to `on_complete`.
+        """
+        if peer_id in self._banned or self._sources.get(
+                piece_idx, peer_id) != peer_id:
+            return None # Not trusted with the piece
+        self._pending_blocks_reqs = [
+            req for req in self._pending_blocks_reqs
+            if req.block.piece_idx != piece_idx or
+            req.block.offset != block_offset]
         ps = [p for p in self._pending_pieces if p.index == piece_idx]
-        piece = piece[0] if ps else None
+        piece = ps[0] if ps else None
         if piece:
-            piece.block_received(block_offset, data)
-            if piece.is_complete:
-                if piece.is_hash_matching:
-                    self._write(piece)
-                    self._pending_pieces.remove(piece)
-                    self._complete_pieces.append(piece)
-                else:
-                    piece.reset()
-
-    def next_request(self, peer_id):
-        if peer_id not in self._peers_maps:
+            piece.block_received(block_offset, data, peer_id)
+            if piece.is_complete and piece.index not in self._verifying:
+                data = piece.data
+                started = time.monotonic()
+                if self._hash_pool is None:
+                    return self._piece_hashed(piece, data,
+                                              sha1(data).digest(), started)
+                self._verifying.add(piece.index)
+                future = asyncio.get_event_loop().run_in_executor(
+                    self._hash_pool, _digest, data)
+                future.add_done_callback(
+                    lambda f: self._piece_hashed(piece, data, f.result(),
+                                                 started))
+        return None
+
+    def _piece_hashed(self, piece, data: bytes, digest: bytes,
+                      started: float):
+        # Time in the hashing pool queue is included
+        elapsed = time.monotonic() - started
+        self._hash_time.observe(elapsed)
+        BUS.trace('hash', elapsed, piece=piece.index)
+        self._verifying.discard(piece.index)
+        if self._closed or piece not in self._pending_pieces:
+            return None # Closed or completed meanwhile
+        if digest != piece.hash:
+            self._corrupt.value += 1
+            self._hash_failed(piece, data)
+            if piece.index in self._sources:
+                piece.reset() # Downloaded again at once, from one peer
+            else:
+                self._drop(piece)
+            return None
+        self._verified.value += 1
+        # The blocks which differ from the good data tell who lied
+        liars = set()
+        for block, peer_id, block_digest in self._suspects.get(piece.index,
+                                                               ()):
+            if block_digest != _digest(
+                    data[block.offset:block.offset + block.length]):
+                liars.add(peer_id)
+        for peer_id in liars:
+            self._blame(peer_id, MAX_STRIKES)
+        # The piece is served from the cache until it is written
+        self._cache.put(piece.index, data, pin=True)
+        self._unwritten[piece.index] = self._disk.submit(
+            self._storage.write, piece.index * self._tinfo.piece_length,
+            data, partial(self._written, piece.index, time.monotonic()))
+        self._mark_complete(piece)
+        if self._on_complete:
+            self._on_complete(piece.index)
+        return piece.index
+
+    def _hash_failed(self, piece, data: bytes):
+        peers = {block.peer_id for block in piece.blocks}
+        if len(peers) == 1:
+            self._blame(peers.pop())
+        elif piece.index not in self._suspects:
+            self._suspects[piece.index] = [
+                (block, block.peer_id, _digest(
+                    data[block.offset:block.offset + block.length]))
+                for block in piece.blocks]
+        if piece.index in self._suspects:
+            self._sources[piece.index] = None
+        # Blocks still on their way must not mix in
+        self._pending_blocks_reqs = [
+            req for req in self._pending_blocks_reqs
+            if req.block.piece_idx != piece.index]
+
+    def _blame(self, peer_id, strikes: int = 1):
+        if peer_id is None or peer_id in self._banned:
+            return
+        self._strikes[peer_id] += strikes
+        banned = self._strikes[peer_id] >= MAX_STRIKES
+        if banned:
+            self._banned.add(peer_id)
+            self.remove_peer(peer_id)
+        BUS.warning('peer.corrupt', torrent=self._tinfo.hex_hash,
+                    peer=peer_id, strikes=self._strikes[peer_id],
+                    banned=banned)
+        if self._on_corrupt:
+            self._on_corrupt(peer_id, banned)
+
+    def banned(self, peer_id) -> bool:
+        return peer_id in self._banned
+
+    def next_request(self, peer_id, allowed=None):
+        """
+        Next block to ask the peer for, only from the `allowed` pieces if
+        given (the allowed fast set of a peer choking us)
+        """
+        if peer_id not in self._peers_maps or self._disk.backpressure:
             return None
+        started = time.perf_counter()
+        block = self._pick(peer_id, allowed)
+        self._picker_time.observe(time.perf_counter() - started)
+        return block
 
-        block = self._expired_requests(peer_id)
+    def _pick(self, peer_id, allowed):
+        pieces = self._peers_maps[peer_id]
+        if allowed is not None:
+            pieces = {idx for idx in allowed if idx in pieces}
+
+        # Started pieces come first, a new one is opened only while its
+        # whole length fits in the memory budget
+        block = None
+        if self._deadlines or self._piece_waiters:
+            block = self._next_due(peer_id, pieces)
+            if not block and not self._is_fast(peer_id):
+                # The rest of the window is left to the fastest peers
+                now = time.monotonic()
+                pieces = _Without(pieces, {
+                    piece_idx for piece_idx, due in self._deadlines.items()
+                    if due > now})
+        if not block:
+            block = self._expired_requests(peer_id, pieces)
         if not block:
-            block = self._next_ongoing(peer_id)
+            block = self._next_ongoing(peer_id, pieces)
             if not block:
-                block = self._next_missing(peer_id)
+                block = self._next_missing(peer_id, pieces)
         return block
 
-    def _expired_requests(self, peer_id):
+    @property
+    def streaming(self) -> bool:
+        return self._window > 0
+
+    def set_streaming(self, window: int = STREAM_WINDOW,
+                      piece_time: float = 1.0):
+        """
+        Ask the `window` pieces from the read cursor first: the piece under
+        the cursor is due at once and each next one `piece_time` seconds
+        later. A window of 0 turns streaming off.
+        """
+        self._window = max(0, window)
+        self._piece_time = piece_time
+        self.seek(self._cursor)
+
+    def seek(self, offset: int):
+        """
+        Move the read cursor, the deadlines restart from now
+        """
+        self._cursor = offset
+        self._deadlines = dict()
+        first = offset // self._tinfo.piece_length
+        last = min(first + self._window, self._tinfo.total_pieces)
+        now = time.monotonic()
+        for position, piece_idx in enumerate(range(first, last)):
+            if self._priorities[piece_idx] and not self.have(piece_idx):
+                self._deadlines[piece_idx] = now + position * self._piece_time
+
+    def _is_fast(self, peer_id) -> bool:
+        return self._fast_peers is None or peer_id in self._fast_peers
+
+    def set_fast_peers(self, peer_ids):
+        """
+        Only these peers are asked for window pieces before they are due,
+        None lets every peer
+        """
+        self._fast_peers = set(peer_ids) if peer_ids is not None else None
+
+    async def read(self, offset: int, length: int) -> bytes:
+        """
+        Wait until the byte range is downloaded and return it. While
+        streaming the window moves to `offset`, missing pieces of the range
+        are due at once anyway.
+        """
+        if offset < 0 or length <= 0 or offset + length > \
+                self._tinfo.total_size:
+            raise ValueError("Range {}+{} is out of the torrent".format(
+                offset, length))
+        if self._window:
+            self.seek(offset)
+        first = offset // self._tinfo.piece_length
+        last = (offset + length - 1) // self._tinfo.piece_length
+        loop = asyncio.get_event_loop()
+        futures = []
+        for piece_idx in range(first, last + 1):
+            if not self.have(piece_idx):
+                future = loop.create_future()
+                self._piece_waiters[piece_idx].append(future)
+                futures.append((piece_idx, future))
+        try:
+            for _, future in futures:
+                await future
+        finally:
+            for piece_idx, future in futures:
+                waiters = self._piece_waiters.get(piece_idx)
+                if waiters and future in waiters:
+                    waiters.remove(future)
+                    if not waiters:
+                        del self._piece_waiters[piece_idx]
+        chunks = []
+        for piece_idx in range(first, last + 1):
+            data = await self._cache.piece(piece_idx)
+            if data is None:
+                raise IOError("Piece {} can not be read".format(piece_idx))
+            chunks.append(data)
+        start = offset - first * self._tinfo.piece_length
+        return b''.join(chunks)[start:start + length]
+
+    def _next_due(self, peer_id, pieces):
+        # Pieces a reader waits for first, then the window by deadline.
+        # Slower peers only get pieces which are already due.
+        now = time.monotonic()
+        due = dict(self._deadlines)
+        for piece_idx in self._piece_waiters:
+            due[piece_idx] = min(due.get(piece_idx, now), now)
+        fast = self._is_fast(peer_id)
+        for piece_idx in sorted(due, key=due.get):
+            if not fast and due[piece_idx] > now:
+                break
+            if piece_idx not in pieces or self.have(piece_idx) or \
+                    not self._claim(piece_idx):
+                continue
+            piece = self._pieces[piece_idx]
+            if piece not in self._pending_pieces:
+                self._open(piece)
+            block = self._take(peer_id, piece)
+            if block:
+                return block
+        return None
+
+    def _expired_requests(self, peer_id, pieces):
         # Rerequest a long-expected block
-        curr_time = int(round(time.time()))
+        curr_time = int(round(time.time() * 1000))
         for req in self._pending_blocks_reqs:
-            if self._peers_maps[peer_id][req.block.piece_idx]:
+            if req.block.piece_idx in pieces and \
+                    req.block.piece_idx not in self._sources:
                 if req.added + self._max_pending_time < curr_time:
                     req.added = curr_time
+                    req.peer_id = peer_id
                     return req.block
         return None
            
-    def _next_ongoing(self, peer_id):
+    def _next_ongoing(self, peer_id, pieces):
         # Request next block for some ongoing piece
         for piece in self._pending_pieces:
-            if self._peers_maps[peer_id][piece.index]:
-                b = piece.next_req()
+            if piece.index in pieces and self._claim(piece.index):
+                b = self._take(peer_id, piece)
                 if b:
-                    curr_time = int(round(time.time() * 1000))
-                    self._pending_blocks_reqs.append(
-                        PendingRequest(b, curr_time))
                     return b
         return None
+
+    def _take(self, peer_id, piece):
+        if piece.index in self._sources:
+            # A piece being isolated comes from one peer with a clean record
+            source = self._sources[piece.index]
+            if source is None and not self._strikes[peer_id]:
+                self._sources[piece.index] = source = peer_id
+            if source != peer_id:
+                return None
+        b = piece.next_req()
+        if b:
+            curr_time = int(round(time.time() * 1000))
+            self._pending_blocks_reqs.append(
+                PendingRequest(b, curr_time, peer_id))
+        return b
+
+    def _claim(self, piece_idx: int) -> bool:
+        # Also keeps the claim of a piece being downloaded alive
+        return self._claims is None or self._claims.claim(piece_idx)
+
+    def _open(self, piece):
+        self._missing_pieces.remove(piece)
+        self._pending_pieces.append(piece)
+        self._reserved += piece.length
+        self._blocked = 0
            
-    def _next_missing(self, peer_id):
-        rarest_pieces = sorted(self._missing_pieces,
-                               key=lambda p: self._pieces_prevalence[p.index])
+    def _next_missing(self, peer_id, pieces):
+        # Higher priorities first, skipped pieces never
+        priorities = self._priorities
+        rarest_pieces = sorted(
+            (p for p in self._missing_pieces if priorities[p.index]),
+            key=lambda p: (-priorities[p.index],
+                           self._pieces_prevalence[p.index]))
         for piece in rarest_pieces:
-            if self._peers_maps[peer_id][piece.index]:
-                self._missing_pieces.remove(piece)
-                self._pending_pieces.append(piece)
-                return piece.next_req()
+            if piece.index in pieces:
+                if self._pending_pieces and self._over_budget(piece.length):
+                    self._blocked = piece.length
+                    return None
+                if not self._claim(piece.index):
+                    continue
+                self._open(piece)
+                return self._next_ongoing(peer_id, pieces)
         return None
-           
@@ -1,10 +1,20 @@
 
 import asyncio 
+import time
+from hashlib import sha1
+from socket import inet_aton
 from struct import pack, unpack
 from concurrent.futures import CancelledError
-from collections import namedtuple
+from collections import namedtuple, deque
 from bitstring import BitArray
 
+from .choker import RateMeter
+from .rate_limiter import TokenBucket, Throttle
+from . import metrics
+from .events import BUS
+from .pex import PexState, UT_PEX, EXTENSION_HANDSHAKE, \
+    extension_handshake, decode_payload, decode_pex
+
 
 
 class ProtocolError(Exception):
@@ -17,18 +27,67 @@ class PeerState:
         self.interested = interested
 
 
-REQUEST_SIZE = 2**14 # 2 KiB
+CONNECT_TIMEOUT = 10
+UTP_CONNECT_TIMEOUT = 3 # TCP is tried next
+REQUEST_SIZE = 2**14 # 16 KiB
+MAX_REQUEST_SIZE = 2**17 # Larger requests are dropped
+MAX_PEER_REQUESTS = 256 # Queued requests we accept from one peer
+ALLOWED_FAST_COUNT = 10 # Pieces a choked peer may request (BEP 6)
 Peer = namedtuple("Peer", ['ip', 'port', 'id'])
 
+
+def allowed_fast_set(ip: str, info_hash: bytes, num_pieces: int,
+                     count: int = ALLOWED_FAST_COUNT) -> list:
+    """
+    Canonical allowed fast set of an IPv4 peer (BEP 6), so reconnecting
+    from the same network doesn't get more free pieces
+    """
+    try:
+        x = bytes(inet_aton(ip)[:3]) + b'\x00' + info_hash
+    except OSError:
+        return []
+    count = min(count, num_pieces)
+    pieces = []
+    while len(pieces) < count:
+        x = sha1(x).digest()
+        for i in range(0, 20, 4):
+            if len(pieces) >= count:
+                break
+            index = unpack('>I', x[i:i + 4])[0] % num_pieces
+            if index not in pieces:
+                pieces.append(index)
+    return pieces
+
     
 class PeerConnection:
-    def __init__(self, queue: asyncio.Queue, info_hash,
-                 my_peer_id, piece_manager, worker_id: int, on_block_cb=None):
+    def __init__(self, queue, info_hash,
+                 my_peer_id, piece_manager, worker_id: int, on_block_cb=None,
+                 incoming=None, budget=None, peer_store=None, on_peers=None,
+                 listen_port: int = None, utp=None, download_limits=(),
+                 upload_limits=()):
         self._queue = queue
         self._info_hash = info_hash
         self._my_id = my_peer_id
         self._piece_manager = piece_manager
         self._on_block_cb = on_block_cb
+        # (reader, writer[, received handshake bytes]) of an accepted socket
+        self._incoming = incoming
+        self._budget = budget # Connection slots shared by a session
+        self._peer_store = peer_store # Learns how dialed peers behaved
+        # Receives addresses learned through PEX, None disables PEX
+        self._on_peers = on_peers
+        self._listen_port = listen_port # Advertised in the extension handshake
+        self._utp = utp # uTP socket, preferred to TCP for dialing
+        # Own limits of the peer, then those of the torrent and session
+        self.download_limit = TokenBucket()
+        self.upload_limit = TokenBucket()
+        self._download_throttle = Throttle(self.download_limit,
+                                           *download_limits)
+        self._upload_throttle = Throttle(self.upload_limit, *upload_limits)
+        label = info_hash.hex()
+        self._downloaded = metrics.BYTES.child(label, 'download')
+        self._uploaded = metrics.BYTES.child(label, 'upload')
+        self._rtt = metrics.REQUEST_RTT.child(label)
         self.worker_id = worker_id
 
         self._defaults()
@@ -37,103 +96,414 @@ class PeerConnection:
 
     def _defaults(self):
         self._my_state = PeerState(choked=True, interested=True)
-        self._peer_state = PeerState(choked=False, interested=False)
+        self._peer_state = PeerState(choked=True, interested=False)
         self._peer = None
         self._writer = None
         self._reader = None
         self._pending = False
-        
+        self._requested_at = None # When the pending block was asked
+        self.last_rtt = None
+        self._requests = deque()  # Blocks requested by the remote peer
+        self._uploading = None
+        self._resuming = None
+        self.connected_at = None
+        self.listen_addr = None # Address other peers can dial it at
+        self._extended = False # The peer supports BEP 10
+        self._extensions = dict() # Extension name => the peer's message id
+        self._fast = False # Both sides support the Fast Extension
+        self._allowed_fast = set() # Pieces we may request while choked
+        self._allowed_fast_out = set() # Pieces the peer may while choked
+        self._pex = PexState()
+        self.download_rate = RateMeter()
+        self.upload_rate = RateMeter()
+
+    @property
+    def future(self):
+        return self._future
+
+    @property
+    def connected(self):
+        return self._peer is not None and self._writer is not None
+
+    @property
+    def peer(self):
+        return self._peer
+
+    @property
+    def peer_interested(self):
+        return self._peer_state.interested
+
+    @property
+    def peer_choked(self):
+        return self._peer_state.choked
+
+    @property
+    def queued_requests(self) -> int:
+        return len(self._requests)
+
+    def stats(self) -> dict:
+        """
+        Snapshot of the connection, for `TorrentClient.stats`
+        """
+        return {
+            'peer': self._peer.ip if self._peer else None,
+            'port': self._peer.port if self._peer else None,
+            'downloaded': self.download_rate.total,
+            'uploaded': self.upload_rate.total,
+            'download_rate': self.download_rate.rate,
+            'upload_rate': self.upload_rate.rate,
+            'choked': self._my_state.choked,
+            'peer_choked': self._peer_state.choked,
+            'pending': int(self._pending),
+            'queued_requests': len(self._requests),
+            'rtt': self.last_rtt,
+        }
 
     async def _start(self):
+        if self._incoming:
+            reader, writer = self._incoming[:2]
+            buff = self._incoming[2] if len(self._incoming) > 2 else b''
+            peer_ip, peer_port = writer.get_extra_info('peername')[:2]
+            try:
+                await self._serve(peer_ip, peer_port, reader, writer, buff)
+            finally:
+                if self._budget: # Acquired by the session on accept
+                    self._budget.release()
+            return
         while not self._aborted:
             peer_ip, peer_port = await self._queue.get()
             try:
-                self._reader, self._writer = await asyncio.open_connection(
-                    peer_ip, peer_port)
-                print("Connected to {}".format(peer_ip))
-                buff = await self._handshake(peer_ip, peer_port)
-                print('Handshake sended')
+                if self._budget:
+                    await self._budget.acquire(self._info_hash)
+                try:
+                    await self._serve(peer_ip, peer_port)
+                finally:
+                    if self._budget:
+                        self._budget.release()
+            finally:
+                self._queue.release((peer_ip, peer_port))
+
+    async def _serve(self, peer_ip, peer_port, reader=None, writer=None,
+                     buff=b''):
+        # Only dialed addresses are worth remembering, incoming peers
+        # connect from ephemeral ports
+        dialed = reader is None
+        store = self._peer_store if dialed else None
+        try:
+            if reader is None:
+                reader, writer = await self._open_connection(peer_ip,
+                                                             peer_port)
+            self._reader, self._writer = reader, writer
+            BUS.debug('peer.connected', peer=peer_ip, port=peer_port)
+            buff = await self._handshake(peer_ip, peer_port, buff)
+            BUS.info('peer.handshake', peer=peer_ip, port=peer_port,
+                     fast=self._fast, extended=self._extended)
+            self.connected_at = time.monotonic()
+            if store is not None:
+                store.connected((peer_ip, peer_port))
+            if dialed:
+                self.listen_addr = (peer_ip, peer_port)
+            self._send_bitfield()
+            self._send_allowed_fast(peer_ip)
+            if self._extended:
+                self._writer.write(Extended(
+                    EXTENSION_HANDSHAKE,
+                    extension_handshake(self._listen_port,
+                                        MAX_PEER_REQUESTS,
+                                        self._on_peers is not None)).encode())
+            self._my_state.interested = not self._piece_manager.complete
+            if self._my_state.interested:
                 await self._send_interested()
-                print('Interested sended')
-                async for msg in PeerStreamIterator(self._reader, buff):
-                    if self._aborted:
-                        break
-                    if type(msg) is BitField:
-                        self._piece_manager.add_peer(self._peer.id,
-                                                     msg.bitfield)
-                    elif type(msg) is Interested:
-                        self._peer_state.interested = True
-                    elif type(msg) is NotInterested:
-                        self._peer_state.interested = False
-                    elif type(msg) is Choke:
-                        self._my_state.choked = True
-                    elif type(msg) is Unchoke:
-                        self._my_state.choked = False 
-                    elif type(msg) is Have:
-                        self._piece_manager.update_peer(self._peer.id,
-                                                       msg.index)
-                    elif type(msg) is KeepAlive:
-                        pass
-                    elif type(msg) is Piece:
+            async for msg in PeerStreamIterator(self._reader, buff,
+                                                self._download_throttle):
+                if self._aborted:
+                    break
+                if type(msg) is BitField:
+                    self._piece_manager.add_peer(self._peer.id,
+                                                 msg.bitfield)
+                elif type(msg) is Interested:
+                    self._peer_state.interested = True
+                elif type(msg) is NotInterested:
+                    self._peer_state.interested = False
+                elif type(msg) is Choke:
+                    self._my_state.choked = True
+                    if not self._fast:
+                        # Our requests are dropped, other peers get them
                         self._pending = False
-                        self._on_block_cb(
-                            peer_id=self._peer.id,
-                            piece_idx=msg.index,
-                            block_offset=msg.begin,
-                            data=msg.block)
-                    elif type(msg) is Request:
-                        oass  # TODO Not sharing
-                    elif type(msg) is Cancel:
-                        pass  # TODO Not sharing
-                    if not self._my_state.choked:
-                        if self._my_state.interested:
-                            if not self._pending:
-                                self._pending = True
-                                await self._request_piece()
-            except ProtocolError as e:
-                print("Protocol Errore")
-            except (ConnectionRefusedError, TimeoutError):
-                print("Unnable to connect to {}".format(peer_ip))
-            except (ConnectionResetError, CancelledError):
-                print("Connection closed")
-            except Exception as e:
-                print("An error occured")
-                self.cancel()
-                self._future = None
-                raise e
+                        self._piece_manager.release_requests(self._peer.id)
+                elif type(msg) is Unchoke:
+                    self._my_state.choked = False
+                elif type(msg) is Have:
+                    if not 0 <= msg.index < self._piece_manager.total_pieces:
+                        raise ProtocolError("Have of unknown piece {}".format(
+                            msg.index))
+                    self._piece_manager.update_peer(self._peer.id,
+                                                   msg.index)
+                elif type(msg) is KeepAlive:
+                    pass
+                elif type(msg) is Piece:
+                    self._pending = False
+                    if self._requested_at is not None:
+                        self.last_rtt = time.monotonic() - self._requested_at
+                        self._rtt.observe(self.last_rtt)
+                        self._requested_at = None
+                    self.download_rate.update(len(msg.block))
+                    self._downloaded.value += len(msg.block)
+                    self._on_block_cb(
+                        peer_id=self._peer.id,
+                        piece_idx=msg.index,
+                        block_offset=msg.begin,
+                        data=msg.block)
+                elif type(msg) is Request:
+                    self._on_request(msg)
+                elif type(msg) is Cancel:
+                    self._on_cancel(msg)
+                elif type(msg) is Extended:
+                    self._on_extended(msg)
+                elif type(msg) is HaveAll and self._fast:
+                    self._piece_manager.add_seed(self._peer.id)
+                elif type(msg) is HaveNone and self._fast:
+                    self._piece_manager.add_peer(self._peer.id, [])
+                elif type(msg) is RejectRequest and self._fast:
+                    if self._piece_manager.request_rejected(
+                            self._peer.id, msg.index, msg.begin):
+                        self._pending = False
+                elif type(msg) is AllowedFast and self._fast:
+                    if len(self._allowed_fast) < 4 * ALLOWED_FAST_COUNT:
+                        self._allowed_fast.add(msg.index)
+                if self._can_request():
+                    await self._request_piece()
+        except ProtocolError as e:
+            BUS.info('peer.protocol_error', peer=peer_ip, error=e)
+            if store is not None and not self.connected_at:
+                store.failed((peer_ip, peer_port))
+        except (ConnectionResetError, CancelledError):
+            BUS.debug('peer.closed', peer=peer_ip)
+        except (ConnectionRefusedError, TimeoutError, asyncio.TimeoutError,
+                OSError):
+            BUS.debug('peer.unreachable', peer=peer_ip, port=peer_port)
+            if store is not None and not self.connected_at:
+                store.failed((peer_ip, peer_port))
+        except Exception as e:
+            BUS.error('peer.error', peer=peer_ip, error=repr(e))
+            self.cancel()
+            self._future = None
+            raise e
+
+        if store is not None and self.connected_at:
+            duration = time.monotonic() - self.connected_at
+            store.disconnected((peer_ip, peer_port),
+                               self.download_rate.total / max(duration, 1))
+        if self._peer:
+            self._piece_manager.remove_peer(self._peer.id)
+        if self._uploading:
+            self._uploading.cancel()
+        if self._resuming:
+            self._resuming.cancel()
+        if self._writer:
+            self._writer.close()
+        self._defaults()
 
-            if self._writer:    
-                self._writer.close()
-            self._defaults()
+    async def _open_connection(self, peer_ip, peer_port):
+        # uTP backs off when the uplink gets congested, TCP fills its buffers
+        if self._utp:
+            try:
+                return await asyncio.wait_for(
+                    self._utp.connect((peer_ip, peer_port)),
+                    UTP_CONNECT_TIMEOUT)
+            except (asyncio.TimeoutError, OSError):
+                pass
+        return await asyncio.wait_for(
+            asyncio.open_connection(peer_ip, peer_port), CONNECT_TIMEOUT)
 
     def cancel(self):
         if self._writer:
             self._writer.close()
 
     def stop(self):
-        self._aborted= True
-        if not self.future.done():
-            self.future.cancel()
+        self._aborted = True
+        if self._future and not self._future.done():
+            self._future.cancel()
+
+    def choke(self):
+        """
+        Stop serving the remote peer, pending requests are discarded
+        except for allowed fast pieces, a Fast Extension peer is told
+        """
+        if self.connected and not self._peer_state.choked:
+            self._peer_state.choked = True
+            self._writer.write(Choke().encode())
+            requests = self._requests
+            self._requests = deque()
+            for request in requests:
+                if request[0] in self._allowed_fast_out:
+                    self._requests.append(request)
+                else:
+                    self._reject(*request)
+
+    def unchoke(self):
+        if self.connected and self._peer_state.choked:
+            self._peer_state.choked = False
+            self._writer.write(Unchoke().encode())
+
+    def send_have(self, piece_idx: int):
+        if self.connected:
+            self._writer.write(Have(piece_idx).encode())
+            if self._piece_manager.complete and self._my_state.interested:
+                self._my_state.interested = False
+                self._writer.write(NotInterested().encode())
+
+    def update_interest(self):
+        """
+        Tell the peer whether we still want pieces, e.g. after the file
+        priorities changed
+        """
+        interested = not self._piece_manager.complete
+        if not self.connected or interested == self._my_state.interested:
+            return
+        self._my_state.interested = interested
+        self._writer.write(Interested().encode() if interested
+                           else NotInterested().encode())
+        if self._can_request() and not self._resuming:
+            self._resuming = asyncio.ensure_future(self._resume_requests())
+
+    def send_pex(self, peers):
+        """
+        Tell the peer which of `peers` were connected or dropped since the
+        previous call
+        """
+        msg_id = self._extensions.get(b'ut_pex')
+        if not self.connected or not msg_id or self._on_peers is None:
+            return
+        payload = self._pex.message(p for p in peers if p != self.listen_addr)
+        if payload:
+            self._writer.write(Extended(msg_id, payload).encode())
+
+    def _send_bitfield(self):
+        if self._fast and self._piece_manager.have_all:
+            self._writer.write(HaveAll().encode())
+        elif self._piece_manager.bytes_downloaded:
+            msg = BitField(self._piece_manager.bitfield)
+            self._writer.write(msg.encode())
+        elif self._fast:
+            self._writer.write(HaveNone().encode())
+
+    def _send_allowed_fast(self, peer_ip):
+        # Lets a new peer get its first pieces before it is unchoked
+        if not self._fast:
+            return
+        for index in allowed_fast_set(peer_ip, self._info_hash,
+                                      self._piece_manager.total_pieces):
+            if self._piece_manager.have(index):
+                self._allowed_fast_out.add(index)
+                self._writer.write(AllowedFast(index).encode())
+
+    def _can_request(self) -> bool:
+        return self._my_state.interested and not self._pending and \
+            (not self._my_state.choked or bool(self._allowed_fast))
+
+    def _reject(self, index, begin, length):
+        if self._fast and self.connected:
+            self._writer.write(RejectRequest(index, begin, length).encode())
+
+    def _on_request(self, msg):
+        if self._peer_state.choked and \
+                msg.index not in self._allowed_fast_out:
+            return self._reject(msg.index, msg.begin, msg.length)
+        if msg.length > MAX_REQUEST_SIZE or \
+                len(self._requests) >= MAX_PEER_REQUESTS:
+            return self._reject(msg.index, msg.begin, msg.length)
+        self._requests.append((msg.index, msg.begin, msg.length))
+        if not self._uploading:
+            self._uploading = asyncio.ensure_future(self._upload())
+
+    def _on_extended(self, msg):
+        if msg.ext_id == EXTENSION_HANDSHAKE:
+            handshake = decode_payload(msg.payload)
+            if handshake is None:
+                return
+            extensions = handshake.get(b'm', {})
+            if isinstance(extensions, dict):
+                self._extensions = {name: ext_id
+                                    for name, ext_id in extensions.items()
+                                    if isinstance(ext_id, int) and ext_id > 0}
+            port = handshake.get(b'p')
+            if self.listen_addr is None and isinstance(port, int) and \
+                    0 < port < 65536:
+                self.listen_addr = (self._peer.ip, port)
+        elif msg.ext_id == UT_PEX and self._on_peers:
+            peers = decode_pex(msg.payload)
+            if peers:
+                self._on_peers(peers)
+
+    def _on_cancel(self, msg):
+        try:
+            self._requests.remove((msg.index, msg.begin, msg.length))
+        except ValueError:
+            pass
+
+    async def _upload(self):
+        # Disk reads are done off the event loop by the piece manager, so
+        # serving a slow disk only delays this peer.
+        try:
+            while self._requests and self.connected:
+                index, begin, length = self._requests.popleft()
+                block = await self._piece_manager.read_block(index, begin,
+                                                             length)
+                if block is None:
+                    self._reject(index, begin, length)
+                    continue
+                if self._peer_state.choked and \
+                        index not in self._allowed_fast_out:
+                    continue # Rejected by choke()
+                if self._upload_throttle.limited:
+                    await self._upload_throttle.acquire(len(block))
+                self._writer.write(Piece(index, begin, block).encode())
+                await self._writer.drain()
+                self.upload_rate.update(len(block))
+                self._uploaded.value += len(block)
+                self._piece_manager.block_sent(len(block))
+        finally:
+            self._uploading = None
 
     async def _request_piece(self):
-        block = self._piece_manager.next_request(self._peer.id)
+        # Choked by a Fast Extension peer only allowed fast pieces are asked
+        allowed = self._allowed_fast if self._my_state.choked else None
+        block = self._piece_manager.next_request(self._peer.id, allowed)
         if block:
-            msg = Request(block.piece, block.offset, block.length).encode()
+            self._pending = True
+            self._requested_at = time.monotonic()
+            msg = Request(block.piece_idx, block.offset, block.length).encode()
             self._writer.write(msg)
             await self._writer.drain()
-
-    async def _handshake(self, peer_ip, peer_port):
+        elif self._piece_manager.backpressure and not self._resuming:
+            self._resuming = asyncio.ensure_future(self._resume_requests())
+
+    async def _resume_requests(self):
+        # The disk is behind, ask for more once the write queue drained
+        try:
+            await self._piece_manager.wait_for_room()
+            if self.connected and self._can_request():
+                await self._request_piece()
+        finally:
+            self._resuming = None
+
+    async def _handshake(self, peer_ip, peer_port, buf=b''):
         msg = Handshake(self._info_hash, self._my_id).encode()
         self._writer.write(msg)
         await self._writer.drain()
-        buf = ''
         while len(buf) < Handshake.length:
-            buf = await self._reader.read(PeerStreamIterator.CHUNK_SIZE)
+            data = await self._reader.read(PeerStreamIterator.CHUNK_SIZE)
+            if not data:
+                raise ProtocolError("Connection closed during handshake")
+            buf += data
         response = Handshake.decode(buf[:Handshake.length])
         if not response:
             raise ProtocolError("Unable receive and parse a handshake")
         if response.info_hash != self._info_hash:
             raise ProtocolError("Handshake with invalid info_hash")
+        self._extended = response.supports_extensions
+        self._fast = response.supports_fast
         self._peer = Peer(peer_ip, peer_port, response.peer_id)
         return buf[Handshake.length:]
 
@@ -147,46 +517,48 @@ class PeerStreamIterator:
 
     CHUNK_SIZE = 10*1024
 
-    def __init__(self, reader, init_buff: bytes=None):
+    def __init__(self, reader, init_buff: bytes=None, throttle=None):
         self._reader = reader
-        self._buffer = init_buff if init_buff else None
+        self._buffer = init_buff if init_buff else b''
+        self._throttle = throttle # Paces reads to the download limits
 
-    async def __aiter__(self):
+    def __aiter__(self):
         return self
 
     async def __anext__(self):
         while True:
             try:
-                data = await self._reader.read(PeerStreamIterator.CHUNK_SIZE)
-                if data:
-                    self._buffer += data
+                with BUS.span('parse'):
                     msg = self.parse()
-                    if msg: return msg
-                else:
-                    if self._buffer:
-                        msg = self.parse()
-                        if msg: return msg
+                if msg: return msg
+                data = await self._reader.read(PeerStreamIterator.CHUNK_SIZE)
+                if not data:
                     raise StopAsyncIteration()
+                self._buffer += data
+                if self._throttle is not None and self._throttle.limited:
+                    await self._throttle.acquire(len(data))
+            except StopAsyncIteration:
+                raise
             except ConnectionResetError:
-                print("Connection closed by peer")
+                BUS.debug('stream.reset')
                 raise StopAsyncIteration()
             except CancelledError:
                 raise StopAsyncIteration()
-            except Exception:
-                print("Error when iterating over stream!")
+            except Exception as e:
+                BUS.warning('stream.error', error=repr(e))
                 raise StopAsyncIteration()
         raise StopAsyncIteration()
 
     def parse(self):
         header_length = 4
-        if not len(self._buffer) > 4:
+        if not len(self._buffer) >= 4:
             return None
         msg_length = unpack('>I', self._buffer[0:4])[0]
         if msg_length == 0:
+            self._buffer = self._buffer[header_length:]
             return KeepAlive()
-        if len(self._buffer) < msg_length:
-            print("Not enough data got")
-            return None
+        if len(self._buffer) < header_length + msg_length:
+            return None # The rest of the message is not read yet
         msg_id = unpack(">b", self._buffer[4:5])[0]
 
         def _consume():
@@ -227,7 +599,27 @@ class PeerStreamIterator:
             data = _data()
             _consume()
             return Cancel.decode(data)
-        print("Unknown msg type got")
+        elif msg_id is PeerMessage.HaveAll:
+            _consume()
+            return HaveAll()
+        elif msg_id is PeerMessage.HaveNone:
+            _consume()
+            return HaveNone()
+        elif msg_id is PeerMessage.RejectRequest:
+            data = _data()
+            _consume()
+            return RejectRequest.decode(data)
+        elif msg_id is PeerMessage.AllowedFast:
+            data = _data()
+            _consume()
+            return AllowedFast.decode(data)
+        elif msg_id is PeerMessage.Extended:
+            data = _data()
+            _consume()
+            return Extended.decode(data)
+        _consume()
+        BUS.debug('stream.unknown_message', id=msg_id)
+        return KeepAlive()
 
 
 class PeerMessage:
@@ -242,6 +634,12 @@ class PeerMessage:
     Piece = 7
     Cancel = 8
     Port = 9
+    Suggest = 13
+    HaveAll = 14
+    HaveNone = 15
+    RejectRequest = 16
+    AllowedFast = 17
+    Extended = 20
 
     def encode(self) -> bytes:
         raise NotImplementedError()
@@ -255,11 +653,16 @@ class Handshake(PeerMessage):
     
     pstr = "BitTorrent protocol"
     length = 49 + len(pstr) # 68
+    # Reserved bits we set, 0x10 of the sixth byte is the extension
+    # protocol (BEP 10) and 0x04 of the last one the Fast Extension (BEP 6)
+    RESERVED = bytes([0, 0, 0, 0, 0, 0x10, 0, 0x04])
 
-    def __init__(self, info_hash: bytes, peer_id: bytes):
+    def __init__(self, info_hash: bytes, peer_id: bytes,
+                 reserved: bytes = RESERVED):
         self._info_hash = info_hash
         self._peer_id = peer_id if isinstance(peer_id, bytes) \
             else bytes(peer_id, "UTF-8")
+        self._reserved = reserved
 
     @property
     def info_hash(self):
@@ -269,18 +672,30 @@ class Handshake(PeerMessage):
     def peer_id(self):
         return self._peer_id
 
+    @property
+    def reserved(self):
+        return self._reserved
+
+    @property
+    def supports_extensions(self):
+        return bool(self._reserved[5] & 0x10)
+
+    @property
+    def supports_fast(self):
+        return bool(self._reserved[7] & 0x04)
+
     def encode(self):
         return pack(
-            '>B19s8x20s20s',
+            '>B19s8s20s20s',
             19, b"BitTorrent protocol",
-            self._info_hash, self._peer_id)
+            self._reserved, self._info_hash, self._peer_id)
 
     @classmethod
     def decode(cls, data: bytes):
         if len(data) < (49 + 19):
             return None
-        parts = unpack('>B19s8x20s20s', data)
-        return cls(info_hash=parts[2], peer_id=parts[3])
+        parts = unpack('>B19s8s20s20s', data)
+        return cls(info_hash=parts[3], peer_id=parts[4], reserved=parts[2])
        
     def __str__(self):
         return "Handshake from" + self._peer_id.decode("UTF-8")
@@ -288,7 +703,7 @@ class Handshake(PeerMessage):
 
 class KeepAlive(PeerMessage):
     def encode(self):
-        return pack(">B", 0)
+        return pack(">I", 0)
 
     @classmethod
     def decode(cls):
@@ -304,7 +719,7 @@ class BitField(PeerMessage):
 
     def encode(self):
         bits_length = len(self.bitfield.bytes)
-        return pack(">Ib" + bits_length + "s",
+        return pack(">Ib" + str(bits_length) + "s",
                     1 + bits_length,
                     PeerMessage.BitField,
                     self.bitfield.bytes)
@@ -393,6 +808,38 @@ class Have(PeerMessage):
         return "Have index: " + str(self.index)
 
 
+class AllowedFast(Have):
+    def encode(self):
+        return pack(">IbI", 5, PeerMessage.AllowedFast, self.index)
+
+    def __str__(self):
+        return "AllowedFast index: " + str(self.index)
+
+
+class HaveAll(PeerMessage):
+    def encode(self):
+        return pack(">Ib", 1, PeerMessage.HaveAll)
+
+    @classmethod
+    def decode(cls, data):
+        return cls()
+
+    def __str__(self):
+        return "HaveAll"
+
+
+class HaveNone(PeerMessage):
+    def encode(self):
+        return pack(">Ib", 1, PeerMessage.HaveNone)
+
+    @classmethod
+    def decode(cls, data):
+        return cls()
+
+    def __str__(self):
+        return "HaveNone"
+
+
 class Request(PeerMessage):
     def __init__(self, index: int, begin: int, length = REQUEST_SIZE):
         self.index = index
@@ -416,6 +863,15 @@ class Request(PeerMessage):
         return "Request"
 
 
+class RejectRequest(Request):
+    def encode(self):
+        return pack(">IbIII", 13, PeerMessage.RejectRequest, self.index,
+                    self.begin, self.length)
+
+    def __str__(self):
+        return "RejectRequest"
+
+
 class Piece(PeerMessage):
 
     length = 9  # The Piece message length without the block data
@@ -426,14 +882,14 @@ class Piece(PeerMessage):
         self.block = block
     
     def encode(self):
-        blk_length = len(self.block)
-        msg_length = Piece.length + blk_length
-        return pack(">IbII" + str(blk_length) + "s",
+        # The block is appended rather than packed to avoid building a
+        # format string and an extra copy per uploaded block
+        msg_length = Piece.length + len(self.block)
+        return pack(">IbII",
                     msg_length,
                     PeerMessage.Piece,
                     self.index,
-                    self.begin,
-                    self.block)
+                    self.begin) + self.block
 
     @classmethod
     def decode(cls, data: bytes):
@@ -461,10 +917,32 @@ class Cancel(PeerMessage):
                     self.length)
 
     @classmethod
-    def decode(self, data: bytes):
+    def decode(cls, data: bytes):
         parts = unpack(">IbIII", data)
         return cls(parts[2], parts[3], parts[4])
     
     def __str__(self):
         return "Cancel"
 
+
+class Extended(PeerMessage):
+    """
+    Extension protocol message (BEP 10), `ext_id` 0 is the extension
+    handshake, other ids are assigned by the handshake of the receiver
+    """
+    def __init__(self, ext_id: int, payload: bytes):
+        self.ext_id = ext_id
+        self.payload = payload
+
+    def encode(self):
+        return pack(">IbB", 2 + len(self.payload), PeerMessage.Extended,
+                    self.ext_id) + self.payload
+
+    @classmethod
+    def decode(cls, data: bytes):
+        if len(data) < 6:
+            raise ProtocolError("Truncated extended message")
+        return cls(data[5], bytes(data[6:]))
+
+    def __str__(self):
+        return "Extended {}".format(self.ext_id)
@@ -0,0 +1,130 @@
+import asyncio
+import time
+from collections import deque
+
+
+
+MIN_BURST = 2**15 # Two blocks
+
+
+class TokenBucket:
+    """
+    Limits a transfer rate in bytes per second, 0 means unlimited.
+
+    Tokens may go negative: a transfer is let through as soon as the bucket
+    is not in debt and the debt is paid back before the next one, so large
+    blocks don't need to be split. Waiters are served in arrival order and
+    every connection waits for one transfer at a time, so connections
+    sharing a bucket are served round-robin.
+    """
+
+    def __init__(self, rate: int = 0, burst: int = None):
+        self._rate = 0
+        self._burst = 0
+        self._tokens = 0
+        self._stamp = time.monotonic()
+        self._waiters = deque() # (future, amount)
+        self._timer = None
+        self.set_rate(rate, burst)
+
+    @property
+    def rate(self) -> int:
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate: int):
+        self.set_rate(rate)
+
+    @property
+    def limited(self) -> bool:
+        return bool(self._rate)
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def set_rate(self, rate: int, burst: int = None):
+        """
+        Can be called at any time, waiters are rescheduled at the new rate
+        """
+        self._refill()
+        self._rate = max(0, int(rate or 0))
+        self._burst = burst or max(MIN_BURST, self._rate // 4)
+        self._tokens = min(self._tokens, self._burst)
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self._wakeup()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self._rate:
+            self._tokens = min(self._burst, self._tokens +
+                               (now - self._stamp) * self._rate)
+        self._stamp = now
+
+    async def acquire(self, amount: int):
+        if not self._rate:
+            return
+        if not self._waiters:
+            self._refill()
+            if self._tokens > 0:
+                self._tokens -= amount
+                return
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.append((future, amount))
+        self._schedule()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._tokens += amount # Granted meanwhile, give it back
+            raise
+
+    def _schedule(self):
+        if self._timer is None and self._waiters and self._rate:
+            self._refill()
+            delay = max(0, -self._tokens) / self._rate
+            self._timer = asyncio.get_event_loop().call_later(
+                delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._wakeup()
+
+    def _wakeup(self):
+        self._refill()
+        while self._waiters and (self._tokens > 0 or not self._rate):
+            future, amount = self._waiters.popleft()
+            if future.done():
+                continue
+            if self._rate:
+                self._tokens -= amount
+            future.set_result(None)
+        self._schedule()
+
+
+class Throttle:
+    """
+    The buckets a transfer goes through, e.g. those of the peer, of its
+    torrent and the global one
+    """
+
+    def __init__(self, *buckets):
+        self._buckets = [bucket for bucket in buckets if bucket is not None]
+
+    @property
+    def buckets(self):
+        return list(self._buckets)
+
+    @property
+    def limited(self) -> bool:
+        for bucket in self._buckets:
+            if bucket.limited:
+                return True
+        return False
+
+    async def acquire(self, amount: int):
+        for bucket in self._buckets:
+            if bucket.limited:
+                await bucket.acquire(amount)
@@ -0,0 +1,235 @@
+import asyncio
+import os
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+from .disk_io import DiskIO
+from .udp_tracker import UDPTrackerClient
+from .protocol import Handshake, PeerStreamIterator
+from .torrent_client import TorrentClient, LISTEN_PORT, MAX_BUFFER
+from .peer_store import STATE_DIR
+from .dht import DHTNode
+from .lsd import LocalDiscovery
+from .utp import UTPSocket
+from .rate_limiter import TokenBucket
+from .web_seed import WEBSEED_CONNECTIONS
+from . import metrics
+
+
+
+class ConnectionBudget:
+    """
+    Peer connection slots shared by all torrents of a session.
+
+    When every slot is taken, freed slots are handed to the waiting
+    torrents in turn rather than in request order, so a torrent with many
+    candidates can not starve the others.
+    """
+    def __init__(self, limit: int):
+        self._limit = limit
+        self._used = 0
+        self._waiters = OrderedDict() # owner => deque of futures
+
+    @property
+    def used(self) -> int:
+        return self._used
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    def try_acquire(self) -> bool:
+        if self._used < self._limit and not self._waiters:
+            self._used += 1
+            return True
+        return False
+
+    async def acquire(self, owner):
+        if self.try_acquire():
+            return
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.setdefault(owner, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release() # The slot was granted meanwhile
+            else:
+                self._forget(owner, future)
+            raise
+
+    def _forget(self, owner, future):
+        waiters = self._waiters.get(owner)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            if not waiters:
+                del self._waiters[owner]
+
+    def release(self):
+        while self._waiters:
+            owner, waiters = next(iter(self._waiters.items()))
+            future = waiters.popleft()
+            if waiters:
+                self._waiters.move_to_end(owner)
+            else:
+                del self._waiters[owner]
+            if not future.done():
+                future.set_result(None) # The slot changes hands
+                return
+        self._used -= 1
+
+
+class Session:
+    """
+    Hosts many torrents in one event loop. They share the listening port,
+    the trackers HTTP connection pool and UDP socket, the uTP socket and
+    DHT node on the listening port, the local discovery socket, a peer
+    connection budget, the hashing pool and the disk I/O pool.
+    """
+
+    HANDSHAKE_TIMEOUT = 30
+
+    def __init__(self, port: int = LISTEN_PORT, max_connections: int = 500,
+                 disk_threads: int = 4, hash_threads: int = None,
+                 http_connections: int = 100, state_dir: str = STATE_DIR,
+                 dht: bool = True, utp: bool = True, download_rate: int = 0,
+                 upload_rate: int = 0, metrics_port: int = None,
+                 lsd: bool = True):
+        self._port = port
+        self._state_dir = state_dir
+        self._torrents = dict() # info hash => TorrentClient
+        self._futures = dict() # info hash => future of TorrentClient.start
+        self._http_connections = http_connections
+        self.connections = ConnectionBudget(max_connections)
+        # Global limits in bytes per second shared by all torrents
+        self.download_limit = TokenBucket(download_rate)
+        self.upload_limit = TokenBucket(upload_rate)
+        self.disk_io = DiskIO(threads=disk_threads)
+        self.hash_pool = ThreadPoolExecutor(hash_threads or os.cpu_count())
+        self.http_client = None
+        self.web_seed_client = None # A few keep-alive connections per host
+        self.udp_client = UDPTrackerClient(max_retries=2)
+        self.utp = UTPSocket(port, on_accept=self._on_incoming) \
+            if utp else None
+        self.dht = DHTNode(port, state_path=os.path.join(state_dir, 'dht')
+                           if state_dir else None) if dht else None
+        self.lsd = LocalDiscovery(port) if lsd else None
+        self._server = None
+        # Prometheus endpoint on localhost, off unless a port is given
+        self._metrics_server = metrics.MetricsServer(
+            metrics.REGISTRY, metrics_port) if metrics_port is not None \
+            else None
+        self._lag_monitor = metrics.LoopLagMonitor(metrics.LOOP_LAG)
+
+    @property
+    def port(self):
+        return self._port
+
+    @property
+    def torrents(self):
+        return list(self._torrents.values())
+
+    def stats(self) -> dict:
+        """
+        Snapshot of the session: its torrents and the metrics registry
+        """
+        return {
+            'connections': self.connections.used,
+            'torrents': [client.stats() for client in self._torrents.values()],
+            'metrics': metrics.REGISTRY.stats(),
+        }
+
+    async def start(self):
+        self.http_client = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self._http_connections))
+        self.web_seed_client = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit_per_host=WEBSEED_CONNECTIONS))
+        self._server = await asyncio.start_server(self._on_incoming,
+                                                  port=self._port)
+        if self.utp:
+            await self.utp.start()
+        if self.dht:
+            if self.utp:
+                self.utp.fallback = self.dht.datagram_received
+            await self.dht.start(self.utp.transport if self.utp else None)
+        if self.lsd:
+            await self.lsd.start()
+        self._lag_monitor.start()
+        if self._metrics_server:
+            await self._metrics_server.start()
+
+    def add_torrent(self, torrent_file, seed: bool = False,
+                    max_buffer: int = MAX_BUFFER,
+                    download_dir: str = '.') -> TorrentClient:
+        client = TorrentClient(torrent_file, seed=seed,
+                               max_buffer=max_buffer, session=self,
+                               state_dir=self._state_dir,
+                               download_dir=download_dir)
+        if client.info_hash in self._torrents:
+            client.stop()
+            raise ValueError("Torrent {} is already added".format(
+                client.torrent_info.hex_hash))
+        self._torrents[client.info_hash] = client
+        self._futures[client.info_hash] = asyncio.ensure_future(
+            client.start())
+        return client
+
+    async def remove_torrent(self, info_hash: bytes):
+        client = self._torrents.pop(info_hash)
+        future = self._futures.pop(info_hash)
+        client.stop()
+        if not future.done():
+            future.cancel()
+        await asyncio.gather(future, return_exceptions=True)
+
+    async def _on_incoming(self, reader, writer):
+        # The torrent is only known once the handshake is read
+        if not self.connections.try_acquire():
+            writer.close()
+            return
+        accepted = False
+        try:
+            buf = b''
+            while len(buf) < Handshake.length:
+                data = await asyncio.wait_for(
+                    reader.read(PeerStreamIterator.CHUNK_SIZE),
+                    self.HANDSHAKE_TIMEOUT)
+                if not data:
+                    break
+                buf += data
+            handshake = Handshake.decode(buf[:Handshake.length])
+            client = self._torrents.get(handshake.info_hash) \
+                if handshake else None
+            if client:
+                accepted = client.accept(reader, writer, buf)
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            if not accepted:
+                self.connections.release()
+                writer.close()
+
+    async def close(self):
+        for info_hash in list(self._torrents):
+            await self.remove_torrent(info_hash)
+        if self._server:
+            self._server.close()
+        self._lag_monitor.stop()
+        if self._metrics_server:
+            self._metrics_server.close()
+        self.disk_io.close()
+        self.hash_pool.shutdown(wait=True)
+        if self.http_client:
+            await self.http_client.close()
+        if self.web_seed_client:
+            await self.web_seed_client.close()
+        self.udp_client.close()
+        if self.dht:
+            self.dht.close()
+        if self.lsd:
+            self.lsd.close()
+        if self.utp:
+            self.utp.close()
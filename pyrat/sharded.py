@@ -0,0 +1,345 @@
+"""
+Download a torrent from several processes, each with its own event loop and
+peer connections, to use more than one core:
+
+    client = ShardedClient('file.torrent', shards=4)
+    await client.start()
+"""
+
+import asyncio
+import copy
+import multiprocessing
+import os
+import time
+
+from .announcer import Announcer
+from .lsd import LocalDiscovery
+from .peer_pool import PRIORITY_KNOWN, PRIORITY_DEFAULT, PRIORITY_LOCAL
+from .peer_store import PeerStore, STATE_DIR
+from .piece_manage import PiecesManager
+from .torrent_client import TorrentClient, LISTEN_PORT, MAX_BUFFER
+from .torrent_file import TorrentInfo
+from .tracker_client import TrackerClient
+from .events import BUS
+from . import events
+
+
+
+CLAIM_TIMEOUT = 30 # Seconds before a piece claimed by a silent shard is free
+# Seconds the shard processes get to stop: they notice the stop flag within
+# a second, then write back the pieces they hold, at most their max_buffer
+STOP_TIMEOUT = 60
+STOP_POLL = 0.1 # Seconds between checks of the stopping shards
+# Piece states of the table besides the index + 1 of the owning shard
+FREE = 0
+DONE = 255
+MAX_SHARDS = DONE - 1
+
+
+class ShardTable:
+    """
+    Pieces shared by the shard processes, in shared memory: the state of
+    each piece (FREE, DONE or the index + 1 of the shard downloading it) and
+    when its owner last asked a block of it. Completed pieces are also
+    appended to a log, so shards learn what the others stored without
+    scanning every piece. Changing owners takes a lock, a shard using its
+    own pieces does not.
+
+    The table is built by the coordinator and handed to the shard
+    processes when they start, each one using its `view`.
+    """
+
+    def __init__(self, pieces: int, shards: int, context=None):
+        if not 0 < shards <= MAX_SHARDS:
+            raise ValueError("Between 1 and {} shards, not {}".format(
+                MAX_SHARDS, shards))
+        context = context or multiprocessing.get_context('spawn')
+        self._states = context.RawArray('B', pieces)
+        self._claimed = context.RawArray('d', pieces) # time.monotonic()
+        self._log = context.RawArray('i', pieces) # Completed piece indexes
+        # Log length, stop flag, then the bytes uploaded by each shard
+        self._counters = context.RawArray('q', 2 + shards)
+        self._lock = context.Lock()
+        self._peers = [context.SimpleQueue() for _ in range(shards)]
+        self._shards = shards
+        self._next_shard = 0
+        self._shard = None
+        self._read = 0 # Log entries seen by this view
+
+    @property
+    def shards(self) -> int:
+        return self._shards
+
+    @property
+    def shard(self):
+        return self._shard
+
+    def view(self, shard: int) -> 'ShardTable':
+        """
+        The table as seen from one shard
+        """
+        view = copy.copy(self)
+        view._shard = shard
+        view._read = 0
+        return view
+
+    # Piece ownership, the `claims` of a PiecesManager
+
+    def claim(self, piece_idx: int) -> bool:
+        """
+        Whether the shard may download the piece: it is free, already its
+        own or left alone by its owner for CLAIM_TIMEOUT
+        """
+        me = self._shard + 1
+        now = time.monotonic()
+        state = self._states[piece_idx]
+        if state == me:
+            self._claimed[piece_idx] = now
+            return True
+        if state == DONE or state != FREE and \
+                now - self._claimed[piece_idx] < CLAIM_TIMEOUT:
+            return False
+        with self._lock:
+            state = self._states[piece_idx]
+            if state == DONE or state not in (FREE, me) and \
+                    now - self._claimed[piece_idx] < CLAIM_TIMEOUT:
+                return False
+            self._states[piece_idx] = me
+            self._claimed[piece_idx] = now
+        return True
+
+    def release(self, piece_idx: int):
+        with self._lock:
+            if self._shard is not None and \
+                    self._states[piece_idx] == self._shard + 1:
+                self._states[piece_idx] = FREE
+
+    def complete(self, piece_idx: int):
+        with self._lock:
+            if self._states[piece_idx] == DONE:
+                return
+            self._states[piece_idx] = DONE
+            self._log[self._counters[0]] = piece_idx
+            self._counters[0] += 1
+
+    def completed(self) -> list:
+        """
+        Pieces completed by any shard since the last call on this view
+        """
+        end = self._counters[0]
+        pieces = self._log[self._read:end]
+        self._read = end
+        return pieces
+
+    @property
+    def completed_pieces(self) -> int:
+        return self._counters[0]
+
+    @property
+    def finished(self) -> bool:
+        return self._counters[0] == len(self._states)
+
+    # Coordination
+
+    def add_peers(self, peers, priority: int = PRIORITY_DEFAULT):
+        """
+        Hand the peers to the shards in turn, so each peer is dialed by one
+        shard only
+        """
+        batches = [[] for _ in range(self._shards)]
+        for peer in peers:
+            batches[self._next_shard].append(tuple(peer))
+            self._next_shard = (self._next_shard + 1) % self._shards
+        for batch, peers_queue in zip(batches, self._peers):
+            if batch:
+                peers_queue.put((batch, priority))
+
+    def take_peers(self) -> list:
+        """
+        (peers, priority) batches handed to this shard
+        """
+        peers_queue = self._peers[self._shard]
+        batches = []
+        while not peers_queue.empty():
+            batches.append(peers_queue.get())
+        return batches
+
+    @property
+    def uploaded(self) -> int:
+        return sum(self._counters[2:])
+
+    def set_uploaded(self, uploaded: int):
+        self._counters[2 + self._shard] = uploaded
+
+    @property
+    def stopped(self) -> bool:
+        return bool(self._counters[1])
+
+    def stop(self):
+        self._counters[1] = 1
+
+
+async def _run_shard(torrent_file, table, options, log_level):
+    if log_level:
+        events.configure(log_level)
+    client = TorrentClient(torrent_file, shard=table, dht=False, utp=False,
+                           lsd=False, state_dir=None, **options)
+    try:
+        await client.start()
+    finally:
+        client.stop()
+        events.shutdown()
+
+
+def _shard_main(torrent_file, table, options, log_level):
+    # Entry point of a shard process
+    asyncio.run(_run_shard(torrent_file, table, options, log_level))
+
+
+class ShardedClient:
+    """
+    A torrent downloaded by `shards` processes, one per core by default.
+    Each shard runs a TorrentClient with its own connections, listening on
+    the same port (SO_REUSEPORT spreads the accepted connections), and they
+    split the pieces through a ShardTable while writing to the same files.
+    This process talks to the trackers and to the local network (BEP 14)
+    and hands the peers out, DHT and uTP are not used.
+    """
+
+    def __init__(self, torrent_file, shards: int = None, seed: bool = False,
+                 port: int = LISTEN_PORT, max_buffer: int = MAX_BUFFER,
+                 state_dir: str = STATE_DIR, download_dir: str = '.',
+                 download_rate: int = 0, upload_rate: int = 0,
+                 log_level: str = None, lsd: bool = True):
+        self._torrent_file = torrent_file
+        self._tinfo = TorrentInfo(torrent_file)
+        self._download_dir = download_dir
+        self._seed = seed
+        shards = shards or os.cpu_count() or 1
+        context = multiprocessing.get_context('spawn')
+        self._table = ShardTable(self._tinfo.total_pieces, shards, context)
+        # Limits and memory are split between the shards
+        options = dict(seed=seed, port=port, max_buffer=max_buffer // shards,
+                       download_dir=download_dir,
+                       download_rate=download_rate // shards,
+                       upload_rate=upload_rate // shards)
+        self._processes = [
+            context.Process(target=_shard_main, daemon=True,
+                            args=(torrent_file, self._table.view(shard),
+                                  options, log_level))
+            for shard in range(shards)]
+        self._peer_store = PeerStore(self._tinfo.hash, state_dir) \
+            if state_dir else None
+        self._tracker = TrackerClient(self._tinfo, port=port)
+        self._announcer = Announcer(self._tracker, self._tinfo.announce_tiers,
+                                    self._transferred,
+                                    self._on_tracker_response)
+        self._lsd = LocalDiscovery(port) \
+            if lsd and not self._tinfo.private else None
+        self._stored = 0 # Pieces found on disk when starting
+        self._stopped = False
+        self._reaping = None # Waits for the shards once stopped
+
+    async def start(self):
+        await self._recheck()
+        for process in self._processes:
+            process.start()
+        self._load_peers()
+        self._announcer.start()
+        if self._lsd:
+            await self._lsd.start()
+            self._lsd.add(self._tinfo.hash, lambda peers:
+                          self._table.add_peers(peers, PRIORITY_LOCAL))
+        completed = self._table.finished
+        while True:
+            if self._table.finished:
+                if not completed:
+                    completed = True
+                    await self._announcer.completed()
+                if not self._seed:
+                    BUS.info('torrent.done', torrent=self._tinfo.hex_hash)
+                    break
+            if not any(process.is_alive() for process in self._processes):
+                BUS.error('shards.exited', torrent=self._tinfo.hex_hash)
+                break
+            await asyncio.sleep(1)
+        await self.stop()
+
+    async def _recheck(self):
+        # Done once here rather than by every shard
+        manager = PiecesManager(self._tinfo, download_dir=self._download_dir,
+                                claims=self._table)
+        try:
+            await manager.recheck()
+        finally:
+            manager.close()
+        self._stored = self._table.completed_pieces
+
+    def _load_peers(self):
+        if self._peer_store is None:
+            return
+        self._peer_store.load()
+        for peer in self._peer_store.ranked():
+            record = self._peer_store.get(peer)
+            self._table.add_peers([peer], PRIORITY_KNOWN
+                                  if not record.failures else PRIORITY_DEFAULT)
+
+    def _transferred(self):
+        downloaded = (self._table.completed_pieces - self._stored) * \
+            self._tinfo.piece_length
+        return self._table.uploaded, downloaded
+
+    def _on_tracker_response(self, url, response):
+        self._table.add_peers(response.peers)
+        BUS.info('tracker.response', torrent=self._tinfo.hex_hash, url=url,
+                 peers=len(response.peers), complete=response.complete,
+                 incomplete=response.incomplete, interval=response.interval)
+
+    def stats(self) -> dict:
+        uploaded, downloaded = self._transferred()
+        return {
+            'info_hash': self._tinfo.hex_hash,
+            'shards': self._table.shards,
+            'downloaded': downloaded,
+            'uploaded': uploaded,
+            'pieces': self._table.completed_pieces,
+            'total_pieces': self._tinfo.total_pieces,
+            'complete': self._table.finished,
+        }
+
+    @property
+    def info_hash(self):
+        return self._tinfo.hash
+
+    @property
+    def torrent_info(self):
+        return self._tinfo
+
+    def stop(self):
+        """
+        Ask the shards to stop, returns a future done once they all exited
+        """
+        if self._stopped:
+            return self._reaping
+        BUS.info('torrent.stopping', torrent=self._tinfo.hex_hash)
+        self._stopped = True
+        self._table.stop()
+        self._announcer.stop()
+        self._tracker.close()
+        if self._lsd:
+            self._lsd.close()
+        self._reaping = asyncio.ensure_future(self._reap())
+        return self._reaping
+
+    async def _reap(self):
+        # Shards stop themselves so their pieces reach the disk, only a hung
+        # one is killed. Polled, joining would block the event loop.
+        deadline = time.monotonic() + STOP_TIMEOUT
+        while time.monotonic() < deadline and \
+                any(process.is_alive() for process in self._processes):
+            await asyncio.sleep(STOP_POLL)
+        for shard, process in enumerate(self._processes):
+            if process.is_alive():
+                BUS.warning('shard.hung', torrent=self._tinfo.hex_hash,
+                            shard=shard)
+                process.terminate()
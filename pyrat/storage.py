@@ -0,0 +1,179 @@
+import os
+import threading
+
+
+
+class FileStorage:
+    """
+    The files of a torrent under `download_dir`, addressed by their offset
+    in the torrent. Reads and writes are blocking, they are run in the
+    disk I/O pool.
+
+    Files are created on their first write. The first and last piece of a
+    skipped file, which it may share with a wanted file, are kept in one
+    sparse `.parts` file at their torrent offset, so skipped files are
+    never created. What was stored of a file before it was skipped stays
+    in it.
+    """
+
+    def __init__(self, torrent_info, download_dir: str = '.'):
+        self._tinfo = torrent_info
+        self._download_dir = download_dir
+        self._files = list(torrent_info.files)
+        if torrent_info.multi_file:
+            self._paths = [os.path.join(download_dir, tfile.name)
+                           for tfile in self._files]
+        else:
+            self._paths = [os.path.join(download_dir, torrent_info.filename)]
+        self._parts_path = os.path.join(
+            download_dir, '.{}.parts'.format(torrent_info.filename))
+        self._fds = [None] * len(self._files) # Opened on first use
+        self._parts = None
+        self._skipped = set() # Indexes of the skipped files
+        # Torrent offsets where the first piece of each file ends and where
+        # its last piece starts
+        self._edges = []
+        piece_length = torrent_info.piece_length
+        file_start = 0
+        for tfile in self._files:
+            file_end = file_start + tfile.length
+            first_end = min(file_end, (file_start // piece_length + 1) *
+                            piece_length)
+            last_start = max(first_end, (max(file_end, 1) - 1) //
+                             piece_length * piece_length)
+            self._edges.append((first_end, last_start))
+            file_start = file_end
+        self._lock = threading.Lock()
+
+    @property
+    def open_files(self) -> int:
+        return sum(1 for fd in self._fds if fd is not None)
+
+    def _open(self, path: str, create: bool):
+        if not create and not os.path.exists(path):
+            return None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        return os.open(path, os.O_RDWR | os.O_CREAT)
+
+    def _in_parts(self, file_idx: int, pos: int) -> bool:
+        if file_idx not in self._skipped:
+            return False
+        first_end, last_start = self._edges[file_idx]
+        return pos < first_end or pos >= last_start
+
+    def _fd(self, file_idx: int, create: bool, pos: int):
+        # The parts file stands for the edges of the skipped files
+        with self._lock:
+            if self._in_parts(file_idx, pos):
+                if self._parts is None:
+                    self._parts = self._open(self._parts_path, create)
+                return self._parts
+            if self._fds[file_idx] is None:
+                self._fds[file_idx] = self._open(self._paths[file_idx],
+                                                 create)
+            return self._fds[file_idx]
+
+    def close(self):
+        with self._lock:
+            for fd in self._fds + [self._parts]:
+                if fd is not None:
+                    os.close(fd)
+            self._fds = [None] * len(self._files)
+            self._parts = None
+
+    def _spans(self, pos: int, length: int):
+        """
+        Yield (file index, file offset, size, torrent offset) chunks
+        covering the torrent byte range, split at the first and last piece
+        of the files
+        """
+        file_start = 0
+        for file_idx, tfile in enumerate(self._files):
+            file_end = file_start + tfile.length
+            while length and pos < file_end:
+                end = min([edge for edge in self._edges[file_idx]
+                           if edge > pos] + [file_end])
+                size = min(end - pos, length)
+                yield file_idx, pos - file_start, size, pos
+                pos += size
+                length -= size
+            if length == 0: break
+            file_start = file_end
+
+    def _offset(self, file_idx: int, file_pos: int, pos: int) -> int:
+        return pos if self._in_parts(file_idx, pos) else file_pos
+
+    def write(self, pos: int, data: bytes):
+        # Runs in the disk I/O pool, possibly with several pieces at once
+        data = memoryview(data)
+        for file_idx, file_pos, size, pos in self._spans(pos, len(data)):
+            os.pwrite(self._fd(file_idx, True, pos), data[:size],
+                      self._offset(file_idx, file_pos, pos))
+            data = data[size:]
+
+    def read(self, pos: int, length: int) -> bytes:
+        chunks = []
+        for file_idx, file_pos, size, pos in self._spans(pos, length):
+            fd = self._fd(file_idx, False, pos)
+            chunks.append(os.pread(fd, size, self._offset(
+                file_idx, file_pos, pos)) if fd is not None else bytes(size))
+        return b''.join(chunks)
+
+    def has(self, pos: int, length: int) -> bool:
+        """
+        Whether the files are long enough to hold the range
+        """
+        for file_idx, file_pos, size, pos in self._spans(pos, length):
+            fd = self._fd(file_idx, False, pos)
+            if fd is None or os.fstat(fd).st_size < \
+                    self._offset(file_idx, file_pos, pos) + size:
+                return False
+        return True
+
+    def set_skipped(self, files):
+        """
+        Change the skipped files. The parts of a file on its first and last
+        piece, the only ones a wanted piece may hold, move between the file
+        and the parts file. No write may be in flight.
+        """
+        files = set(files)
+        changed = files ^ self._skipped
+        file_start = 0
+        moves = []
+        for file_idx, tfile in enumerate(self._files):
+            file_end = file_start + tfile.length
+            if file_idx in changed and tfile.length:
+                first_end, last_start = self._edges[file_idx]
+                moves.append((file_idx, file_start, first_end))
+                if last_start < file_end:
+                    moves.append((file_idx, last_start, file_end))
+            file_start = file_end
+        saved = [(pos, self.read(pos, end - pos)) if self.has(pos, end - pos)
+                 else None for _, pos, end in moves]
+        self._skipped = files
+        for data in saved:
+            if data is not None:
+                self.write(*data)
+
+
+class NullStorage:
+    """
+    Drops writes and reads zeros, for simulations and benchmarks
+    """
+
+    def close(self):
+        pass
+
+    def write(self, pos: int, data: bytes):
+        pass
+
+    def read(self, pos: int, length: int) -> bytes:
+        return bytes(length)
+
+    def has(self, pos: int, length: int) -> bool:
+        return False
+
+    def set_skipped(self, files):
+        pass
@@ -0,0 +1,450 @@
+#!/usr/bin/python3
+"""
+Simulated swarm benchmark: a local tracker, seeders and leechers of a
+generated torrent run in this process. Every peer is reached through a
+proxy which can delay and corrupt what the peer sends.
+
+    python -m pyrat.swarm_bench --seeders 2 --leechers 4 --size 64
+"""
+
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from collections import OrderedDict
+from hashlib import sha1
+from struct import pack, unpack
+from urllib.parse import unquote_to_bytes
+
+from .bencode_parser import Encoder
+from .torrent_client import TorrentClient
+from . import events
+
+
+
+HANDSHAKE_LENGTH = 68
+PIECE_ID = 7
+CHUNK_SIZE = 2**16
+
+
+class PeerProfile:
+    """
+    How a simulated peer behaves: `latency` is added in seconds to what
+    goes through its proxy both ways, rates are in bytes per second,
+    `corrupt` is the probability a sent block is damaged and every
+    `choke_interval` seconds it chokes all its peers.
+    """
+
+    def __init__(self, latency: float = 0, upload_rate: int = 0,
+                 download_rate: int = 0, corrupt: float = 0,
+                 choke_interval: float = 0):
+        self.latency = latency
+        self.upload_rate = upload_rate
+        self.download_rate = download_rate
+        self.corrupt = corrupt
+        self.choke_interval = choke_interval
+
+
+def make_torrent(directory: str, size: int, piece_length: int,
+                 announce: str, name: str = 'data.bin'):
+    """
+    Write random content of `size` bytes and its torrent file, returns
+    (torrent path, content path)
+    """
+    data = os.urandom(size)
+    content = os.path.join(directory, name)
+    with open(content, 'wb') as f:
+        f.write(data)
+    pieces = b''.join(sha1(data[i:i + piece_length]).digest()
+                      for i in range(0, size, piece_length))
+    info = OrderedDict([(b'length', size), (b'name', name.encode()),
+                        (b'piece length', piece_length), (b'pieces', pieces)])
+    torrent = os.path.join(directory, name + '.torrent')
+    with open(torrent, 'wb') as f:
+        f.write(Encoder.encode(OrderedDict([(b'announce', announce.encode()),
+                                            (b'info', info)])))
+    return torrent, content
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class FakeTracker:
+    """
+    HTTP tracker answering announces with every other registered peer.
+    A peer is advertised at the port of its proxy.
+    """
+
+    def __init__(self, interval: int = 2):
+        self._interval = interval
+        self._server = None
+        self._peers = dict() # info hash => set of listening ports
+        self.advertised = dict() # listening port => advertised port
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:{}/announce'.format(
+            self._server.sockets[0].getsockname()[1])
+
+    def registered(self, info_hash: bytes) -> int:
+        return len(self._peers.get(info_hash, ()))
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._on_client,
+                                                  '127.0.0.1', 0)
+
+    def close(self):
+        if self._server:
+            self._server.close()
+            self._server = None
+
+    def _announce(self, query: bytes) -> bytes:
+        args = dict(part.split(b'=', 1) for part in query.split(b'&')
+                    if b'=' in part)
+        # Query strings are form encoded, a space byte comes as '+'
+        info_hash = unquote_to_bytes(args[b'info_hash'].replace(b'+', b' '))
+        port = int(args[b'port'])
+        peers = self._peers.setdefault(info_hash, set())
+        if args.get(b'event') == b'stopped':
+            peers.discard(port)
+        else:
+            peers.add(port)
+        compact = b''.join(socket.inet_aton('127.0.0.1') +
+                           pack('>H', self.advertised.get(peer, peer))
+                           for peer in peers if peer != port)
+        return Encoder.encode({b'interval': self._interval,
+                               b'peers': compact})
+
+    async def _on_client(self, reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            target = request.split()[1]
+            body = self._announce(target.partition(b'?')[2])
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: ' +
+                         str(len(body)).encode() +
+                         b'\r\nConnection: close\r\n\r\n' + bytes(body))
+            await writer.drain()
+        except (ConnectionError, IndexError, KeyError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+class PeerProxy:
+    """
+    Forwards connections to a peer, adding its latency both ways and
+    corrupting the blocks it sends
+    """
+
+    def __init__(self, port: int, profile: PeerProfile):
+        self._port = port
+        self._profile = profile
+        self._server = None
+        self._tasks = set()
+        self.corrupted = 0
+
+    @property
+    def port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._on_client,
+                                                  '127.0.0.1', 0)
+
+    def close(self):
+        if self._server:
+            self._server.close()
+            self._server = None
+        for task in self._tasks:
+            task.cancel()
+
+    async def _on_client(self, reader, writer):
+        try:
+            peer_reader, peer_writer = await asyncio.open_connection(
+                '127.0.0.1', self._port)
+        except OSError:
+            writer.close()
+            return
+        tasks = [asyncio.ensure_future(self._pump(reader, peer_writer)),
+                 asyncio.ensure_future(self._pump(peer_reader, writer,
+                                                  self._profile.corrupt))]
+        self._tasks.update(tasks)
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+                self._tasks.discard(task)
+            writer.close()
+            peer_writer.close()
+
+    async def _pump(self, reader, writer, corrupt: float = 0):
+        queue = asyncio.Queue()
+        sender = asyncio.ensure_future(self._send(queue, writer))
+        framer = self._frames() if corrupt else None
+        if framer:
+            next(framer)
+        try:
+            while not sender.done():
+                data = await reader.read(CHUNK_SIZE)
+                if not data:
+                    break
+                if framer:
+                    data = framer.send((data, corrupt))
+                queue.put_nowait((time.monotonic() + self._profile.latency,
+                                  data))
+            queue.put_nowait((0, None))
+            await sender
+        finally:
+            sender.cancel()
+
+    async def _send(self, queue, writer):
+        while True:
+            deadline, data = await queue.get()
+            if data is None:
+                return
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if data:
+                writer.write(data)
+                await writer.drain()
+
+    def _frames(self):
+        # Cuts the stream into messages so only block payloads are damaged
+        buf = bytearray()
+        out = b''
+        skip = HANDSHAKE_LENGTH
+        while True:
+            data, corrupt = yield out
+            buf += data
+            ready = bytearray()
+            if skip:
+                taken = min(skip, len(buf))
+                ready += buf[:taken]
+                del buf[:taken]
+                skip -= taken
+            while len(buf) >= 4:
+                length = unpack('>I', buf[:4])[0]
+                if len(buf) < 4 + length:
+                    break
+                message = buf[:4 + length]
+                del buf[:4 + length]
+                if length > 9 and message[4] == PIECE_ID and \
+                        random.random() < corrupt:
+                    message[-1] ^= 0xff
+                    self.corrupted += 1
+                ready += message
+            out = bytes(ready)
+
+
+class SimulatedPeer:
+    def __init__(self, name: str, torrent: str, directory: str,
+                 profile: PeerProfile, seed: bool):
+        self.name = name
+        self.seed = seed
+        self.profile = profile
+        self.port = _free_port()
+        self.proxy = PeerProxy(self.port, profile)
+        self.client = TorrentClient(
+            torrent, seed=True, port=self.port, state_dir=None, dht=False,
+            utp=False, lsd=False, download_rate=profile.download_rate,
+            upload_rate=profile.upload_rate, download_dir=directory)
+        self.future = None
+        self.first_piece = None
+        self.completed = None
+        self._choking = None
+
+    async def start(self):
+        await self.proxy.start()
+        self.future = asyncio.ensure_future(self.client.start())
+        if self.profile.choke_interval:
+            self._choking = asyncio.ensure_future(self._choke())
+
+    async def _choke(self):
+        # The choker unchokes them again at its next round
+        while True:
+            await asyncio.sleep(self.profile.choke_interval)
+            for conn in self.client._connections():
+                if conn.connected:
+                    conn.choke()
+
+    def poll(self, now: float):
+        stats = self.client.stats()
+        if self.first_piece is None and stats['pieces']:
+            self.first_piece = now
+        if self.completed is None and stats['complete']:
+            self.completed = now
+
+    def stop(self):
+        if self._choking:
+            self._choking.cancel()
+        self.client.stop()
+        self.proxy.close()
+        if self.future and not self.future.done():
+            self.future.cancel()
+
+
+async def run_swarm(seeders: int = 1, leechers: int = 1,
+                    size: int = 16 * 2**20, piece_length: int = 2**18,
+                    seeder_profile: PeerProfile = None,
+                    leecher_profile: PeerProfile = None,
+                    profiles: dict = None, timeout: float = 300,
+                    poll_interval: float = 0.01) -> dict:
+    """
+    Run a swarm until every leecher completes or `timeout` expires and
+    return its report. `profiles` maps peer names ('seeder0',
+    'leecher1'...) to their own PeerProfile.
+    """
+    seeder_profile = seeder_profile or PeerProfile()
+    leecher_profile = leecher_profile or PeerProfile()
+    profiles = profiles or dict()
+    tracker = FakeTracker()
+    await tracker.start()
+    peers = []
+    with tempfile.TemporaryDirectory() as directory:
+        torrent, content = make_torrent(directory, size, piece_length,
+                                        tracker.url)
+        with open(content, 'rb') as f:
+            data = f.read()
+        for idx in range(seeders + leechers):
+            seed = idx < seeders
+            name = 'seeder{}'.format(idx) if seed else \
+                'leecher{}'.format(idx - seeders)
+            peer_dir = os.path.join(directory, name)
+            os.mkdir(peer_dir)
+            if seed:
+                with open(os.path.join(peer_dir, 'data.bin'), 'wb') as f:
+                    f.write(data)
+            profile = profiles.get(name, seeder_profile if seed
+                                   else leecher_profile)
+            peers.append(SimulatedPeer(name, torrent, peer_dir, profile,
+                                       seed))
+        del data
+        try:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            for peer in peers:
+                await peer.proxy.start()
+                tracker.advertised[peer.port] = peer.proxy.port
+            # Leechers find the seeders at their first announce
+            info_hash = peers[0].client.info_hash
+            for peer in peers[:seeders]:
+                await peer.start()
+            while tracker.registered(info_hash) < seeders:
+                await asyncio.sleep(poll_interval)
+            start = time.monotonic()
+            for peer in peers[seeders:]:
+                await peer.start()
+            leeching = peers[seeders:]
+            while time.monotonic() - start < timeout:
+                now = time.monotonic() - start
+                for peer in leeching:
+                    peer.poll(now)
+                if all(peer.completed is not None for peer in leeching):
+                    break
+                await asyncio.sleep(poll_interval)
+            wall = time.monotonic() - start
+            done = resource.getrusage(resource.RUSAGE_SELF)
+        finally:
+            for peer in peers:
+                peer.stop()
+            tracker.close()
+            await asyncio.sleep(0)
+        return _report(peers[seeders:], peers[:seeders], size, wall,
+                       usage, done)
+
+
+def _report(leechers, seeders, size, wall, usage, done) -> dict:
+    cpu = (done.ru_utime - usage.ru_utime) + (done.ru_stime - usage.ru_stime)
+    finished = [peer.completed for peer in leechers
+                if peer.completed is not None]
+    peers = dict()
+    for peer in leechers:
+        peers[peer.name] = {
+            'first_piece': peer.first_piece,
+            'completed': peer.completed,
+            'mb_per_s': size / 2**20 / peer.completed
+            if peer.completed else None,
+        }
+    return {
+        'size_mb': size / 2**20,
+        'leechers': len(leechers),
+        'completed': len(finished),
+        'wall_time': wall,
+        'completion_time': max(finished) if len(finished) == len(leechers)
+        else None,
+        'first_piece': min((peer.first_piece for peer in leechers
+                            if peer.first_piece is not None), default=None),
+        'mb_per_s': len(finished) * size / 2**20 / wall,
+        'cpu_time': cpu,
+        'cpu_percent': 100 * cpu / wall if wall else 0,
+        'peak_rss_mb': done.ru_maxrss / 1024, # Of the whole process
+        'corrupted_blocks': sum(peer.proxy.corrupted
+                                for peer in seeders + leechers),
+        'peers': peers,
+    }
+
+
+def init_parser():
+    parser = ArgumentParser(description="PyRat simulated swarm benchmark.")
+    parser.add_argument("--seeders", type=int, default=1)
+    parser.add_argument("--leechers", type=int, default=1)
+    parser.add_argument("--size", type=float, default=16,
+                        help="Content size in MB.")
+    parser.add_argument("--piece-length", type=int, default=256,
+                        help="Piece length in KB.")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="One way latency of every peer in ms.")
+    parser.add_argument("--upload-rate", type=int, default=0,
+                        help="Upload cap of every seeder in KB/s.")
+    parser.add_argument("--download-rate", type=int, default=0,
+                        help="Download cap of every leecher in KB/s.")
+    parser.add_argument("--corrupt", type=float, default=0,
+                        help="Probability a seeder corrupts a block.")
+    parser.add_argument("--corrupt-seeders", type=int, default=None,
+                        help="How many seeders corrupt blocks, all if unset.")
+    parser.add_argument("--choke-interval", type=float, default=0,
+                        help="Seeders choke everyone every that many seconds.")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--log-level", default="WARNING",
+                        help="Level of the events of the clients to show.")
+    return parser
+
+
+def main():
+    args = init_parser().parse_args()
+    latency = args.latency / 1000
+    seeder = PeerProfile(latency, upload_rate=args.upload_rate * 1024,
+                         choke_interval=args.choke_interval)
+    leecher = PeerProfile(latency, download_rate=args.download_rate * 1024)
+    profiles = dict()
+    corrupt_seeders = args.seeders if args.corrupt_seeders is None \
+        else args.corrupt_seeders
+    for idx in range(corrupt_seeders):
+        profiles['seeder{}'.format(idx)] = PeerProfile(
+            latency, upload_rate=args.upload_rate * 1024,
+            corrupt=args.corrupt, choke_interval=args.choke_interval)
+    events.configure(args.log_level, stream=sys.stderr)
+    try:
+        report = asyncio.run(run_swarm(
+            args.seeders, args.leechers, int(args.size * 2**20),
+            args.piece_length * 1024, seeder, leecher, profiles,
+            args.timeout))
+    finally:
+        events.shutdown()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
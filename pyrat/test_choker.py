@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+
+import asyncio
+import random
+import unittest
+from unittest import mock
+from .choker import Choker, RateMeter
+
+
+class FakeRate:
+    def __init__(self, rate: float):
+        self.rate = rate
+
+
+class FakeConnection:
+    def __init__(self, download: float = 0, upload: float = 0,
+                 interested: bool = True, connected_at: float = None):
+        self.connected = True
+        self.peer_interested = interested
+        self.download_rate = FakeRate(download)
+        self.upload_rate = FakeRate(upload)
+        self.connected_at = connected_at
+        self.unchoked = False
+
+    def choke(self):
+        self.unchoked = False
+
+    def unchoke(self):
+        self.unchoked = True
+
+
+class FakePieces:
+    complete = False
+
+
+class TestRateMeter(unittest.TestCase):
+    def test_rate_decays(self):
+        with mock.patch('pyrat.choker.time') as clock:
+            clock.monotonic.return_value = 100.0
+            meter = RateMeter(window=10)
+            meter.update(1000)
+            self.assertEqual(meter.rate, 100)
+            clock.monotonic.return_value = 110.0
+            self.assertAlmostEqual(meter.rate, 100 / 2.718281828, places=3)
+            self.assertEqual(meter.total, 1000)
+
+
+class TestChoker(unittest.TestCase):
+    def setUp(self):
+        self.pieces = FakePieces()
+        self.conns = []
+        self.choker = Choker(lambda: self.conns, self.pieces)
+
+    def _unchoked(self):
+        return [conn for conn in self.conns if conn.unchoked]
+
+    def test_fastest_peers_get_the_slots(self):
+        self.conns = [FakeConnection(download=rate) for rate in range(6)]
+        self.conns.append(FakeConnection(download=100, interested=False))
+        self.choker.rechoke()
+        unchoked = self._unchoked()
+        # Four regular slots and the optimistic one
+        self.assertEqual(len(unchoked), 5)
+        self.assertTrue(all(conn.unchoked for conn in self.conns[2:6]))
+        self.assertFalse(self.conns[6].unchoked)
+
+    def test_seeding_ranks_by_upload(self):
+        self.pieces.complete = True
+        self.choker = Choker(lambda: self.conns, self.pieces, upload_slots=1)
+        self.conns = [FakeConnection(download=100, upload=1),
+                      FakeConnection(download=1, upload=100)]
+        self.choker.rechoke()
+        self.assertTrue(self.conns[1].unchoked)
+
+    def test_optimistic_slot_rotates(self):
+        self.conns = [FakeConnection(download=100)] + \
+            [FakeConnection() for _ in range(20)]
+        self.choker = Choker(lambda: self.conns, self.pieces, upload_slots=1)
+        with mock.patch('pyrat.choker.time') as clock:
+            clock.monotonic.return_value = 1000.0
+            self.choker.rechoke()
+            optimistic = [conn for conn in self._unchoked()
+                          if conn is not self.conns[0]]
+            self.assertEqual(len(optimistic), 1)
+            # Kept for the 30 s of its slot across rechokes
+            for now in (1010.0, 1020.0, 1029.0):
+                clock.monotonic.return_value = now
+                self.choker.rechoke()
+                self.assertEqual(self._unchoked(),
+                                 [self.conns[0], optimistic[0]])
+            random.seed(1)
+            picked = set()
+            for now in range(1030, 1330, 30):
+                clock.monotonic.return_value = float(now)
+                self.choker.rechoke()
+                picked.update(self._unchoked())
+        self.assertGreater(len(picked), 3)
+
+    def test_new_peers_are_favoured(self):
+        now = 1000.0
+        new = FakeConnection(connected_at=now - 10)
+        old = FakeConnection(connected_at=now - 600)
+        random.seed(1)
+        picks = [self.choker._pick_optimistic([new, old], now)
+                 for _ in range(2000)]
+        # Weighted 3 to 1
+        self.assertAlmostEqual(picks.count(new) / len(picks), 0.75,
+                               delta=0.05)
+
+    def test_rechokes_every_interval(self):
+        rechokes = []
+        async def main():
+            choker = Choker(lambda: self.conns, self.pieces, interval=0.01)
+            with mock.patch.object(choker, 'rechoke',
+                                   lambda: rechokes.append(1)):
+                choker.start()
+                await asyncio.sleep(0.055)
+                choker.stop()
+        asyncio.run(main())
+        self.assertGreaterEqual(len(rechokes), 4)
+
+    def test_default_intervals(self):
+        choker = Choker(lambda: [], self.pieces)
+        self.assertEqual((choker._upload_slots, choker._interval,
+                          choker._optimistic_interval), (4, 10, 30))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+from .dht import DHTError, DHTNode, Node, RoutingTable, TokenManager, K
+
+
+def _local_node(bootstrap=(), **kwargs):
+    return DHTNode(port=0, host='127.0.0.1', bootstrap=bootstrap, **kwargs)
+
+
+class TestRoutingTable(unittest.TestCase):
+    def test_full_bucket_returns_oldest(self):
+        table = RoutingTable(bytes(20), k=2)
+        # Ids sharing the top bit fall in the same bucket
+        nodes = [Node(bytes([0x80, i]) + bytes(18), '10.0.0.1', i + 1)
+                 for i in range(3)]
+        self.assertIsNone(table.add(nodes[0]))
+        self.assertIsNone(table.add(nodes[1]))
+        self.assertIs(table.add(nodes[2]), nodes[0])
+        table.failed(nodes[1].addr)
+        table.failed(nodes[1].addr)
+        self.assertIsNone(table.add(nodes[2])) # Replaces the bad node
+        self.assertEqual([n.id for n in table.closest(bytes(20))],
+                         [nodes[0].id, nodes[2].id])
+
+    def test_tokens(self):
+        tokens = TokenManager()
+        token = tokens.token('10.0.0.1')
+        self.assertTrue(tokens.check('10.0.0.1', token))
+        self.assertFalse(tokens.check('10.0.0.2', token))
+
+    def test_malformed_transaction_id_dropped(self):
+        node = _local_node()
+        for tid in (b'li1ee', b'd1:ai1ee', b'i1e'):
+            node.datagram_received(b'd1:rd2:id20:' + bytes(20) + b'e1:t' +
+                                   tid + b'1:y1:re', ('10.0.0.1', 6881))
+
+    def test_error_message_must_be_bytes(self):
+        async def main():
+            node = _local_node()
+            future = asyncio.get_event_loop().create_future()
+            node._pending[b'aa'] = (future, ('10.0.0.1', 6881))
+            # A huge int would be a buffer of that size
+            node.datagram_received(b'd1:eli201ei99999999999ee1:t2:aa1:y1:ee',
+                                   ('10.0.0.1', 6881))
+            with self.assertRaises(DHTError) as raised:
+                await future
+            return str(raised.exception)
+        self.assertEqual(asyncio.run(main()), '201 ')
+
+    def test_expired_hashes_make_room(self):
+        node = _local_node()
+        node.MAX_STORED_HASHES = 2
+        with mock.patch('pyrat.dht.time') as clock:
+            clock.monotonic.return_value = 1000.0
+            node._store_peer(b'a' * 20, ('10.0.0.1', 6881))
+            node._store_peer(b'b' * 20, ('10.0.0.1', 6881))
+            node._store_peer(b'c' * 20, ('10.0.0.1', 6881))
+            self.assertNotIn(b'c' * 20, node._stored)
+            clock.monotonic.return_value = 1000.0 + node.PEER_TTL + 1
+            self.assertEqual(node._stored_peers(b'a' * 20), [])
+            self.assertNotIn(b'a' * 20, node._stored)
+            node._store_peer(b'c' * 20, ('10.0.0.1', 6881))
+            node._store_peer(b'd' * 20, ('10.0.0.1', 6881))
+        self.assertEqual(sorted(node._stored), [b'c' * 20, b'd' * 20])
+
+
+class TestDHTNetwork(unittest.TestCase):
+    def test_announce_and_get_peers(self):
+        async def main():
+            router = _local_node()
+            await router.start()
+            bootstrap = [('127.0.0.1', router.port)]
+            nodes = []
+            try:
+                for _ in range(2 * K):
+                    node = _local_node(bootstrap)
+                    await node.start()
+                    await node.bootstrap()
+                    nodes.append(node)
+                info_hash = os.urandom(20)
+                await nodes[0].announce(info_hash, 6881)
+                return await nodes[-1].get_peers(info_hash)
+            finally:
+                for node in nodes + [router]:
+                    node.close()
+        peers = asyncio.run(asyncio.wait_for(main(), 30))
+        self.assertEqual(peers, {('127.0.0.1', 6881)})
+
+    def test_routing_table_is_persisted(self):
+        async def main(path):
+            router = _local_node()
+            await router.start()
+            node = _local_node([('127.0.0.1', router.port)], state_path=path)
+            await node.start()
+            await node.bootstrap()
+            node.close()
+            router.close()
+            return node.node_id, router.node_id
+        path = os.path.join(tempfile.mkdtemp(), 'dht')
+        node_id, router_id = asyncio.run(main(path))
+        restarted = _local_node(state_path=path)
+        self.assertEqual(restarted.node_id, node_id)
+        self.assertIsNotNone(restarted.routing_table.get(router_id))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+
+import asyncio
+import threading
+import unittest
+from .disk_io import DiskIO
+
+
+class FakeFile:
+    def __init__(self, size):
+        self.data = bytearray(size)
+        self.writes = []
+        self.started = threading.Event()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def write(self, pos, data):
+        self.started.set()
+        self.gate.wait()
+        self.writes.append((pos, len(data)))
+        self.data[pos:pos + len(data)] = data
+
+
+class TestDiskIO(unittest.TestCase):
+    def test_adjacent_jobs_are_merged(self):
+        f = FakeFile(400)
+        disk = DiskIO(threads=1)
+        f.gate.clear() # Hold the first write so the rest are queued
+        disk.submit(f.write, 0, b'a' * 100)
+        f.started.wait()
+        for pos in (300, 100, 200):
+            disk.submit(f.write, pos, bytes([pos // 100]) * 100)
+        f.gate.set()
+        disk.close()
+        self.assertEqual(f.writes, [(0, 100), (100, 300)])
+        self.assertEqual(f.data[100:300], b'\x01' * 100 + b'\x02' * 100)
+        self.assertEqual(disk.jobs, 4)
+        self.assertEqual(disk.queued_bytes, 0)
+
+    def test_backpressure(self):
+        f = FakeFile(1000)
+        disk = DiskIO(threads=1, high_watermark=300, low_watermark=100)
+        f.gate.clear()
+        for pos in range(0, 400, 200):
+            disk.submit(f.write, pos, b'x' * 100)
+        self.assertFalse(disk.backpressure)
+        disk.submit(f.write, 800, b'x' * 100)
+        self.assertTrue(disk.backpressure)
+        f.gate.set()
+        disk.flush()
+        self.assertFalse(disk.backpressure)
+        disk.close()
+
+    def test_callbacks_and_flush_per_writer(self):
+        first, second = FakeFile(100), FakeFile(100)
+        done = []
+        disk = DiskIO()
+        disk.submit(first.write, 0, b'1' * 100, lambda: done.append(1))
+        disk.submit(second.write, 0, b'2' * 100, lambda: done.append(2))
+        disk.flush(first.write)
+        self.assertEqual(bytes(first.data), b'1' * 100)
+        disk.close()
+        self.assertEqual(sorted(done), [1, 2])
+        with self.assertRaises(RuntimeError):
+            disk.submit(first.write, 0, b'')
+
+    def test_wait_flushed_keeps_loop_running(self):
+        f = FakeFile(100)
+        disk = DiskIO()
+        f.gate.clear()
+        async def main():
+            disk.submit(f.write, 0, b'x' * 100)
+            waiter = asyncio.ensure_future(disk.wait_flushed(f.write))
+            await asyncio.sleep(0.05) # The loop runs meanwhile
+            self.assertFalse(waiter.done())
+            f.gate.set()
+            await waiter
+            await disk.wait_flushed() # Nothing queued
+        asyncio.run(main())
+        self.assertEqual(f.writes, [(0, 100)])
+        disk.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+
+import io
+import os
+import tempfile
+import unittest
+from . import events
+from .events import BUS
+
+
+class TestEvents(unittest.TestCase):
+    def tearDown(self):
+        events.shutdown()
+        logger = events.logging.getLogger('pyrat')
+        logger.setLevel(events.logging.NOTSET)
+        logger.propagate = True
+        BUS.tracing = False
+
+    def test_level_filter(self):
+        stream = io.StringIO()
+        events.configure('INFO', stream=stream)
+        self.assertFalse(BUS.enabled(events.logging.DEBUG))
+        BUS.debug('hidden.event')
+        BUS.info('peer.connected', peer='1.2.3.4', port=6881)
+        with BUS.span('parse'):
+            pass # Tracing is off
+        events.shutdown()
+        output = stream.getvalue()
+        self.assertIn('INFO pyrat peer.connected peer=1.2.3.4 port=6881',
+                      output)
+        self.assertNotIn('hidden', output)
+        self.assertNotIn('parse', output)
+
+    def test_trace_to_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'log')
+            events.configure('ERROR', path, trace=True, stream=io.StringIO())
+            with BUS.span('hash', piece=3):
+                pass
+            BUS.trace('announce', 0.5, tracker='example.org')
+            events.shutdown()
+            with open(path) as f:
+                lines = f.read().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn('TRACE pyrat.trace hash piece=3 duration=', lines[0])
+        self.assertTrue(lines[1].endswith(
+            'announce tracker=example.org duration=0.5'))
+
+if __name__ == "__main__":
+    unittest.main()
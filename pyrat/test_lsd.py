@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+
+import asyncio
+import unittest
+from .lsd import LocalDiscovery, encode_announce, decode_announce
+
+
+class _Transport:
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append((data, addr))
+
+    def close(self):
+        pass
+
+
+class TestLocalDiscovery(unittest.TestCase):
+    def test_announce_roundtrip(self):
+        hashes = [bytes(range(20)), bytes(20)]
+        data = encode_announce(6881, hashes, 'c00c1e')
+        self.assertTrue(data.startswith(b'BT-SEARCH * HTTP/1.1\r\n'))
+        self.assertEqual(decode_announce(data), (6881, hashes, 'c00c1e'))
+        self.assertIsNone(decode_announce(b'M-SEARCH * HTTP/1.1\r\n\r\n'))
+        self.assertIsNone(decode_announce(
+            b'BT-SEARCH * HTTP/1.1\r\nPort: x\r\n\r\n'))
+        self.assertIsNone(decode_announce(
+            b'BT-SEARCH * HTTP/1.1\r\nPort: 1\r\n\r\n'))
+
+    def test_peers_of_added_torrents(self):
+        discovery = LocalDiscovery(7000)
+        found = []
+        discovery.add(b'a' * 20, found.extend)
+        other = encode_announce(7001, [b'a' * 20, b'b' * 20], 'other')
+        discovery.datagram_received(other, ('192.168.1.5', 6771))
+        own = encode_announce(7000, [b'a' * 20], discovery._cookie)
+        discovery.datagram_received(own, ('192.168.1.4', 6771))
+        self.assertEqual(found, [('192.168.1.5', 7001)])
+
+    def test_announces_rate_limited(self):
+        discovery = LocalDiscovery(7000)
+        discovery._transport = _Transport()
+        discovery.add(b'a' * 20, print)
+        discovery.add(b'b' * 20, print)
+        discovery.announce([b'a' * 20, b'b' * 20]) # Too soon
+        self.assertEqual(len(discovery._transport.sent), 2)
+        data, addr = discovery._transport.sent[0]
+        self.assertEqual(addr, ('239.192.152.143', 6771))
+        self.assertEqual(decode_announce(data)[:2], (7000, [b'a' * 20]))
+
+    def test_multicast(self):
+        async def main():
+            found = []
+            first = LocalDiscovery(7001, lsd_port=16771)
+            second = LocalDiscovery(7002, lsd_port=16771)
+            first.add(b'a' * 20, found.extend)
+            await first.start()
+            await second.start()
+            if first._transport is None or second._transport is None:
+                first.close()
+                second.close()
+                self.skipTest("No multicast route")
+            second.add(b'a' * 20, print)
+            for _ in range(50):
+                if found:
+                    break
+                await asyncio.sleep(0.01)
+            first.close()
+            second.close()
+            return found
+        found = asyncio.run(main())
+        self.assertEqual([port for _, port in found], [7002])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+
+import os
+import tempfile
+import unittest
+from hashlib import sha1
+from . import make_torrent as maker
+from .make_torrent import make_torrent, piece_length_for
+from .torrent_file import TorrentInfo
+
+
+class TestMakeTorrent(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self._dir.name, 'data')
+        # Pieces straddle the files, one of them empty
+        self.contents = [('b.bin', os.urandom(70000)), ('a/c.bin', b''),
+                         ('a/d.bin', os.urandom(100)),
+                         ('a/e.bin', os.urandom(50000))]
+        for name, content in self.contents:
+            path = os.path.join(self.directory, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(content)
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _expected_pieces(self, data, piece_length):
+        return [sha1(data[pos:pos + piece_length]).digest()
+                for pos in range(0, len(data), piece_length)]
+
+    def test_directory_loads(self):
+        # Small tasks so the pieces are spread over the pool
+        maker.TASK_SIZE = 2**15
+        self.addCleanup(setattr, maker, 'TASK_SIZE', 32 * 2**20)
+        output = os.path.join(self._dir.name, 'data.torrent')
+        progress = []
+        data = make_torrent(self.directory, 'http://tracker/announce',
+                            output, 2**14, workers=2,
+                            progress=lambda *args: progress.append(args))
+        torrent = TorrentInfo(output)
+        self.assertEqual(torrent.filename, 'data')
+        # Walked in sorted order
+        self.assertEqual([list(f.path) for f in torrent.files],
+                         [['a', 'c.bin'], ['a', 'd.bin'], ['a', 'e.bin'],
+                          ['b.bin']])
+        content = b''.join(content for _, content in sorted(self.contents))
+        self.assertEqual(torrent.total_size, len(content))
+        self.assertEqual(list(torrent.pieces_hashes),
+                         self._expected_pieces(content, 2**14))
+        self.assertEqual(torrent.get_announce(), 'http://tracker/announce')
+        self.assertEqual(progress[-1], (len(content), len(content)))
+        self.assertEqual(progress, sorted(progress))
+        # The info dictionary is written canonically, as the last key
+        info = data[data.index(b'4:infod') + 6:-1]
+        self.assertEqual(torrent.hex_hash, sha1(info).hexdigest())
+
+    def test_single_file(self):
+        path = os.path.join(self.directory, 'b.bin')
+        output = os.path.join(self._dir.name, 'b.torrent')
+        make_torrent(path, output=output, private=True, workers=1)
+        torrent = TorrentInfo(output)
+        self.assertFalse(torrent.multi_file)
+        self.assertTrue(torrent.private)
+        self.assertEqual(torrent.piece_length, 2**14)
+        self.assertEqual(list(torrent.pieces_hashes), self._expected_pieces(
+            self.contents[0][1], 2**14))
+
+    def test_piece_length_for(self):
+        self.assertEqual(piece_length_for(1000), 2**14)
+        self.assertEqual(piece_length_for(2**30), 2**20)
+        self.assertEqual(piece_length_for(2**50), 2**24)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+
+import asyncio
+import unittest
+from .metrics import MetricsRegistry, MetricsServer
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.bytes = self.registry.counter('bytes_total', 'Bytes',
+                                           ('torrent', 'direction'))
+        self.rtt = self.registry.histogram('rtt_seconds', 'RTT',
+                                           buckets=(0.1, 1))
+        self.peers = self.registry.gauge('peers', 'Peers')
+
+    def test_stats(self):
+        down = self.bytes.child('aa', 'download')
+        down.value += 10
+        self.bytes.inc(5, 'aa', 'download')
+        for value in (0.05, 0.5, 5):
+            self.rtt.observe(value)
+        self.peers.set_function(lambda: 3)
+        stats = self.registry.stats()
+        self.assertEqual(stats['bytes_total'], {('aa', 'download'): 15})
+        self.assertEqual(stats['peers'], {(): 3})
+        rtt = stats['rtt_seconds'][()]
+        self.assertEqual(rtt['count'], 3)
+        self.assertAlmostEqual(rtt['sum'], 5.55)
+        self.assertEqual(list(rtt['buckets'].values()), [1, 2, 3])
+        with self.assertRaises(ValueError):
+            self.bytes.child('aa')
+
+    def test_prometheus(self):
+        self.bytes.inc(7, 'a"b', 'upload')
+        self.rtt.observe(0.5)
+        text = self.registry.prometheus()
+        self.assertIn('# TYPE bytes_total counter', text)
+        self.assertIn('bytes_total{torrent="a\\"b",direction="upload"} 7',
+                      text)
+        self.assertIn('rtt_seconds_bucket{le="0.1"} 0', text)
+        self.assertIn('rtt_seconds_bucket{le="1"} 1', text)
+        self.assertIn('rtt_seconds_bucket{le="+Inf"} 1', text)
+        self.assertIn('rtt_seconds_count 1', text)
+
+    def test_server(self):
+        self.bytes.inc(1, 'aa', 'download')
+        async def get(port, path):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write('GET {} HTTP/1.1\r\nHost: x\r\n\r\n'.format(
+                path).encode())
+            response = await reader.read()
+            writer.close()
+            return response
+        async def main():
+            server = MetricsServer(self.registry, 0)
+            await server.start()
+            try:
+                return (await get(server.port, '/metrics'),
+                        await get(server.port, '/'))
+            finally:
+                server.close()
+        found, missing = asyncio.run(main())
+        self.assertTrue(found.startswith(b'HTTP/1.1 200'))
+        self.assertIn(b'bytes_total{torrent="aa",direction="download"} 1',
+                      found)
+        self.assertTrue(missing.startswith(b'HTTP/1.1 404'))
+
+if __name__ == "__main__":
+    unittest.main()
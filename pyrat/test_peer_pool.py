@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+
+import asyncio
+import unittest
+from unittest import mock
+from .peer_pool import PeerPool
+
+
+class TestPeerPool(unittest.TestCase):
+    def test_deduplication(self):
+        pool = PeerPool()
+        self.assertEqual(pool.add([('1.1.1.1', 1), ('2.2.2.2', 2)]), 2)
+        self.assertEqual(pool.add([('1.1.1.1', 1), ('3.3.3.3', 3)]), 1)
+        self.assertEqual(len(pool), 3)
+
+    def test_priority_order(self):
+        pool = PeerPool()
+        pool.add([('1.1.1.1', 1), ('2.2.2.2', 2)])
+        pool.add([('3.3.3.3', 3)], priority=10)
+        pool.add([('2.2.2.2', 2)], priority=5) # Raises a queued peer
+        order = [pool.get_nowait() for _ in range(3)]
+        self.assertEqual(order, [('3.3.3.3', 3), ('2.2.2.2', 2),
+                                 ('1.1.1.1', 1)])
+        with self.assertRaises(asyncio.QueueEmpty):
+            pool.get_nowait()
+
+    def test_active_and_recently_dialed_are_skipped(self):
+        pool = PeerPool()
+        pool.add([('1.1.1.1', 1)])
+        peer = pool.get_nowait()
+        self.assertEqual(pool.add([peer]), 0) # Connected
+        pool.release(peer)
+        self.assertEqual(pool.add([peer]), 0) # Dialed too recently
+        pool.RETRY_INTERVAL = 0
+        self.assertEqual(pool.add([peer]), 1)
+
+    def test_get_waits_for_candidates(self):
+        async def main():
+            pool = PeerPool()
+            getter = asyncio.ensure_future(pool.get())
+            await asyncio.sleep(0)
+            self.assertFalse(getter.done())
+            pool.add([('1.1.1.1', 1)])
+            return await asyncio.wait_for(getter, 1)
+        self.assertEqual(asyncio.run(main()), ('1.1.1.1', 1))
+
+    def test_dial_records_expire(self):
+        pool = PeerPool()
+        with mock.patch('pyrat.peer_pool.time') as clock:
+            clock.monotonic.return_value = 1000.0
+            pool.add([('10.0.0.{}'.format(i), 1) for i in range(100)])
+            for _ in range(100):
+                pool.release(pool.get_nowait())
+            self.assertEqual(len(pool._dialed), 100)
+            clock.monotonic.return_value += pool.RETRY_INTERVAL
+            pool.add([('10.1.0.1', 1)])
+            pool.get_nowait()
+        # Only the last one is remembered
+        self.assertEqual(list(pool._dialed), [('10.1.0.1', 1)])
+
+    def test_banned_hosts_refused(self):
+        pool = PeerPool()
+        pool.add([('1.1.1.1', 1), ('2.2.2.2', 2)])
+        pool.ban('1.1.1.1')
+        self.assertEqual(pool.add([('1.1.1.1', 3)]), 0)
+        self.assertEqual(pool.get_nowait(), ('2.2.2.2', 2))
+        with self.assertRaises(asyncio.QueueEmpty):
+            pool.get_nowait()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+#!/usr/bin/python3
+
+import tempfile
+import unittest
+from .peer_store import PeerStore
+
+
+class TestPeerStore(unittest.TestCase):
+    def test_ranking(self):
+        store = PeerStore(b'\x00' * 20, tempfile.mkdtemp())
+        for peer in (('1.1.1.1', 1), ('2.2.2.2', 2), ('3.3.3.3', 3)):
+            store.connected(peer)
+        store.disconnected(('2.2.2.2', 2), 3)
+        store.failed(('3.3.3.3', 3))
+        store.failed(('4.4.4.4', 4)) # Never connected, not remembered
+        self.assertEqual(store.ranked(), [('2.2.2.2', 2), ('1.1.1.1', 1),
+                                          ('3.3.3.3', 3)])
+        store.hash_failed(('2.2.2.2', 2))
+        self.assertEqual(store.ranked(1), [('1.1.1.1', 1)])
+
+    def test_save_and_load(self):
+        directory = tempfile.mkdtemp()
+        store = PeerStore(b'\x01' * 20, directory)
+        store.connected(('1.1.1.1', 1))
+        store.disconnected(('1.1.1.1', 1), 500)
+        store.save()
+        loaded = PeerStore(b'\x01' * 20, directory)
+        loaded.load()
+        self.assertEqual(loaded.ranked(), [('1.1.1.1', 1)])
+        self.assertEqual(loaded.get(('1.1.1.1', 1)).rate, 500)
+
+    def test_ban_persisted(self):
+        directory = tempfile.mkdtemp()
+        store = PeerStore(b'\x02' * 20, directory)
+        store.connected(('1.1.1.1', 1))
+        store.connected(('2.2.2.2', 2))
+        store.ban('1.1.1.1')
+        self.assertEqual(store.ranked(), [('2.2.2.2', 2)])
+        store.save()
+        loaded = PeerStore(b'\x02' * 20, directory)
+        loaded.load()
+        self.assertEqual(loaded.banned, {'1.1.1.1'})
+        self.assertEqual(loaded.ranked(), [('2.2.2.2', 2)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+
+import unittest
+from .bencode_parser import Decoder
+from .protocol import Handshake, Extended, PeerStreamIterator
+from .pex import PexState, decode_pex, decode_payload, \
+    extension_handshake, UT_PEX
+
+
+class TestExtensionProtocol(unittest.TestCase):
+    def test_handshake_advertises_extensions(self):
+        data = Handshake(b'i' * 20, b'p' * 20).encode()
+        self.assertEqual(len(data), Handshake.length)
+        self.assertTrue(Handshake.decode(data).supports_extensions)
+        plain = Handshake(b'i' * 20, b'p' * 20, reserved=bytes(8))
+        self.assertFalse(Handshake.decode(plain.encode()).supports_extensions)
+
+    def test_extended_message_is_parsed(self):
+        payload = extension_handshake(port=6881)
+        stream = PeerStreamIterator(None, Extended(0, payload).encode())
+        msg = stream.parse()
+        self.assertIs(type(msg), Extended)
+        self.assertEqual(msg.ext_id, 0)
+        handshake = decode_payload(msg.payload)
+        self.assertEqual(handshake[b'm'], {b'ut_pex': UT_PEX})
+        self.assertEqual(handshake[b'p'], 6881)
+        private = decode_payload(extension_handshake(port=6881, pex=False))
+        self.assertEqual(private[b'm'], {})
+
+
+class TestPexState(unittest.TestCase):
+    def test_only_differences_are_sent(self):
+        state = PexState()
+        peers = [('10.0.0.1', 1), ('2001:db8::1', 2)]
+        payload = state.message(peers)
+        self.assertEqual(sorted(decode_pex(payload)), sorted(peers))
+        self.assertIsNone(state.message(peers))
+        payload = state.message([('10.0.0.1', 1)])
+        msg = Decoder(payload).parse()
+        self.assertEqual(msg[b'added'], b'')
+        self.assertEqual(len(msg[b'dropped6']), 18)
+
+    def test_malformed_payload(self):
+        self.assertEqual(decode_pex(b'd5:added'), tuple())
+        self.assertEqual(decode_pex(b'i1e'), tuple())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,28 @@
+#!/usr/bin/python3
+
+import asyncio
+import unittest
+from .picker_sim import PickerSimulator, percentiles
+from .protocol import REQUEST_SIZE
+
+
+class TestPickerSimulator(unittest.TestCase):
+    def test_percentiles(self):
+        summary = percentiles([i / 1e6 for i in range(1, 101)])
+        self.assertEqual(summary['count'], 100)
+        self.assertAlmostEqual(summary['p50'], 51)
+        self.assertAlmostEqual(summary['p99'], 100)
+        self.assertEqual(percentiles([]), {'count': 0})
+
+    def test_download_completes(self):
+        simulator = PickerSimulator(300, piece_length=2 * REQUEST_SIZE,
+                                    connected=20, seed=1)
+        report = asyncio.run(simulator.run(operations=10**5))
+        self.assertEqual(report['completed_pieces'], 300)
+        self.assertGreater(report['peers_seen'], 20) # Peers were replaced
+        for call in ('init', 'next_request', 'block_received', 'add_peer',
+                     'remove_peer'):
+            self.assertGreater(report['calls'][call]['count'], 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+
+import asyncio
+import unittest
+from .piece_cache import PieceCache
+
+
+class FakeDisk:
+    def __init__(self, size):
+        self.data = bytes(i % 251 for i in range(size))
+        self.reads = []
+
+    def read(self, pos, length):
+        self.reads.append((pos, length))
+        return self.data[pos:pos + length]
+
+
+class TestPieceCache(unittest.TestCase):
+    def setUp(self):
+        self.disk = FakeDisk(10 * 100 + 50)
+        self.cache = PieceCache(self.disk.read, 100, len(self.disk.data),
+                                max_bytes=300, read_ahead=2)
+
+    def _piece(self, idx):
+        return asyncio.run(self.cache.piece(idx))
+
+    def test_hit_after_miss(self):
+        self.assertEqual(self._piece(3), self.disk.data[300:400])
+        self.assertEqual(self._piece(3), self.disk.data[300:400])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(len(self.disk.reads), 1)
+
+    def test_last_piece_length(self):
+        self.assertEqual(self._piece(10), self.disk.data[1000:])
+
+    def test_lru_eviction(self):
+        for idx in (0, 5, 7):
+            self._piece(idx)
+        self._piece(0)
+        self._piece(9) # Evicts 5, the least recently used
+        self.assertIsNone(self.cache.get(5))
+        self.assertIsNotNone(self.cache.get(0))
+        self.assertLessEqual(self.cache.size, 300)
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_sequential_read_ahead(self):
+        self._piece(0)
+        self._piece(1) # Sequential, reads 1, 2 and 3 at once
+        self.assertEqual(self.disk.reads[-1], (100, 300))
+        self._piece(2)
+        self._piece(3)
+        self.assertEqual(len(self.disk.reads), 2)
+        self.assertEqual(self.cache.hits, 2)
+
+    def test_short_read_is_not_cached(self):
+        self.disk.data = self.disk.data[:250]
+        self.assertIsNone(self._piece(4))
+        self.assertIsNone(self.cache.get(4))
+
+    def test_put_replaces_and_invalidate(self):
+        self._piece(1)
+        self.cache.put(1, b'x' * 100)
+        self.assertEqual(self._piece(1), b'x' * 100)
+        self.cache.invalidate(1)
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(self.cache.size, 0)
+
+if __name__ == "__main__":
+    unittest.main()
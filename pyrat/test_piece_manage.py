@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+
+import asyncio
+import threading
+import unittest
+from .piece_manage import PiecesManager, FILE_SKIP, FILE_LOW, FILE_HIGH, \
+    MAX_STRIKES
+from .protocol import REQUEST_SIZE
+from .storage import NullStorage
+from .torrent_file import SyntheticTorrent
+
+
+def _manager(pieces: int = 100) -> PiecesManager:
+    # One block per piece
+    return PiecesManager(SyntheticTorrent(pieces, REQUEST_SIZE),
+                         storage=NullStorage())
+
+
+class TestStreaming(unittest.TestCase):
+    def test_window_in_deadline_order(self):
+        manager = _manager()
+        manager.add_seed('seed')
+        manager.set_streaming(window=4)
+        manager.seek(10 * REQUEST_SIZE + 5)
+        picked = [manager.next_request('seed').piece_idx for _ in range(5)]
+        self.assertEqual(picked[:4], [10, 11, 12, 13])
+        self.assertNotIn(picked[4], range(10, 14)) # Rarest first again
+        manager.close()
+
+    def test_slow_peers_wait_for_due_pieces(self):
+        manager = _manager()
+        manager.add_seed('fast')
+        manager.add_seed('slow')
+        manager.set_streaming(window=4, piece_time=60)
+        manager.set_fast_peers(['fast'])
+        self.assertEqual(manager.next_request('slow').piece_idx, 0) # Due
+        self.assertNotIn(manager.next_request('slow').piece_idx, range(4))
+        self.assertEqual(manager.next_request('fast').piece_idx, 1)
+        manager.close()
+
+    def test_read_waits_for_range(self):
+        async def main():
+            manager = _manager()
+            manager.add_seed('seed')
+            reader = asyncio.ensure_future(
+                manager.read(50 * REQUEST_SIZE - 10, 20))
+            await asyncio.sleep(0)
+            for _ in range(2): # The waited pieces come first
+                block = manager.next_request('seed')
+                self.assertIn(block.piece_idx, (49, 50))
+                self.assertFalse(reader.done())
+                manager.block_received('seed', block.piece_idx, block.offset,
+                                       bytes(block.length))
+            data = await asyncio.wait_for(reader, 1)
+            manager.close()
+            return data
+        self.assertEqual(asyncio.run(main()), bytes(20))
+
+
+class TestFilePriorities(unittest.TestCase):
+    def test_priorities(self):
+        # Pieces 0-1 are file0 only, 2 is shared, 3-5 file1 only, 6 file2
+        torrent = SyntheticTorrent.with_files(
+            [REQUEST_SIZE * 2 + 100, REQUEST_SIZE * 4 - 100, REQUEST_SIZE],
+            REQUEST_SIZE)
+        manager = PiecesManager(torrent, storage=NullStorage(),
+                                file_priorities=[FILE_SKIP, FILE_LOW,
+                                                 FILE_HIGH])
+        manager.add_seed('seed')
+        picked = []
+        while True:
+            block = manager.next_request('seed')
+            if block is None:
+                break
+            picked.append(block.piece_idx)
+            manager.block_received('seed', block.piece_idx, block.offset,
+                                   bytes(block.length))
+        self.assertEqual(picked[0], 6) # High first
+        self.assertEqual(sorted(picked), [2, 3, 4, 5, 6]) # Shared included
+        self.assertTrue(manager.complete)
+        self.assertFalse(manager.have_all)
+        asyncio.run(manager.set_file_priorities([FILE_LOW, FILE_LOW,
+                                                 FILE_LOW]))
+        self.assertFalse(manager.complete)
+        self.assertEqual(manager.next_request('seed').piece_idx // 2, 0)
+        manager.close()
+
+
+class TestPeers(unittest.TestCase):
+    def test_have_out_of_range_ignored(self):
+        manager = _manager(pieces=4)
+        manager.add_seed('seed')
+        manager.add_peer('peer', [0, 1])
+        for peer_id in ('seed', 'peer', 'new'):
+            manager.update_peer(peer_id, 4)
+            manager.update_peer(peer_id, -1)
+        manager.update_peer('peer', 2)
+        self.assertEqual(manager.next_request('peer').piece_idx, 1)
+        self.assertIsNone(manager.next_request('new'))
+        manager.close()
+
+
+class TestMemoryBudget(unittest.TestCase):
+    def test_requests_wait_for_written_pieces(self):
+        written = threading.Event()
+        class SlowStorage(NullStorage):
+            def write(self, pos, data):
+                written.wait(5)
+        async def main():
+            # The first piece is opened whatever the budget
+            manager = PiecesManager(SyntheticTorrent(4, REQUEST_SIZE),
+                                    storage=SlowStorage(),
+                                    max_buffer=REQUEST_SIZE // 2)
+            manager.add_seed('seed')
+            block = manager.next_request('seed')
+            self.assertIsNone(manager.next_request('seed'))
+            self.assertTrue(manager.backpressure)
+            room = asyncio.ensure_future(manager.wait_for_room())
+            manager.block_received('seed', block.piece_idx, block.offset,
+                                   bytes(block.length))
+            # Queued for writing it still counts
+            await asyncio.sleep(0.05)
+            self.assertFalse(room.done())
+            self.assertEqual(manager.buffered_bytes, REQUEST_SIZE)
+            written.set()
+            await asyncio.wait_for(room, 5)
+            self.assertEqual(manager.buffered_bytes, 0)
+            self.assertFalse(manager.backpressure)
+            self.assertIsNotNone(manager.next_request('seed'))
+            manager.close()
+        asyncio.run(main())
+
+    def test_piece_not_fitting_raises_backpressure(self):
+        async def main():
+            # One piece fits, not two
+            manager = PiecesManager(SyntheticTorrent(4, REQUEST_SIZE),
+                                    storage=NullStorage(),
+                                    max_buffer=REQUEST_SIZE * 3 // 2)
+            manager.add_seed('seed')
+            block = manager.next_request('seed')
+            self.assertIsNone(manager.next_request('seed'))
+            # Else the connection would not wait and never ask again
+            self.assertTrue(manager.backpressure)
+            room = asyncio.ensure_future(manager.wait_for_room())
+            await asyncio.sleep(0)
+            self.assertFalse(room.done())
+            manager.block_received('seed', block.piece_idx, block.offset,
+                                   bytes(block.length))
+            await asyncio.wait_for(room, 5)
+            self.assertIsNotNone(manager.next_request('seed'))
+            manager.close()
+        asyncio.run(main())
+
+    def test_dropped_peer_gives_back_its_pieces(self):
+        manager = PiecesManager(SyntheticTorrent(4, 2 * REQUEST_SIZE),
+                                storage=NullStorage())
+        manager.add_seed('started')
+        manager.add_seed('empty')
+        first = manager.next_request('started')
+        manager.next_request('started')
+        manager.block_received('started', first.piece_idx, first.offset,
+                               bytes(first.length))
+        other = manager.next_request('empty')
+        self.assertNotEqual(other.piece_idx, first.piece_idx)
+        self.assertEqual(manager.buffered_bytes, 4 * REQUEST_SIZE)
+        manager.remove_peer('empty')
+        self.assertEqual(manager.buffered_bytes, 2 * REQUEST_SIZE)
+        # The received block is kept, the piece is finished by others
+        manager.remove_peer('started')
+        self.assertEqual(manager.buffered_bytes, 2 * REQUEST_SIZE)
+        manager.add_seed('next')
+        block = manager.next_request('next')
+        self.assertEqual((block.piece_idx, block.offset),
+                         (first.piece_idx, REQUEST_SIZE))
+        manager.close()
+
+    def test_corrupt_piece_gives_back_its_budget(self):
+        manager = _manager()
+        manager.add_seed('bad')
+        block = manager.next_request('bad')
+        manager.block_received('bad', block.piece_idx, block.offset,
+                               b'x' * block.length)
+        self.assertFalse(manager.have(block.piece_idx))
+        self.assertEqual(manager.buffered_bytes, 0)
+        manager.close()
+
+
+class TestHashFailures(unittest.TestCase):
+    def _manager(self, blocks: int):
+        self.blamed = []
+        manager = PiecesManager(
+            SyntheticTorrent(4, blocks * REQUEST_SIZE), storage=NullStorage(),
+            on_corrupt=lambda *args: self.blamed.append(args))
+        for peer_id in ('good', 'bad', 'other'):
+            manager.add_seed(peer_id)
+        return manager
+
+    def _send(self, manager, peer_id, block, corrupt=False):
+        data = b'x' * block.length if corrupt else bytes(block.length)
+        manager.block_received(peer_id, block.piece_idx, block.offset, data)
+
+    def test_sole_sender_blamed(self):
+        manager = self._manager(blocks=1)
+        for strike in range(1, MAX_STRIKES + 1):
+            block = manager.next_request('bad')
+            self._send(manager, 'bad', block, corrupt=True)
+            self.assertEqual(self.blamed[-1],
+                             ('bad', strike == MAX_STRIKES))
+        self.assertTrue(manager.banned('bad'))
+        manager.update_peer('bad', 3) # A Have does not bring it back
+        self.assertIsNone(manager.next_request('bad'))
+        manager.close()
+
+    def test_shared_piece_isolated(self):
+        manager = self._manager(blocks=2)
+        first = manager.next_request('good')
+        second = manager.next_request('bad')
+        self.assertEqual(first.piece_idx, second.piece_idx)
+        self._send(manager, 'good', first)
+        self._send(manager, 'bad', second, corrupt=True)
+        self.assertEqual(self.blamed, []) # Nobody can tell yet
+        # The piece now comes from the first peer asking for it
+        blocks = [manager.next_request('good'), manager.next_request('good')]
+        self.assertEqual({block.piece_idx for block in blocks},
+                         {first.piece_idx})
+        other = manager.next_request('other')
+        self.assertNotEqual(other.piece_idx, first.piece_idx)
+        self._send(manager, 'other', blocks[1]) # Not its piece, ignored
+        for block in blocks:
+            self._send(manager, 'good', block)
+        self.assertTrue(manager.have(first.piece_idx))
+        self.assertEqual(self.blamed, [('bad', True)])
+        manager.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+
+import asyncio
+import unittest
+from .piece_manage import PiecesManager
+from .protocol import Handshake, PeerStreamIterator, HaveAll, HaveNone, \
+    RejectRequest, AllowedFast, Request, Interested, Unchoke, Choke, Piece, \
+    Have, Extended, PeerConnection, REQUEST_SIZE, allowed_fast_set
+from .pex import EXTENSION_HANDSHAKE, UT_PEX, PexState, decode_payload
+from .storage import NullStorage
+from .torrent_file import SyntheticTorrent
+
+
+class TestFastExtension(unittest.TestCase):
+    def test_handshake_advertises_fast(self):
+        data = Handshake(b'i' * 20, b'p' * 20).encode()
+        self.assertTrue(Handshake.decode(data).supports_fast)
+
+    def test_messages_are_parsed(self):
+        stream = PeerStreamIterator(None, HaveAll().encode() +
+                                    HaveNone().encode() +
+                                    RejectRequest(1, 2, 3).encode() +
+                                    AllowedFast(7).encode() +
+                                    Request(1, 2, 3).encode())
+        msgs = [stream.parse() for _ in range(5)]
+        self.assertEqual([type(msg) for msg in msgs],
+                         [HaveAll, HaveNone, RejectRequest, AllowedFast,
+                          Request])
+        self.assertEqual((msgs[2].index, msgs[2].begin, msgs[2].length),
+                         (1, 2, 3))
+        self.assertEqual(msgs[3].index, 7)
+        self.assertIsNone(stream.parse())
+
+    def test_allowed_fast_set(self):
+        # Example of BEP 6
+        self.assertEqual(
+            allowed_fast_set('80.4.4.200', b'\xaa' * 20, 1313, 7),
+            [1059, 431, 808, 1217, 287, 376, 1188])
+        self.assertEqual(
+            allowed_fast_set('80.4.4.200', b'\xaa' * 20, 1313, 9)[7:],
+            [353, 508])
+        self.assertEqual(len(allowed_fast_set('10.0.0.1', b'a' * 20, 3)), 3)
+
+
+class TestServing(unittest.TestCase):
+    """
+    A seeding connection driven by a remote peer speaking the protocol
+    """
+
+    async def _next(self, stream, kind):
+        # Skips the bitfield, allowed fast and other messages meanwhile
+        async def find():
+            async for msg in stream:
+                if type(msg) is kind:
+                    return msg
+        return await asyncio.wait_for(find(), 5)
+
+    def _exchange(self, talk, on_peers=None):
+        """
+        Run `talk(torrent, manager, conns, reader, writer)` once the
+        handshakes are exchanged
+        """
+        async def main():
+            torrent = SyntheticTorrent(100, REQUEST_SIZE)
+            manager = PiecesManager(torrent, storage=NullStorage())
+            for piece_idx in range(torrent.total_pieces):
+                manager.mark_have(piece_idx)
+            conns = []
+            server = await asyncio.start_server(
+                lambda reader, writer: conns.append(PeerConnection(
+                    None, torrent.hash, b'l' * 20, manager, 0,
+                    incoming=(reader, writer), on_peers=on_peers)),
+                '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            try:
+                writer.write(Handshake(torrent.hash, b'r' * 20).encode() +
+                             Interested().encode())
+                handshake = await reader.readexactly(Handshake.length)
+                self.assertTrue(Handshake.decode(handshake).supports_fast)
+                await talk(torrent, manager, conns, reader, writer)
+            finally:
+                writer.close()
+                for conn in conns:
+                    conn.stop()
+                server.close()
+                manager.close()
+        asyncio.run(main())
+
+    def test_choked_requests_refused(self):
+        async def talk(torrent, manager, conns, reader, writer):
+            stream = PeerStreamIterator(reader)
+            allowed = allowed_fast_set('127.0.0.1', torrent.hash,
+                                       torrent.total_pieces)
+            index = min(set(range(torrent.total_pieces)) - set(allowed))
+            writer.write(Request(index, 0, REQUEST_SIZE).encode())
+            rejected = await self._next(stream, RejectRequest)
+            self.assertEqual((rejected.index, rejected.begin), (index, 0))
+            # Allowed fast pieces are served while choked
+            writer.write(Request(allowed[0], 0, REQUEST_SIZE).encode())
+            piece = await self._next(stream, Piece)
+            self.assertEqual(piece.index, allowed[0])
+            conn = conns[0]
+            self.assertTrue(conn.peer_interested)
+            conn.unchoke()
+            await self._next(stream, Unchoke)
+            writer.write(Request(index, 0, REQUEST_SIZE).encode())
+            piece = await self._next(stream, Piece)
+            self.assertEqual((piece.index, len(piece.block)),
+                             (index, REQUEST_SIZE))
+            self.assertEqual(conn.upload_rate.total, 2 * REQUEST_SIZE)
+            self.assertEqual(manager.bytes_uploaded, 2 * REQUEST_SIZE)
+            conn.choke()
+            await self._next(stream, Choke)
+        self._exchange(talk)
+
+    def test_have_out_of_range_drops_peer(self):
+        async def talk(torrent, manager, conns, reader, writer):
+            writer.write(HaveAll().encode() +
+                         Have(torrent.total_pieces).encode())
+            async def closed():
+                while await reader.read(2**16):
+                    pass
+            await asyncio.wait_for(closed(), 5)
+            self.assertFalse(conns[0].connected)
+            self.assertIsNotNone(conns[0].future) # Not crashed
+        self._exchange(talk)
+
+    def test_pex_only_when_enabled(self):
+        learned = []
+        extensions = []
+        pex = PexState().message([('10.0.0.1', 6881)])
+        async def talk(torrent, manager, conns, reader, writer):
+            stream = PeerStreamIterator(reader)
+            msg = await self._next(stream, Extended)
+            self.assertEqual(msg.ext_id, EXTENSION_HANDSHAKE)
+            extensions.append(decode_payload(msg.payload)[b'm'])
+            writer.write(Extended(UT_PEX, pex).encode())
+            await asyncio.sleep(0.05)
+        self._exchange(talk, on_peers=learned.extend)
+        self.assertEqual(extensions[0], {b'ut_pex': UT_PEX})
+        self.assertEqual(learned, [('10.0.0.1', 6881)])
+        # Private torrents give no callback, PEX is off
+        self._exchange(talk)
+        self.assertEqual(extensions[1], {})
+        self.assertEqual(learned, [('10.0.0.1', 6881)])
+
+if __name__ == "__main__":
+    unittest.main()
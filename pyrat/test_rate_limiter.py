@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+
+import asyncio
+import time
+import unittest
+from .rate_limiter import TokenBucket, Throttle
+
+
+async def _transfer(throttle, total: int, block: int = 2**14):
+    sent = 0
+    while sent < total:
+        await throttle.acquire(block)
+        sent += block
+    return time.monotonic()
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_unlimited_does_not_wait(self):
+        async def main():
+            throttle = Throttle(TokenBucket(), TokenBucket())
+            self.assertFalse(throttle.limited)
+            start = time.monotonic()
+            await _transfer(throttle, 2**30)
+            return time.monotonic() - start
+        self.assertLess(asyncio.run(main()), 1)
+
+    def test_rate(self):
+        async def main():
+            bucket = TokenBucket(2**20, burst=2**15)
+            start = time.monotonic()
+            await _transfer(bucket, 2**19)
+            return time.monotonic() - start
+        self.assertAlmostEqual(asyncio.run(main()), 0.5, delta=0.15)
+
+    def test_hierarchy_and_fairness(self):
+        async def main():
+            shared = TokenBucket(2**20, burst=2**15)
+            slow = Throttle(TokenBucket(2**18), shared)
+            fast = Throttle(TokenBucket(), shared)
+            start = time.monotonic()
+            ends = await asyncio.gather(_transfer(slow, 2**17),
+                                        _transfer(fast, 2**18))
+            return [end - start for end in ends]
+        slow, fast = asyncio.run(main())
+        self.assertAlmostEqual(slow, 0.5, delta=0.15) # Its own limit
+        self.assertLess(fast, 0.5) # Gets what the slow one leaves
+
+    def test_rate_change_releases_waiters(self):
+        async def main():
+            bucket = TokenBucket(1000, burst=1000)
+            await bucket.acquire(10**6) # Deep in debt
+            waiter = asyncio.ensure_future(bucket.acquire(1))
+            await asyncio.sleep(0.01)
+            self.assertFalse(waiter.done())
+            bucket.rate = 0
+            await asyncio.wait_for(waiter, 1)
+        asyncio.run(main())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+
+import asyncio
+import os
+import socket
+import tempfile
+import unittest
+from .make_torrent import make_torrent
+from .protocol import Handshake
+from .session import ConnectionBudget, Session
+
+
+class TestConnectionBudget(unittest.TestCase):
+    def test_freed_slots_go_round_robin(self):
+        async def main():
+            budget = ConnectionBudget(2)
+            await budget.acquire('a')
+            await budget.acquire('a')
+            granted = []
+            async def wait(owner):
+                await budget.acquire(owner)
+                granted.append(owner)
+            # The busy torrent asked first and three times
+            waiters = [asyncio.ensure_future(wait(owner))
+                       for owner in ('a', 'a', 'a', 'b')]
+            await asyncio.sleep(0)
+            self.assertFalse(budget.try_acquire())
+            for _ in range(4):
+                budget.release()
+                await asyncio.sleep(0)
+            await asyncio.gather(*waiters)
+            self.assertEqual(granted, ['a', 'b', 'a', 'a'])
+            self.assertEqual(budget.used, 2)
+        asyncio.run(main())
+
+    def test_cancelled_waiter_gives_slot_on(self):
+        async def main():
+            budget = ConnectionBudget(1)
+            await budget.acquire('a')
+            waiter = asyncio.ensure_future(budget.acquire('b'))
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.gather(waiter, return_exceptions=True)
+            budget.release()
+            self.assertEqual(budget.used, 0)
+            self.assertTrue(budget.try_acquire())
+        asyncio.run(main())
+
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        data = os.path.join(self._dir.name, 'data.bin')
+        with open(data, 'wb') as f:
+            f.write(os.urandom(50000))
+        self.torrent_file = os.path.join(self._dir.name, 'data.torrent')
+        make_torrent(data, output=self.torrent_file, workers=1)
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    async def _handshake(self, port, info_hash):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(Handshake(info_hash, b'r' * 20).encode())
+        try:
+            data = await asyncio.wait_for(reader.read(Handshake.length), 5)
+        finally:
+            writer.close()
+        return Handshake.decode(data)
+
+    def test_incoming_routed_by_info_hash(self):
+        async def main():
+            session = Session(port=0, dht=False, utp=False, lsd=False,
+                              state_dir=None)
+            await session.start()
+            # Bound on every interface, each with its own port
+            port = [sock.getsockname()[1] for sock in session._server.sockets
+                    if sock.family == socket.AF_INET][0]
+            client = session.add_torrent(self.torrent_file, seed=True,
+                                         download_dir=self._dir.name)
+            try:
+                response = await self._handshake(port, client.info_hash)
+                self.assertEqual(response.info_hash, client.info_hash)
+                # Nobody serves an unknown torrent
+                self.assertIsNone(await self._handshake(port, b'u' * 20))
+                await asyncio.sleep(0.05)
+                self.assertEqual(session.connections.used, 0)
+            finally:
+                await session.close()
+            self.assertEqual(session.torrents, [])
+            self.assertTrue(session.http_client.closed)
+            self.assertTrue(session.web_seed_client.closed)
+        asyncio.run(main())
+
+
+if __name__ == '__main__':
+    unittest.main()
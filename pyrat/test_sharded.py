@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from . import sharded
+from .make_torrent import make_torrent
+from .piece_manage import PiecesManager
+from .protocol import REQUEST_SIZE
+from .sharded import ShardedClient, ShardTable
+from .storage import NullStorage
+from .torrent_file import SyntheticTorrent
+
+
+class TestShardTable(unittest.TestCase):
+    def setUp(self):
+        self.table = ShardTable(10, 2)
+        self.first = self.table.view(0)
+        self.second = self.table.view(1)
+
+    def test_claims(self):
+        self.assertTrue(self.first.claim(3))
+        self.assertFalse(self.second.claim(3))
+        self.assertTrue(self.first.claim(3))
+        self.second.release(3) # Not its own
+        self.assertFalse(self.second.claim(3))
+        self.first.release(3)
+        self.assertTrue(self.second.claim(3))
+
+    def test_silent_owner_loses_claim(self):
+        self.assertTrue(self.first.claim(3))
+        self.addCleanup(setattr, sharded, 'CLAIM_TIMEOUT',
+                        sharded.CLAIM_TIMEOUT)
+        sharded.CLAIM_TIMEOUT = 0
+        self.assertTrue(self.second.claim(3))
+
+    def test_completed_log(self):
+        self.first.claim(3)
+        self.first.complete(3)
+        self.first.complete(3)
+        self.second.complete(5)
+        self.assertFalse(self.second.claim(3))
+        self.assertEqual(self.second.completed(), [3, 5])
+        self.assertEqual(self.second.completed(), [])
+        self.assertEqual(self.table.completed_pieces, 2)
+        self.assertFalse(self.table.finished)
+
+    def test_peers_handed_in_turn(self):
+        self.table.add_peers([('10.0.0.{}'.format(i), 6881)
+                              for i in range(5)])
+        first = self.first.take_peers()
+        second = self.second.take_peers()
+        self.assertEqual([len(peers) for peers, _ in first + second], [3, 2])
+        self.assertEqual(self.first.take_peers(), [])
+
+
+class TestShardedPieces(unittest.TestCase):
+    def test_managers_split_pieces(self):
+        torrent = SyntheticTorrent(6, REQUEST_SIZE)
+        table = ShardTable(torrent.total_pieces, 2)
+        views = [table.view(0), table.view(1)]
+        managers = [PiecesManager(torrent, storage=NullStorage(),
+                                  claims=view) for view in views]
+        for manager in managers:
+            manager.add_seed('seed')
+        blocks = [[], []]
+        for _ in range(3):
+            for shard, manager in enumerate(managers):
+                blocks[shard].append(manager.next_request('seed'))
+        picked = [{block.piece_idx for block in shard_blocks}
+                  for shard_blocks in blocks]
+        self.assertFalse(picked[0] & picked[1])
+        self.assertEqual(len(picked[0] | picked[1]), 6)
+        for block in blocks[0]:
+            managers[0].block_received('seed', block.piece_idx, block.offset,
+                                       bytes(block.length))
+        managers[0].close() # Once written
+        self.assertEqual(sorted(views[1].completed()), sorted(picked[0]))
+        for piece_idx in picked[0]:
+            managers[1].mark_have(piece_idx)
+        self.assertEqual(managers[1].completed_pieces, 3)
+        self.assertFalse(managers[1].complete)
+        managers[1].close()
+
+    def _complete_piece(self, storage):
+        torrent = SyntheticTorrent(1, REQUEST_SIZE)
+        table = ShardTable(torrent.total_pieces, 1)
+        manager = PiecesManager(torrent, storage=storage,
+                                claims=table.view(0))
+        manager.add_seed('seed')
+        block = manager.next_request('seed')
+        manager.block_received('seed', block.piece_idx, block.offset,
+                               bytes(block.length))
+        self.assertTrue(manager.complete)
+        return table, manager
+
+    def test_completion_published_once_written(self):
+        # Other shards read the piece from disk
+        written = threading.Event()
+        class SlowStorage(NullStorage):
+            def write(self, pos, data):
+                written.wait(5)
+        table, manager = self._complete_piece(SlowStorage())
+        self.assertEqual(table.completed_pieces, 0)
+        written.set()
+        manager.close()
+        self.assertTrue(table.finished)
+
+    def test_failed_write_not_published(self):
+        class FailingStorage(NullStorage):
+            def write(self, pos, data):
+                raise OSError("No space left on device")
+        with self.assertLogs(level='ERROR'):
+            table, manager = self._complete_piece(FailingStorage())
+            manager.close()
+        self.assertEqual(table.completed_pieces, 0)
+
+
+class FakeProcess:
+    def __init__(self, lifetime: float):
+        self._end = time.monotonic() + lifetime
+        self.terminated = False
+
+    def is_alive(self):
+        return not self.terminated and time.monotonic() < self._end
+
+    def terminate(self):
+        self.terminated = True
+
+
+class TestShardedClient(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        data = os.path.join(self._dir.name, 'data.bin')
+        with open(data, 'wb') as f:
+            f.write(os.urandom(50000))
+        self.torrent_file = os.path.join(self._dir.name, 'data.torrent')
+        make_torrent(data, output=self.torrent_file, workers=1)
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_stop_waits_on_the_loop(self):
+        async def main():
+            client = ShardedClient(self.torrent_file, shards=2, lsd=False,
+                                   state_dir=None,
+                                   download_dir=self._dir.name)
+            client._processes = [FakeProcess(0.1), FakeProcess(60)]
+            ticks = 0
+            stopping = client.stop()
+            while not stopping.done():
+                await asyncio.sleep(0.01)
+                ticks += 1
+            self.assertIs(client.stop(), stopping)
+            return client._processes, ticks
+        with mock.patch('pyrat.sharded.STOP_TIMEOUT', 0.3):
+            (stopped, hung), ticks = asyncio.run(main())
+        self.assertFalse(stopped.terminated)
+        self.assertTrue(hung.terminated)
+        self.assertGreater(ticks, 10) # The loop kept running
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+
+import os
+import tempfile
+import unittest
+from .storage import FileStorage
+from .torrent_file import SyntheticTorrent
+
+
+class TestFileStorage(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.directory = self._dir.name
+        # Pieces of 8 bytes: file0 is on piece 0 and 1, file1 on 1 and 2
+        self.torrent = SyntheticTorrent.with_files([10, 10, 4], 8, 'data')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _path(self, idx):
+        return os.path.join(self.directory, 'data', 'file{}'.format(idx))
+
+    def test_spans_files_created_lazily(self):
+        storage = FileStorage(self.torrent, self.directory)
+        self.assertFalse(storage.has(0, 24))
+        self.assertEqual(storage.open_files, 0)
+        self.assertFalse(os.path.exists(self._path(0)))
+        storage.write(0, bytes(range(12)))
+        self.assertEqual(storage.open_files, 2)
+        self.assertFalse(os.path.exists(self._path(2)))
+        self.assertEqual(storage.read(8, 4), bytes([8, 9, 10, 11]))
+        self.assertEqual(storage.read(20, 4), bytes(4)) # Not created
+        storage.close()
+        with open(self._path(1), 'rb') as f:
+            self.assertEqual(f.read(), bytes([10, 11]))
+
+    def test_skipped_file_parts(self):
+        storage = FileStorage(self.torrent, self.directory)
+        storage.write(0, bytes(range(8)))
+        storage.set_skipped([1])
+        storage.write(8, bytes(range(8, 16))) # Piece 1 is shared
+        self.assertFalse(os.path.exists(self._path(1)))
+        self.assertEqual(storage.read(8, 8), bytes(range(8, 16)))
+        self.assertTrue(storage.has(8, 8))
+        storage.set_skipped([]) # Its part moves to the file
+        self.assertEqual(storage.read(8, 8), bytes(range(8, 16)))
+        storage.close()
+        with open(self._path(1), 'rb') as f:
+            self.assertEqual(f.read(6), bytes(range(10, 16)))
+
+    def test_skipped_file_keeps_its_data(self):
+        # Pieces of 4 bytes: file1 has piece 3 to itself
+        torrent = SyntheticTorrent.with_files([10, 10, 4], 4, 'data')
+        storage = FileStorage(torrent, self.directory)
+        data = bytes(range(24))
+        storage.write(0, data)
+        storage.set_skipped([1])
+        self.assertEqual(storage.read(0, 24), data)
+        self.assertTrue(storage.has(0, 24))
+        storage.set_skipped([])
+        self.assertEqual(storage.read(0, 24), data)
+        storage.close()
+        with open(self._path(1), 'rb') as f:
+            self.assertEqual(f.read(), data[10:20])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+#!/usr/bin/python3
+
+import asyncio
+import unittest
+from urllib.parse import urlencode
+from .protocol import Handshake, Piece, Have
+from .swarm_bench import FakeTracker, PeerProfile, PeerProxy, run_swarm
+
+
+class TestSwarmBench(unittest.TestCase):
+    def test_proxy_corrupts_blocks_only(self):
+        proxy = PeerProxy(0, PeerProfile(corrupt=1))
+        framer = proxy._frames()
+        next(framer)
+        block = bytes(2**14)
+        stream = Handshake(bytes(20), bytes(20)).encode() + \
+            Have(3).encode() + Piece(3, 0, block).encode()
+        out = framer.send((stream[:70], 1)) + framer.send((stream[70:], 1))
+        self.assertEqual(len(out), len(stream))
+        self.assertEqual(out[:-1], stream[:-1])
+        self.assertNotEqual(out[-1], stream[-1])
+        self.assertEqual(proxy.corrupted, 1)
+
+    def test_tracker_decodes_form_encoding(self):
+        tracker = FakeTracker()
+        info_hash = b' +' + bytes(18) # Sent as '+%2B'
+        tracker._announce(urlencode({'info_hash': info_hash,
+                                     'port': 6881}).encode())
+        self.assertEqual(tracker.registered(info_hash), 1)
+
+    def test_swarm(self):
+        report = asyncio.run(run_swarm(
+            seeders=1, leechers=2, size=2**20 + 1000,
+            piece_length=2**16, timeout=30,
+            profiles={'seeder0': PeerProfile(corrupt=0.01)}))
+        self.assertEqual(report['completed'], 2)
+        self.assertIsNotNone(report['first_piece'])
+        self.assertGreater(report['mb_per_s'], 0)
+        self.assertGreater(report['peak_rss_mb'], 0)
+
+if __name__ == "__main__":
+    unittest.main()
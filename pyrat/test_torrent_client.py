@@ -0,0 +1,40 @@
+#!/usr/bin/python3
+
+import asyncio
+import os
+import tempfile
+import unittest
+from .make_torrent import make_torrent
+from .torrent_client import TorrentClient
+
+
+class TestTorrentClient(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.data = os.path.join(self._dir.name, 'data.bin')
+        with open(self.data, 'wb') as f:
+            f.write(os.urandom(50000))
+        self.torrent_file = os.path.join(self._dir.name, 'data.torrent')
+        make_torrent(self.data, output=self.torrent_file, private=True,
+                     workers=1)
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_private_torrent_stops(self):
+        async def run():
+            # No DHT node is made for a private torrent, even when asked
+            client = TorrentClient(self.torrent_file, port=0, dht=True,
+                                   utp=False, lsd=False, state_dir=None,
+                                   download_dir=self._dir.name)
+            self.assertIsNone(client._dht)
+            self.assertIsNone(client._pex_callback) # Nor PEX
+            # The data is there, the download completes at once and stops
+            await client.start()
+            return client
+        client = asyncio.run(run())
+        self.assertTrue(client.stats()['complete'])
+
+
+if __name__ == '__main__':
+    unittest.main()
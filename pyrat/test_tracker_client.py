@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+
+import asyncio
+import socket
+import unittest
+from aiohttp import web
+from struct import pack
+from .announcer import Announcer
+from .torrent_file import SyntheticTorrent
+from .tracker_client import TrackerClient, TrackerResponce, \
+    parse_compact_peers
+
+
+class TestTrackerResponce(unittest.TestCase):
+    def test_compact_ipv4(self):
+        data = socket.inet_aton('10.0.0.1') + pack('>H', 6881) + \
+            socket.inet_aton('192.168.1.2') + pack('>H', 1) + b'\x01\x02'
+        self.assertEqual(parse_compact_peers(data),
+                         (('10.0.0.1', 6881), ('192.168.1.2', 1)))
+
+    def test_compact_ipv6(self):
+        data = socket.inet_pton(socket.AF_INET6, '2001:db8::1') + \
+            pack('>H', 51413)
+        self.assertEqual(parse_compact_peers(data, ipv6=True),
+                         (('2001:db8::1', 51413),))
+
+    def test_peers_and_peers6_are_merged_and_cached(self):
+        responce = TrackerResponce({
+            b'peers': socket.inet_aton('10.0.0.1') + pack('>H', 1),
+            b'peers6': socket.inet_pton(socket.AF_INET6, '::1') +
+                       pack('>H', 2)})
+        self.assertEqual(responce.peers, (('10.0.0.1', 1), ('::1', 2)))
+        self.assertIs(responce.peers, responce.peers)
+
+    def test_dict_peers(self):
+        responce = TrackerResponce({b'peers': [{b'ip': b'10.0.0.1',
+                                                b'port': 1,
+                                                b'peer id': b'x' * 20}]})
+        self.assertEqual(responce.peers, (('10.0.0.1', 1),))
+        self.assertIn('10.0.0.1', str(responce))
+
+
+class TestTrackerClient(unittest.TestCase):
+    def test_close_closes_own_session(self):
+        async def main():
+            tracker = TrackerClient(SyntheticTorrent(1, 2**14))
+            tracker.close()
+            await asyncio.sleep(0)
+            return tracker._http_client.closed
+        self.assertTrue(asyncio.run(main()))
+
+    def test_garbage_body(self):
+        async def main():
+            async def html(request):
+                return web.Response(text='<html>Busy</html>')
+            app = web.Application()
+            app.router.add_get('/announce', html)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+            tracker = TrackerClient(SyntheticTorrent(1, 2**14))
+            try:
+                return await tracker.announce(
+                    'http://127.0.0.1:{}/announce'.format(port))
+            finally:
+                tracker.close()
+                await runner.cleanup()
+        self.assertIsNone(asyncio.run(main()))
+
+
+class FailingClient:
+    async def announce(self, url, **kwargs):
+        raise RuntimeError("Can't find token b'e'.")
+
+
+class TestAnnouncer(unittest.TestCase):
+    def test_unexpected_error_backs_off(self):
+        async def main():
+            announcer = Announcer(FailingClient(), [['http://t/announce']],
+                                  lambda: (0, 0), None)
+            tracker = next(announcer.trackers)
+            self.assertFalse(await announcer._announce(tracker))
+            return tracker
+        tracker = asyncio.run(main())
+        self.assertEqual(tracker.failures, 1)
+        self.assertGreater(tracker.next_announce, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+
+import asyncio
+import socket
+import unittest
+from struct import pack, unpack_from
+
+from .udp_tracker import UDPTrackerClient, PROTOCOL_ID, MAX_SCRAPE, \
+    _TrackerProtocol
+
+
+class FakeUDPTracker(asyncio.DatagramProtocol):
+    """
+    Local stand-in tracker, drops the first `drop` packets it receives
+    and cuts the first `short` announce replies
+    """
+    CONNECTION_ID = 0x1122334455667788
+
+    def __init__(self, drop: int = 0, error: bytes = None, short: int = 0):
+        self.drop = drop
+        self.error = error
+        self.short = short
+        self.connects = 0
+        self.announces = []
+        self.scrape_packets = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.drop:
+            self.drop -= 1
+            return
+        connection_id, action, tid = unpack_from('>QII', data)
+        if action == 0:
+            assert connection_id == PROTOCOL_ID
+            self.connects += 1
+            reply = pack('>IIQ', 0, tid, self.CONNECTION_ID)
+        elif connection_id != self.CONNECTION_ID:
+            reply = pack('>II', 3, tid) + b'bad connection id'
+        elif self.error:
+            reply = pack('>II', 3, tid) + self.error
+        elif action == 1:
+            self.announces.append(unpack_from('>20s20sQQQIIIiH', data, 16))
+            reply = pack('>IIIII', 1, tid, 1800, 3, 7) + \
+                socket.inet_aton('10.0.0.1') + pack('>H', 6881) + \
+                socket.inet_aton('10.0.0.2') + pack('>H', 51413)
+            if self.short:
+                self.short -= 1
+                reply = reply[:12]
+        else:
+            self.scrape_packets += 1
+            hashes = [data[i:i + 20] for i in range(16, len(data), 20)]
+            reply = pack('>II', 2, tid) + b''.join(
+                pack('>III', h[0], h[1], h[2]) for h in hashes)
+        self.transport.sendto(reply, addr)
+
+
+class TestUDPTracker(unittest.TestCase):
+    def _run(self, tracker, scenario):
+        async def main():
+            loop = asyncio.get_event_loop()
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: tracker, local_addr=('127.0.0.1', 0))
+            port = transport.get_extra_info('sockname')[1]
+            client = UDPTrackerClient(timeout=0.05, max_retries=3)
+            try:
+                return await scenario(client,
+                                      'udp://127.0.0.1:{}/announce'.format(
+                                          port))
+            finally:
+                client.close()
+                transport.close()
+        return asyncio.run(main())
+
+    def test_announce(self):
+        tracker = FakeUDPTracker()
+
+        async def scenario(client, url):
+            return await client.announce(url, b'i' * 20,
+                                         '-PC0516-123456789012', 6889,
+                                         left=100, event='started')
+        response = self._run(tracker, scenario)
+        self.assertEqual(response.interval, 1800)
+        self.assertEqual(response.incomplete, 3)
+        self.assertEqual(response.complete, 7)
+        self.assertEqual(list(response.peers),
+                         [('10.0.0.1', 6881), ('10.0.0.2', 51413)])
+        info_hash, peer_id, _, left, _, event = tracker.announces[0][:6]
+        self.assertEqual((info_hash, left, event), (b'i' * 20, 100, 2))
+
+    def test_connection_id_is_cached(self):
+        tracker = FakeUDPTracker()
+
+        async def scenario(client, url):
+            for _ in range(3):
+                await client.announce(url, b'i' * 20, b'p' * 20, 6889)
+        self._run(tracker, scenario)
+        self.assertEqual(tracker.connects, 1)
+        self.assertEqual(len(tracker.announces), 3)
+
+    def test_retransmission(self):
+        tracker = FakeUDPTracker(drop=2)
+
+        async def scenario(client, url):
+            return await client.announce(url, b'i' * 20, b'p' * 20, 6889)
+        self.assertEqual(self._run(tracker, scenario).interval, 1800)
+
+    def test_no_answer(self):
+        tracker = FakeUDPTracker(drop=100)
+
+        async def scenario(client, url):
+            return await client.announce(url, b'i' * 20, b'p' * 20, 6889)
+        self.assertIsNone(self._run(tracker, scenario))
+
+    def test_short_reply(self):
+        async def scenario(client, url):
+            return await client.announce(url, b'i' * 20, b'p' * 20, 6889)
+        # Retransmitted like a lost packet
+        response = self._run(FakeUDPTracker(short=1), scenario)
+        self.assertEqual(response.interval, 1800)
+        self.assertIsNone(self._run(FakeUDPTracker(short=100), scenario))
+
+    def test_reply_from_other_address_ignored(self):
+        async def main():
+            protocol = _TrackerProtocol()
+            future = asyncio.get_event_loop().create_future()
+            protocol.transactions[5] = (('10.0.0.1', 80), future)
+            protocol.datagram_received(pack('>IIQ', 0, 5, 1),
+                                       ('10.0.0.2', 80))
+            self.assertFalse(future.done())
+            protocol.datagram_received(pack('>IIQ', 0, 5, 1),
+                                       ('10.0.0.1', 80))
+            self.assertEqual(future.result(), (0, pack('>Q', 1)))
+        asyncio.run(main())
+
+    def test_error(self):
+        tracker = FakeUDPTracker(error=b'torrent not registered')
+
+        async def scenario(client, url):
+            return await client.announce(url, b'i' * 20, b'p' * 20, 6889)
+        self.assertEqual(self._run(tracker, scenario).failure,
+                         'torrent not registered')
+
+    def test_batched_scrape(self):
+        tracker = FakeUDPTracker()
+        hashes = [bytes([i % 256, 1, 2]) + b'h' * 17
+                  for i in range(MAX_SCRAPE + 6)]
+
+        async def scenario(client, url):
+            return await client.scrape(url, hashes)
+        result = self._run(tracker, scenario)
+        self.assertEqual(tracker.scrape_packets, 2)
+        self.assertEqual(len(result), len(hashes))
+        self.assertEqual(result[hashes[5]],
+                         {'complete': 5, 'downloaded': 1, 'incomplete': 2})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+
+import asyncio
+import os
+import random
+import unittest
+from .utp import UTPSocket, UTPConnection, TARGET_DELAY, decode_packet, \
+    encode_packet, ST_DATA
+
+
+class LossySocket(UTPSocket):
+    """
+    Drops and delays outgoing datagrams to simulate a bad path
+    """
+    def __init__(self, loss: float = 0, delay: float = 0, **kwargs):
+        super().__init__(host='127.0.0.1', **kwargs)
+        self.loss = loss
+        self.delay = delay
+        self._random = random.Random(42)
+
+    def _sendto(self, data, addr):
+        if self._random.random() < self.loss:
+            return
+        if self.delay:
+            asyncio.get_event_loop().call_later(
+                self.delay, UTPSocket._sendto, self, data, addr)
+        else:
+            UTPSocket._sendto(self, data, addr)
+
+
+async def _transfer(size: int, loss: float = 0, delay: float = 0):
+    accepted = asyncio.get_event_loop().create_future()
+
+    async def on_accept(reader, writer):
+        accepted.set_result((reader, writer))
+
+    server = LossySocket(loss, delay, on_accept=on_accept)
+    client = LossySocket(loss, delay)
+    await server.start()
+    await client.start()
+    try:
+        reader, writer = await client.connect(('127.0.0.1', server.port))
+        peer_reader, peer_writer = await accepted
+        data = os.urandom(size)
+        writer.write(data)
+        await writer.drain()
+        writer.close()
+        received = await peer_reader.read()
+        peer_writer.write(b'bye')
+        peer_writer.close()
+        reply = await reader.read()
+        return data == received, reply
+    finally:
+        client.close()
+        server.close()
+
+
+class TestUTP(unittest.TestCase):
+    def test_packet_roundtrip(self):
+        data = encode_packet(ST_DATA, 7, 1, 2, 3, 4, 5, b'payload',
+                             sack=b'\x01\x00\x00\x00')
+        self.assertEqual(decode_packet(data),
+                         (ST_DATA, 7, 1, 2, 3, 4, 5, b'\x01\x00\x00\x00',
+                          b'payload'))
+        self.assertIsNone(decode_packet(b'd1:ad2:id20:'))
+
+    def test_transfer(self):
+        same, reply = asyncio.run(asyncio.wait_for(_transfer(2**20), 30))
+        self.assertTrue(same)
+        self.assertEqual(reply, b'bye')
+
+    def test_transfer_with_loss_and_delay(self):
+        same, reply = asyncio.run(asyncio.wait_for(
+            _transfer(200 * 1024, loss=0.1, delay=0.005), 60))
+        self.assertTrue(same)
+        self.assertEqual(reply, b'bye')
+
+    def test_connection_refused(self):
+        async def main():
+            server = LossySocket() # Doesn't accept connections
+            client = LossySocket()
+            await server.start()
+            await client.start()
+            try:
+                await client.connect(('127.0.0.1', server.port))
+            finally:
+                client.close()
+                server.close()
+        with self.assertRaises(ConnectionResetError):
+            asyncio.run(main())
+
+    def test_ledbat_window(self):
+        async def main():
+            conn = UTPConnection(None, ('127.0.0.1', 1), 1, 2, 1)
+            start = conn.cwnd
+            conn._update_window(1400, 0)
+            grown = conn.cwnd
+            conn._update_window(1400, 3 * TARGET_DELAY)
+            return start, grown, conn.cwnd
+        start, grown, shrunk = asyncio.run(main())
+        self.assertGreater(grown, start)
+        self.assertLess(shrunk, grown)
+
+if __name__ == "__main__":
+    unittest.main()
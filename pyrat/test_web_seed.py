@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+
+import asyncio
+import os
+import tempfile
+import unittest
+import aiohttp
+from aiohttp import web
+from .make_torrent import make_torrent
+from .piece_manage import PiecesManager
+from .torrent_file import TorrentInfo
+from .web_seed import WebSeed, file_urls
+
+
+class TestWebSeed(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.served = os.path.join(self._dir.name, 'served')
+        self.download = os.path.join(self._dir.name, 'download')
+        os.makedirs(os.path.join(self.served, 'data', 'sub'))
+        os.makedirs(self.download)
+        # Pieces of 16 KB straddle the files
+        self.contents = {'a.bin': os.urandom(50000),
+                         'sub/b c.bin': os.urandom(30000)}
+        for name, content in self.contents.items():
+            with open(os.path.join(self.served, 'data', name), 'wb') as f:
+                f.write(content)
+        self.torrent_file = os.path.join(self._dir.name, 'data.torrent')
+        make_torrent(os.path.join(self.served, 'data'),
+                     output=self.torrent_file, piece_length=2**14, workers=1,
+                     web_seeds=['http://127.0.0.1/'])
+        self.torrent = TorrentInfo(self.torrent_file)
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_file_urls(self):
+        self.assertEqual(self.torrent.url_list, ['http://127.0.0.1/'])
+        self.assertEqual(file_urls('http://host/seed', self.torrent),
+                         ['http://host/seed/data/a.bin',
+                          'http://host/seed/data/sub/b%20c.bin'])
+
+    async def _serve(self, handler=None):
+        requests = []
+        @web.middleware
+        async def count(request, handler):
+            requests.append(request.headers.get('Range'))
+            return await handler(request)
+        app = web.Application(middlewares=[count])
+        if handler:
+            app.router.add_get('/{path:.*}', handler)
+        else:
+            app.router.add_static('/', self.served) # Serves ranges
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return runner, 'http://127.0.0.1:{}/'.format(port), requests
+
+    def test_downloads_through_piece_manager(self):
+        async def main():
+            runner, url, requests = await self._serve()
+            manager = PiecesManager(self.torrent,
+                                    download_dir=self.download)
+            async with aiohttp.ClientSession() as client:
+                seed = WebSeed(url, self.torrent, manager, client,
+                               manager.block_received, connections=2)
+                seed.start()
+                for _ in range(100):
+                    if manager.complete:
+                        break
+                    await asyncio.sleep(0.05)
+                seed.stop()
+            manager.close()
+            await runner.cleanup()
+            return requests, seed.stats()
+        requests, stats = asyncio.run(main())
+        for name, content in self.contents.items():
+            with open(os.path.join(self.download, name), 'rb') as f:
+                self.assertEqual(f.read(), content)
+        # Runs of blocks, not one request per block
+        self.assertLess(len(requests), 80000 // 2**14)
+        self.assertTrue(all(requests))
+        self.assertEqual(stats['downloaded'], 80000)
+
+    def test_failures_release_blocks(self):
+        async def failing(request):
+            return web.Response(status=503)
+        async def main():
+            runner, url, requests = await self._serve(failing)
+            manager = PiecesManager(self.torrent,
+                                    download_dir=self.download)
+            async with aiohttp.ClientSession() as client:
+                seed = WebSeed(url, self.torrent, manager, client,
+                               manager.block_received, connections=1)
+                seed.start()
+                while not requests:
+                    await asyncio.sleep(0.01)
+                await asyncio.sleep(0.05)
+                pending = manager.pending_requests
+                stats = seed.stats()
+                seed.stop()
+            manager.close()
+            await runner.cleanup()
+            return pending, stats
+        pending, stats = asyncio.run(main())
+        self.assertEqual(pending, 0)
+        self.assertEqual(stats['failures'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
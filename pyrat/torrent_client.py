@@ -3,94 +3,512 @@
 
 import asyncio
 from hashlib import sha1
+import ipaddress
+import os
 import time
 
+import aiohttp
+
 from .tracker_client import TrackerClient
 from .torrent_file import TorrentInfo
-from .piece_manage import PiecesManager
+from .piece_manage import PiecesManager, STREAM_WINDOW
 from .protocol import PeerConnection
+from .choker import Choker
+from .peer_pool import PeerPool, PRIORITY_KNOWN, PRIORITY_DEFAULT, \
+    PRIORITY_LOCAL
+from .peer_store import PeerStore, STATE_DIR
+from .announcer import Announcer
+from .pex import PEX_INTERVAL
+from .dht import DHTNode
+from .lsd import LocalDiscovery
+from .utp import UTPSocket
+from .rate_limiter import TokenBucket
+from .web_seed import WebSeed, WEBSEED_CONNECTIONS
+from . import metrics
+from .events import BUS
 
 
 
-MAX_PEERS = 1
+MAX_PEERS = 30 # Outgoing connections
+MAX_INCOMING = 30 # Accepted connections
+LISTEN_PORT = 6889
+MAX_BUFFER = 256 * 2**20 # Bytes of piece data kept in memory
+STORE_SAVE_INTERVAL = 300
+DHT_INTERVAL = 15 * 60 # Between DHT announces
+STREAM_PEERS = 4 # Fastest peers the streaming window is asked from
 
 
 class TorrentClient:
-    def __init__(self, torrent_file):
+    def __init__(self, torrent_file, seed: bool = False,
+                 port: int = LISTEN_PORT, max_buffer: int = MAX_BUFFER,
+                 session=None, state_dir: str = STATE_DIR, dht: bool = True,
+                 utp: bool = True, download_rate: int = 0,
+                 upload_rate: int = 0, metrics_port: int = None,
+                 download_dir: str = '.', file_priorities: list = None,
+                 shard=None, lsd: bool = True):
         self._tinfo = TorrentInfo(torrent_file)
-        self._tracker = TrackerClient(self._tinfo)
-        self._peers_queue = asyncio.Queue()
+        # One of the processes of a sharded.ShardedClient: peers come from
+        # the coordinator and pieces are split through the shared table
+        self._shard = shard
+        # Peers are remembered across restarts unless state_dir is None
+        self._peer_store = PeerStore(self._tinfo.hash, state_dir) \
+            if state_dir else None
+        # A session owns the listening port and the pools shared by torrents
+        self._session = session
+        self._port = session.port if session else port
+        self._tracker = TrackerClient(
+            self._tinfo, port=self._port,
+            http_client=session.http_client if session else None,
+            udp_client=session.udp_client if session else None)
+        self._peers_queue = PeerPool()
+        # Bytes per second of the torrent, 0 is unlimited. A session adds
+        # its global limits on top.
+        self.download_limit = TokenBucket(download_rate)
+        self.upload_limit = TokenBucket(upload_rate)
+        self._peer_rates = (0, 0) # Download and upload limits of each peer
+        # uTP shares the UDP listening port with the DHT
+        self._utp = None
+        if session:
+            self._utp = session.utp
+        elif utp:
+            self._utp = UTPSocket(self._port, on_accept=self._on_incoming)
+        # Private torrents (BEP 27) only get peers from their trackers
+        private = self._tinfo.private
+        self._own_dht = False
+        self._dht = None
+        if session and not private:
+            self._dht = session.dht
+        elif dht and not private:
+            self._dht = DHTNode(self._port, state_path=os.path.join(
+                state_dir, 'dht') if state_dir else None)
+            self._own_dht = True
+        # LAN peers (BEP 14) are dialed before any other
+        self._own_lsd = False
+        self._lsd = None
+        if session and not private:
+            self._lsd = session.lsd
+        elif lsd and not private:
+            self._lsd = LocalDiscovery(self._port)
+            self._own_lsd = True
+        self._dht_future = None
+        self._announcer = Announcer(
+            self._tracker, self._tinfo.announce_tiers,
+            lambda: (self._piece_manager.bytes_uploaded,
+                     self._piece_manager.bytes_downloaded),
+            self._on_tracker_response)
         self._workers = list()
+        self._incoming = list()
         self._futures = list()
-        self._piece_manager = PiecesManager(self._tinfo)
+        self._piece_manager = PiecesManager(
+            self._tinfo,
+            max_buffer=max_buffer,
+            disk_io=session.disk_io if session else None,
+            hash_pool=session.hash_pool if session else None,
+            on_complete=self._on_piece_complete,
+            download_dir=download_dir,
+            file_priorities=file_priorities,
+            claims=shard,
+            on_corrupt=self._on_corrupt)
+        self._choker = Choker(self._connections, self._piece_manager)
+        # Web seeds (BEP 19) share one HTTP client, the session's if any
+        self._web_seeds = []
+        self._http_client = None
+        self._server = None
+        # A session serves the metrics of all its torrents
+        self._metrics_server = None
+        self._lag_monitor = None
+        if not session:
+            self._lag_monitor = metrics.LoopLagMonitor(metrics.LOOP_LAG)
+            if metrics_port is not None:
+                self._metrics_server = metrics.MetricsServer(
+                    metrics.REGISTRY, metrics_port)
+        self._seed = seed
         self._aborted = False
+        self._stopped = False
 
     async def start(self):
+        self._load_peers()
+        if self._shard:
+            self._sync_shard() # The coordinator checked the files
+        else:
+            await self._piece_manager.recheck()
+        if not self._session:
+            # Shards share the port, the kernel spreads the connections
+            self._server = await asyncio.start_server(
+                self._on_incoming, port=self._port,
+                reuse_port=self._shard is not None)
+        if self._utp and not self._session:
+            await self._utp.start()
+        self._register_metrics()
+        if self._lag_monitor:
+            self._lag_monitor.start()
+        if self._metrics_server:
+            await self._metrics_server.start()
+        if self._dht:
+            if self._own_dht and self._dht:
+                if self._utp:
+                    self._utp.fallback = self._dht.datagram_received
+                await self._dht.start(self._utp.transport
+                                      if self._utp else None)
+            self._dht_future = asyncio.ensure_future(self._dht_announce())
+        if self._lsd:
+            if self._own_lsd:
+                await self._lsd.start()
+            self._lsd.add(self._tinfo.hash, self._on_local_peers)
         self._init_workers()
-        previous = None # time we last made an announce call (timestamp)
-        interval = 30 * 60 # default interval between requests
+        self._init_web_seeds()
+        self._choker.start()
+        if not self._shard:
+            self._announcer.start()
+        completed = self._piece_manager.complete
+        saved = time.time()
+        exchanged = time.time()
         while True:
+            if self._shard:
+                self._sync_shard()
+            if self._piece_manager.streaming:
+                self._update_fast_peers()
+            if exchanged + PEX_INTERVAL < time.time():
+                exchanged = time.time()
+                self._exchange_peers()
+            if saved + STORE_SAVE_INTERVAL < time.time():
+                saved = time.time()
+                if self._peer_store is not None:
+                    self._peer_store.save()
             if self._piece_manager.complete:
-                print("Done")
-                break
+                if not completed:
+                    completed = True
+                    if not self._shard:
+                        await self._announcer.completed()
+                if not self._seed:
+                    BUS.info('torrent.done', torrent=self._tinfo.hex_hash)
+                    break
             if self._aborted:
-                print("Aborted")
+                BUS.info('torrent.aborted', torrent=self._tinfo.hex_hash)
                 break
-            current = time.time()
-            if (not previous) or (previous + interval < current):
-                response = await self._tracker.connect(
-                    first=True if not previous else False,
-                    uploaded=self._piece_manager.bytes_uploaded,
-                    downloaded=self._piece_manager.bytes_downloaded,
-                    next_url=True)
-                if not response:
-                    print("Tracker doesn't responds")
-                else:
-                    previous = time.time()
-                    interval = response.interval
-                    self._empty_queue()
-                    local_time = time.localtime() 
-                    for peer in response.peers:
-                        self._peers_queue.put_nowait(peer)
-                    print("Tracker respond got at {}. " \
-                          "Next request in {} minutes.".format(
-                              "{}:{}".format(local_time.tm_hour,
-                                             local_time.tm_min),
-                              interval / 60))
-                    print(response)
-            else:
-                await asyncio.sleep(5)
+            await asyncio.sleep(1)
         self.stop()
 
+    def _load_peers(self):
+        # Known good peers are dialed before any tracker answers
+        if self._peer_store is None:
+            return
+        self._peer_store.load()
+        for ip in self._peer_store.banned:
+            self._peers_queue.ban(ip)
+        for peer in self._peer_store.ranked():
+            record = self._peer_store.get(peer)
+            self._peers_queue.add([peer], PRIORITY_KNOWN
+                                  if not record.failures else PRIORITY_DEFAULT)
+
+    def _sync_shard(self):
+        # Pieces stored by the other shards are announced to our peers
+        for peers, priority in self._shard.take_peers():
+            self._peers_queue.add(peers, priority)
+        for piece_idx in self._shard.completed():
+            self._piece_manager.mark_have(piece_idx)
+        self._shard.set_uploaded(self._piece_manager.bytes_uploaded)
+        if self._shard.stopped:
+            self._aborted = True
+
+    def _on_tracker_response(self, url, response):
+        # Peers of every tracker go to the same pool as they arrive
+        added = self._peers_queue.add(response.peers)
+        BUS.info('tracker.response', torrent=self._tinfo.hex_hash, url=url,
+                 peers=len(response.peers), new=added,
+                 complete=response.complete,
+                 incomplete=response.incomplete,
+                 interval=response.interval)
+
+    async def _dht_announce(self):
+        # Works when every tracker is down or the torrent has none
+        while True:
+            peers = await self._dht.announce(self._tinfo.hash, self._port)
+            added = self._peers_queue.add(peers)
+            BUS.info('dht.peers', torrent=self._tinfo.hex_hash,
+                     peers=len(peers), new=added)
+            await asyncio.sleep(DHT_INTERVAL)
+
+    def _on_local_peers(self, peers):
+        added = self._peers_queue.add(peers, PRIORITY_LOCAL)
+        if added:
+            BUS.info('lsd.peers', torrent=self._tinfo.hex_hash, peers=peers)
+
+    def _on_corrupt(self, peer_id, banned: bool):
+        # The piece manager blamed the peer for a piece failing the hash
+        # check, a banned host is dropped and never dialed again
+        for seed in self._web_seeds:
+            if seed.peer_id == peer_id and banned:
+                seed.stop()
+        for conn in self._connections():
+            if not conn.connected or conn.peer.id != peer_id:
+                continue
+            if self._peer_store is not None and conn.listen_addr:
+                self._peer_store.hash_failed(conn.listen_addr)
+            if banned and ipaddress.ip_address(conn.peer.ip).is_loopback:
+                # Clients sharing this host (tests, benchmarks) are only
+                # told apart by their peer id, which the piece manager bans
+                conn.cancel()
+            elif banned:
+                self.ban(conn.peer.ip)
+
+    def ban(self, ip: str):
+        """
+        Disconnect the host and refuse its connections from now on
+        """
+        self._peers_queue.ban(ip)
+        if self._peer_store is not None:
+            self._peer_store.ban(ip)
+        for conn in self._connections():
+            if conn.connected and conn.peer.ip == ip:
+                conn.cancel()
+        BUS.warning('peer.banned', torrent=self._tinfo.hex_hash, peer=ip)
+
+    @property
+    def _pex_callback(self):
+        # Private torrents neither advertise nor accept PEX
+        return None if self._tinfo.private else self._on_pex_peers
+
+    def _on_pex_peers(self, peers):
+        # Connected peers keep telling us about the rest of the swarm
+        if not self._tinfo.private:
+            self._peers_queue.add(peers)
+
+    def _exchange_peers(self):
+        if self._tinfo.private:
+            return
+        peers = [conn.listen_addr for conn in self._connections()
+                 if conn.connected and conn.listen_addr]
+        for conn in self._connections():
+            conn.send_pex(peers)
+
+    async def set_file_priorities(self, priorities: list):
+        """
+        One of FILE_SKIP, FILE_LOW, FILE_NORMAL and FILE_HIGH per file of
+        the torrent, skipped files are not downloaded nor created
+        """
+        await self._piece_manager.set_file_priorities(priorities)
+        for conn in self._connections():
+            conn.update_interest()
+
+    def stream(self, window: int = STREAM_WINDOW, piece_time: float = 1.0):
+        """
+        Download the pieces ahead of the read cursor first, from the
+        fastest peers, so the content can be used while it downloads. See
+        `PiecesManager.set_streaming`, a window of 0 stops streaming.
+        """
+        self._piece_manager.set_streaming(window, piece_time)
+        self._update_fast_peers()
+
+    async def read(self, offset: int, length: int) -> bytes:
+        """
+        Wait for a byte range of the torrent and return it, while
+        streaming the read cursor moves there
+        """
+        return await self._piece_manager.read(offset, length)
+
+    def _update_fast_peers(self):
+        sources = [(conn.download_rate.rate, conn.peer.id)
+                   for conn in self._connections() if conn.connected]
+        sources.extend((seed.download_rate.rate, seed.peer_id)
+                       for seed in self._web_seeds)
+        sources.sort(key=lambda source: source[0], reverse=True)
+        self._piece_manager.set_fast_peers(
+            [peer_id for _, peer_id in sources[:STREAM_PEERS]] or None)
+
+    def set_peer_rates(self, download: int = 0, upload: int = 0):
+        """
+        Limit every connection of the torrent, 0 is unlimited
+        """
+        self._peer_rates = (download, upload)
+        for conn in self._connections():
+            self._apply_peer_rates(conn)
+
+    def _apply_peer_rates(self, conn):
+        conn.download_limit.rate = self._peer_rates[0]
+        conn.upload_limit.rate = self._peer_rates[1]
+
+    def _limits(self):
+        session = self._session
+        return dict(
+            download_limits=(self.download_limit,
+                             session.download_limit if session else None),
+            upload_limits=(self.upload_limit,
+                           session.upload_limit if session else None))
+
+    def _register_metrics(self):
+        # Gauges are read when collected, nothing is updated meanwhile
+        label = self._tinfo.hex_hash
+        metrics.PEERS.set_function(
+            lambda: sum(1 for conn in self._connections() if conn.connected),
+            label)
+        metrics.PENDING_REQUESTS.set_function(
+            lambda: self._piece_manager.pending_requests, label)
+        metrics.UPLOAD_QUEUE.set_function(
+            lambda: sum(conn.queued_requests
+                        for conn in self._connections()), label)
+
+    def _unregister_metrics(self):
+        label = self._tinfo.hex_hash
+        for gauge in (metrics.PEERS, metrics.PENDING_REQUESTS,
+                      metrics.UPLOAD_QUEUE):
+            gauge.remove(label)
+
+    def stats(self) -> dict:
+        """
+        Snapshot of the torrent and of each connected peer. Peers are
+        reported here rather than as metric labels, which would grow
+        without bound as peers come and go.
+        """
+        peers = [conn.stats() for conn in self._connections()
+                 if conn.connected]
+        web_seeds = [seed.stats() for seed in self._web_seeds]
+        return {
+            'info_hash': self._tinfo.hex_hash,
+            'downloaded': self._piece_manager.bytes_downloaded,
+            'uploaded': self._piece_manager.bytes_uploaded,
+            'download_rate': sum(peer['download_rate'] for peer
+                                 in peers + web_seeds),
+            'upload_rate': sum(peer['upload_rate'] for peer in peers),
+            'pieces': self._piece_manager.completed_pieces,
+            'total_pieces': self._piece_manager.total_pieces,
+            'complete': self._piece_manager.complete,
+            'pending_requests': self._piece_manager.pending_requests,
+            'buffered_bytes': self._piece_manager.buffered_bytes,
+            'peers': peers,
+            'web_seeds': web_seeds,
+        }
+
     def _init_workers(self):
         self._workers = [PeerConnection(self._peers_queue,
                                         self._tinfo.hash,
                                         self._tracker.my_id,
                                         self._piece_manager,
                                         worker_id,
-                                        self._on_block_retrieved)
+                                        self._on_block_retrieved,
+                                        budget=self._session.connections
+                                        if self._session else None,
+                                        peer_store=self._peer_store,
+                                        on_peers=self._pex_callback,
+                                        listen_port=self._port,
+                                        utp=self._utp,
+                                        **self._limits())
                          for worker_id in range(MAX_PEERS)]
+        for worker in self._workers:
+            self._apply_peer_rates(worker)
         # self._futures = [worker.future for worker in self._workers]
 
+    def _init_web_seeds(self):
+        urls = self._tinfo.url_list
+        if not urls or self._piece_manager.complete:
+            return
+        if self._session:
+            self._http_client = self._session.web_seed_client
+        else:
+            # Keep-alive connections are pooled, at most a few per host
+            self._http_client = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit_per_host=WEBSEED_CONNECTIONS))
+        self._web_seeds = [WebSeed(url, self._tinfo, self._piece_manager,
+                                   self._http_client,
+                                   self._on_block_retrieved,
+                                   download_limits=(
+                                       self._limits()['download_limits']))
+                           for url in urls]
+        for seed in self._web_seeds:
+            seed.start()
+
+    def _connections(self):
+        yield from self._workers
+        yield from self._incoming
+
+    async def _on_incoming(self, reader, writer):
+        self.accept(reader, writer)
+
+    def accept(self, reader, writer, handshake: bytes = b'') -> bool:
+        """
+        Serve an accepted connection, `handshake` holds the bytes already
+        read from it
+        """
+        self._incoming = [c for c in self._incoming
+                          if c.future and not c.future.done()]
+        peer_ip = writer.get_extra_info('peername')[0]
+        if self._aborted or len(self._incoming) >= MAX_INCOMING or \
+                self._peers_queue.is_banned(peer_ip):
+            writer.close()
+            return False
+        conn = PeerConnection(None,
+                              self._tinfo.hash,
+                              self._tracker.my_id,
+                              self._piece_manager,
+                              len(self._incoming),
+                              self._on_block_retrieved,
+                              incoming=(reader, writer,
+                                        handshake),
+                              budget=self._session.connections
+                              if self._session else None,
+                              on_peers=self._pex_callback,
+                              listen_port=self._port,
+                              **self._limits())
+        self._apply_peer_rates(conn)
+        self._incoming.append(conn)
+        return True
+
+    @property
+    def info_hash(self):
+        return self._tinfo.hash
+
+    @property
+    def torrent_info(self):
+        return self._tinfo
+
     @property
     def future(self):
         return self._future
 
-    def _empty_queue(self):
-        while not self._peers_queue.empty():
-            self._peers_queue.get_nowait()
-
     def stop(self):
-        print("Aborting!")
+        if self._stopped:
+            return
+        BUS.info('torrent.stopping', torrent=self._tinfo.hex_hash)
         self._aborted = True
-        for worker in self._workers:
+        self._stopped = True
+        self._choker.stop()
+        self._announcer.stop()
+        self._unregister_metrics()
+        if self._lag_monitor:
+            self._lag_monitor.stop()
+        if self._metrics_server:
+            self._metrics_server.close()
+        if self._dht_future and not self._dht_future.done():
+            self._dht_future.cancel()
+        if self._own_dht and self._dht:
+            self._dht.close()
+        if self._lsd:
+            self._lsd.remove(self._tinfo.hash)
+            if self._own_lsd and self._lsd:
+                self._lsd.close()
+        if self._utp and not self._session:
+            self._utp.close()
+        if self._server:
+            self._server.close()
+        for worker in self._connections():
             worker.stop()
+        for seed in self._web_seeds:
+            seed.stop()
+        if self._http_client and not self._session:
+            asyncio.ensure_future(self._http_client.close())
         self._piece_manager.close()
         self._tracker.close()
+        if self._peer_store is not None:
+            self._peer_store.save()
 
-    def _on_block_retrieved(self, peer_id, piece_index, block_offset, data):
+    def _on_block_retrieved(self, peer_id, piece_idx, block_offset, data):
         self._piece_manager.block_received(peer_id=peer_id,
-                                           piece_idx=piece_index,
+                                           piece_idx=piece_idx,
                                            block_offset=block_offset,
                                            data=data)
 
+    def _on_piece_complete(self, piece_idx):
+        for conn in self._connections():
+            conn.send_have(piece_idx)
+
@@ -2,6 +2,7 @@
 from .bencode_parser import Decoder, Encoder
 from hashlib import sha1
 import math
+import random
 
 
 
@@ -63,12 +64,51 @@ class TorrentInfo:
 
     def _take_announce(self):
         self._announce_idx = 0
-        self._announce_list = [self._data[b"announce"].decode('utf-8')]
+        # Trackerless torrents have no announce, peers come from the DHT
+        self._announce_list = [self._data[b"announce"].decode('utf-8')] \
+            if b"announce" in self._data else []
         if b"announce-list" in self._data:
             for ann in self._data[b'announce-list']:
                 ann = ann[0].decode("utf-8")
                 if ann not in self._announce_list:
                     self._announce_list.append(ann)
+        # BEP 12: the announce-list replaces announce, trackers of a tier
+        # are shuffled once and tried in that order
+        self._announce_tiers = []
+        seen = set()
+        tiers = self._data.get(b'announce-list',
+                               [self._announce_list[:1]])
+        for tier in tiers:
+            urls = [url.decode('utf-8') if isinstance(url, bytes) else url
+                    for url in tier]
+            urls = [url for url in urls if url not in seen]
+            seen.update(urls)
+            random.shuffle(urls)
+            if urls:
+                self._announce_tiers.append(urls)
+        if not self._announce_tiers and self._announce_list:
+            self._announce_tiers.append(self._announce_list[:1])
+
+    @property
+    def announce_tiers(self):
+        return [list(tier) for tier in self._announce_tiers]
+
+    @property
+    def private(self):
+        """
+        Private torrents (BEP 27) only get peers from their trackers
+        """
+        return self._data[b'info'].get(b'private') == 1
+
+    @property
+    def url_list(self) -> list:
+        """
+        HTTP servers holding the content (BEP 19 web seeds)
+        """
+        urls = self._data.get(b'url-list', [])
+        if isinstance(urls, bytes):
+            urls = [urls]
+        return [url.decode('utf-8') for url in urls if url]
 
     @property
     def files(self):
@@ -79,6 +119,8 @@ class TorrentInfo:
         return self._filename.decode('utf-8')
 
     def get_announce(self, next_ann=False):
+        if not self._announce_list:
+            return None
         if next_ann:
             self._announce_idx = (self._announce_idx + 1) % \
                 len(self._announce_list)
@@ -128,3 +170,91 @@ class TorrentInfo:
             res += "\n"
         return res
 
+
+
+class SyntheticTorrent:
+    """
+    A torrent description without a metainfo file, for simulations. Every
+    piece is filled with zeros, so blocks of zeros pass the hash check.
+    """
+
+    def __init__(self, total_pieces: int, piece_length: int = 2**18,
+                 last_piece_length: int = None, name: str = 'synthetic'):
+        self._total_pieces = total_pieces
+        self._piece_length = piece_length
+        self._last_piece_length = last_piece_length or piece_length
+        self._name = name
+        self._info_hash = sha1("{}:{}:{}:{}".format(
+            name, total_pieces, piece_length,
+            self._last_piece_length).encode())
+        self._files = [TFile([name.encode()], self.total_size)]
+
+    @classmethod
+    def with_files(cls, file_lengths: list, piece_length: int = 2**18,
+                   name: str = 'synthetic'):
+        """
+        A multi-file torrent of files of the given lengths
+        """
+        total_size = sum(file_lengths)
+        pieces = math.ceil(total_size / piece_length)
+        torrent = cls(pieces, piece_length,
+                      total_size - (pieces - 1) * piece_length, name)
+        torrent._files = [TFile([name.encode(),
+                                 'file{}'.format(idx).encode()], length)
+                          for idx, length in enumerate(file_lengths)]
+        return torrent
+
+    @property
+    def multi_file(self):
+        return len(self._files) > 1
+
+    @property
+    def files(self):
+        yield from self._files
+
+    @property
+    def filename(self):
+        return self._name
+
+    @property
+    def announce_tiers(self):
+        return []
+
+    @property
+    def url_list(self):
+        return []
+
+    @property
+    def private(self):
+        return False
+
+    def get_announce(self, next_ann=False):
+        return None
+
+    @property
+    def hex_hash(self):
+        return self._info_hash.hexdigest()
+
+    @property
+    def hash(self):
+        return self._info_hash.digest()
+
+    @property
+    def piece_length(self):
+        return self._piece_length
+
+    @property
+    def total_size(self):
+        return (self._total_pieces - 1) * self._piece_length + \
+            self._last_piece_length
+
+    @property
+    def pieces_hashes(self):
+        piece_hash = sha1(bytes(self._piece_length)).digest()
+        for _ in range(self._total_pieces - 1):
+            yield piece_hash
+        yield sha1(bytes(self._last_piece_length)).digest()
+
+    @property
+    def total_pieces(self):
+        return self._total_pieces
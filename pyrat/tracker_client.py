@@ -1,16 +1,35 @@
 
+import asyncio
 import aiohttp
+import time
 from random import randint
-from socket import inet_ntoa
-from struct import unpack
-from urllib.parse import urlencode
+from socket import inet_ntoa, inet_ntop, AF_INET6
+from struct import iter_unpack
+from urllib.parse import urlencode, urlsplit
 
 from .bencode_parser import Decoder, Encoder
+from . import metrics
+from .events import BUS
+
+
+def parse_compact_peers(data: bytes, ipv6: bool = False) -> tuple:
+    """
+    Decode a compact peer list (BEP 23, BEP 7 for IPv6) in one pass over
+    a memoryview, a trailing partial entry is ignored
+    """
+    entry = 18 if ipv6 else 6
+    view = memoryview(data)[:len(data) - len(data) % entry]
+    if ipv6:
+        return tuple((inet_ntop(AF_INET6, ip), port)
+                     for ip, port in iter_unpack('>16sH', view))
+    return tuple((inet_ntoa(ip), port)
+                 for ip, port in iter_unpack('>4sH', view))
 
 
 class TrackerResponce:
     def __init__(self, responce: dict):
        self._responce = responce
+       self._peers = None
 
     @property
     def failure(self) -> str:
@@ -30,15 +49,22 @@ class TrackerResponce:
         return self._responce.get(b'incomplete', 0)
 
     @property
-    def peers(self):
-        peers = self._responce[b'peers']
-        if type(peers) == list: # List of dicts
-            # Not sure it's correct
-            return [(peer[b'ip'], peer[b'port']) for peer in peers]
-        else:
-            peers = [peers[i:i+6] for i in range(0, len(peers), 6)]
-            return [(inet_ntoa(peer[:4]), unpack(">H", peer[4:])[0])
-                    for peer in peers]
+    def peers(self) -> tuple:
+        """
+        (ip, port) tuples of IPv4 and IPv6 peers, decoded once
+        """
+        if self._peers is None:
+            peers = self._responce.get(b'peers', b'')
+            if type(peers) == list: # List of dicts
+                peers = tuple((peer[b'ip'].decode('utf-8'), peer[b'port'])
+                              for peer in peers)
+            else:
+                peers = parse_compact_peers(peers)
+            peers6 = self._responce.get(b'peers6', b'')
+            if peers6:
+                peers += parse_compact_peers(peers6, ipv6=True)
+            self._peers = peers
+        return self._peers
     
     def __str__(self):
         return "incomplete: {incomplete}\n" \
@@ -52,39 +78,89 @@ class TrackerResponce:
     
 
 class TrackerClient:
-    def __init__(self, tfile):
+    def __init__(self, tfile, port: int = 6889, http_client=None,
+                 udp_client=None):
         self._torrent = tfile
+        self._port = port
+        self._own_udp = udp_client is None
+        self._udp_client = udp_client # Created on the first udp:// URL
         self._my_id = '-PC0516-' + ''.join(
             [str(randint(0, 9)) for _ in range(12)])
-        self._http_client = aiohttp.ClientSession()
+        # A session shares its connection pool between trackers clients
+        self._own_client = http_client is None
+        self._http_client = http_client if http_client \
+            else aiohttp.ClientSession()
         
     async def connect(self,
                       first: bool=False,
                       uploaded: int=0,
                       downloaded: int=0,
                       next_url: bool=False):
+        return await self.announce(self._torrent.get_announce(next_url),
+                                   uploaded=uploaded,
+                                   downloaded=downloaded,
+                                   event='started' if first else None)
+
+    async def announce(self, announce: str, uploaded: int=0,
+                       downloaded: int=0, event: str=None):
+        """
+        Announce to the given tracker URL, returns None if it is unreachable
+        """
+        started = time.monotonic()
+        try:
+            return await self._announce(announce, uploaded, downloaded, event)
+        finally:
+            elapsed = time.monotonic() - started
+            tracker = urlsplit(announce).netloc
+            metrics.TRACKER_TIME.observe(elapsed, tracker)
+            BUS.trace('announce', elapsed, tracker=tracker)
+
+    async def _announce(self, announce: str, uploaded: int, downloaded: int,
+                        event: str):
         args = {
             'info_hash': self._torrent.hash,
             'peer_id': self._my_id,
-            'port': 6889,
+            'port': self._port,
             'uploaded': uploaded,
             'downloaded': downloaded,
             'left': self._torrent.total_size - downloaded,
             'compact': 1
         }
-        if first: args['event'] = 'started'
-        url = self._torrent.get_announce(next_url) + '?' + urlencode(args)
+        if event: args['event'] = event
+        if announce.startswith('udp://'):
+            return await self._udp_announce(announce, args)
+        url = announce + '?' + urlencode(args)
         try:
             async with self._http_client.get(url) as responce:
                 if not responce.status == 200:
                     raise ConnectionError("Can not connect to tracker")
                 data = await responce.read()
-                return TrackerResponce(Decoder(data).parse())
-        except aiohttp.client_exceptions.ClientConnectionError:
+        except (aiohttp.ClientError, ConnectionError):
+            return None
+        try:
+            decoded = Decoder(data).parse()
+        except (RuntimeError, IndexError, EOFError, ValueError):
+            return None # Not bencoded, an HTML error page for one
+        if not isinstance(decoded, dict):
             return None
+        return TrackerResponce(decoded)
         
+    async def _udp_announce(self, url: str, args: dict):
+        if self._udp_client is None:
+            from .udp_tracker import UDPTrackerClient
+            # Few retries, a silent tracker should not stall the announces
+            self._udp_client = UDPTrackerClient(max_retries=2)
+        return await self._udp_client.announce(
+            url, args['info_hash'], args['peer_id'], args['port'],
+            uploaded=args['uploaded'], downloaded=args['downloaded'],
+            left=args['left'], event=args.get('event'))
+
     def close(self):
-        self._http_client.close()
+        if self._own_client and not self._http_client.closed:
+            # Closing the session is a coroutine, run on the loop
+            asyncio.ensure_future(self._http_client.close())
+        if self._own_udp and self._udp_client:
+            self._udp_client.close()
 
     @property
     def my_id(self):
@@ -0,0 +1,206 @@
+import asyncio
+import socket
+import time
+from random import getrandbits
+from struct import pack, unpack_from
+from urllib.parse import urlparse
+
+from .tracker_client import TrackerResponce
+
+
+
+PROTOCOL_ID = 0x41727101980
+
+ACTION_CONNECT = 0
+ACTION_ANNOUNCE = 1
+ACTION_SCRAPE = 2
+ACTION_ERROR = 3
+
+EVENTS = {None: 0, 'completed': 1, 'started': 2, 'stopped': 3}
+
+MAX_SCRAPE = 74 # Info hashes fitting one scrape packet
+
+
+class UDPTrackerError(Exception):
+    pass
+
+
+class _TrackerProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        self.transactions = dict() # transaction id => (address, future)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 8:
+            return
+        action, transaction_id = unpack_from('>II', data)
+        addr_future = self.transactions.get(transaction_id)
+        if addr_future is None or addr_future[0] != addr:
+            return # Not an answer from the tracker we asked
+        future = addr_future[1]
+        if not future.done():
+            future.set_result((action, data[8:]))
+
+    def error_received(self, exc):
+        # ICMP errors can not be matched to a transaction, the request
+        # will time out and be retransmitted
+        pass
+
+
+class UDPTrackerClient:
+    """
+    BEP 15 tracker client. All trackers are reached through one UDP socket,
+    connection ids are cached per tracker for `CONNECTION_ID_TTL` seconds
+    and lost packets are retransmitted after timeout * 2 ** attempt.
+    """
+
+    CONNECTION_ID_TTL = 60
+
+    def __init__(self, timeout: float = 15, max_retries: int = 8):
+        self._timeout = timeout
+        self._max_retries = max_retries
+        self._protocol = None
+        self._connecting = None
+        self._addresses = dict() # (host, port) => resolved address
+        self._connection_ids = dict() # address => (connection id, expiry)
+
+    async def _endpoint(self):
+        if self._protocol is None:
+            if self._connecting is None:
+                loop = asyncio.get_event_loop()
+                self._connecting = asyncio.ensure_future(
+                    loop.create_datagram_endpoint(
+                        _TrackerProtocol, local_addr=('0.0.0.0', 0)))
+            _, self._protocol = await asyncio.shield(self._connecting)
+        return self._protocol
+
+    async def _resolve(self, url: str):
+        parsed = urlparse(url)
+        key = (parsed.hostname, parsed.port or 80)
+        if key not in self._addresses:
+            loop = asyncio.get_event_loop()
+            infos = await loop.getaddrinfo(key[0], key[1],
+                                           type=socket.SOCK_DGRAM,
+                                           family=socket.AF_INET)
+            self._addresses[key] = infos[0][4]
+        return self._addresses[key]
+
+    async def _request(self, addr, build, expected_action: int,
+                       length: int):
+        """
+        Send the packet made by `build(transaction_id)` until the answer
+        arrives. Returns the payload following action and transaction id,
+        an answer with a payload shorter than `length` is a failed attempt.
+        """
+        protocol = await self._endpoint()
+        for attempt in range(self._max_retries + 1):
+            transaction_id = getrandbits(32)
+            future = asyncio.get_event_loop().create_future()
+            protocol.transactions[transaction_id] = (addr, future)
+            try:
+                protocol.transport.sendto(build(transaction_id), addr)
+                action, payload = await asyncio.wait_for(
+                    future, self._timeout * 2 ** attempt)
+            except asyncio.TimeoutError:
+                continue
+            finally:
+                del protocol.transactions[transaction_id]
+            if action == ACTION_ERROR:
+                raise UDPTrackerError(payload.decode('utf-8', 'replace'))
+            if action != expected_action:
+                raise UDPTrackerError("Unexpected action {}".format(action))
+            if len(payload) < length:
+                continue
+            return payload
+        raise asyncio.TimeoutError()
+
+    async def _connection_id(self, addr):
+        cached = self._connection_ids.get(addr)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        payload = await self._request(
+            addr, lambda tid: pack('>QII', PROTOCOL_ID, ACTION_CONNECT, tid),
+            ACTION_CONNECT, 8)
+        connection_id = unpack_from('>Q', payload)[0]
+        self._connection_ids[addr] = (
+            connection_id, time.monotonic() + self.CONNECTION_ID_TTL)
+        return connection_id
+
+    async def _with_connection(self, addr, build, expected_action: int,
+                               length: int):
+        connection_id = await self._connection_id(addr)
+        try:
+            return await self._request(
+                addr, lambda tid: build(connection_id, tid), expected_action,
+                length)
+        except asyncio.TimeoutError:
+            # The tracker may have forgotten our connection id
+            self._connection_ids.pop(addr, None)
+            raise
+
+    async def announce(self, url: str, info_hash: bytes, peer_id,
+                       port: int, uploaded: int = 0, downloaded: int = 0,
+                       left: int = 0, event: str = None,
+                       num_want: int = -1) -> TrackerResponce:
+        """
+        Returns a TrackerResponce like the HTTP tracker client, or None if
+        the tracker does not answer
+        """
+        peer_id = peer_id if isinstance(peer_id, bytes) \
+            else bytes(peer_id, 'utf-8')
+        key = getrandbits(32)
+
+        def build(connection_id, tid):
+            return pack('>QII20s20sQQQIIIiH', connection_id, ACTION_ANNOUNCE,
+                        tid, info_hash, peer_id, downloaded, left, uploaded,
+                        EVENTS[event], 0, key, num_want, port)
+
+        try:
+            addr = await self._resolve(url)
+            payload = await self._with_connection(addr, build,
+                                                  ACTION_ANNOUNCE, 12)
+        except UDPTrackerError as e:
+            return TrackerResponce({b'failure reason': bytes(str(e),
+                                                             'utf-8')})
+        except (asyncio.TimeoutError, OSError):
+            return None
+        interval, leechers, seeders = unpack_from('>III', payload)
+        return TrackerResponce({b'interval': interval,
+                                b'incomplete': leechers,
+                                b'complete': seeders,
+                                b'peers': payload[12:]})
+
+    async def scrape(self, url: str, info_hashes: list) -> dict:
+        """
+        Returns info hash => {'complete', 'downloaded', 'incomplete'}.
+        Hashes are sent MAX_SCRAPE per packet, the packets in parallel.
+        """
+        addr = await self._resolve(url)
+        batches = [info_hashes[i:i + MAX_SCRAPE]
+                   for i in range(0, len(info_hashes), MAX_SCRAPE)]
+
+        async def scrape_batch(batch):
+            def build(connection_id, tid):
+                return pack('>QII', connection_id, ACTION_SCRAPE, tid) + \
+                    b''.join(batch)
+            payload = await self._with_connection(addr, build, ACTION_SCRAPE,
+                                                  12 * len(batch))
+            return zip(batch, (unpack_from('>III', payload, 12 * i)
+                               for i in range(len(batch))))
+
+        result = dict()
+        for stats in await asyncio.gather(*map(scrape_batch, batches)):
+            for info_hash, (seeders, completed, leechers) in stats:
+                result[info_hash] = {'complete': seeders,
+                                     'downloaded': completed,
+                                     'incomplete': leechers}
+        return result
+
+    def close(self):
+        if self._protocol:
+            self._protocol.transport.close()
+        self._protocol = None
+        self._connecting = None
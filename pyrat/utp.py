@@ -0,0 +1,662 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from struct import pack, unpack_from
+
+
+
+ST_DATA = 0
+ST_FIN = 1
+ST_STATE = 2
+ST_RESET = 3
+ST_SYN = 4
+
+VERSION = 1
+HEADER = '>BBHIIIHH'
+HEADER_SIZE = 20
+EXT_SACK = 1
+
+MSS = 1400 # Payload of one packet, fits a 1500 bytes MTU
+TARGET_DELAY = 100000 # LEDBAT target queuing delay, microseconds
+MAX_CWND_INCREASE = 3000 # Window growth per RTT at zero delay, bytes
+MIN_WINDOW = 2 * MSS
+INIT_WINDOW = 4 * MSS
+RECV_WINDOW = 2**20 # Advertised receive window
+MAX_WINDOW = RECV_WINDOW
+SEND_BUFFER = 2**18 # Buffered bytes above which drain() waits
+MAX_OUTSTANDING = 1024 # Packets in flight, keeps the 16 bits seq space sane
+REORDER_LIMIT = 1024 # Packets buffered ahead of a hole
+
+INIT_RTO = 1.0
+MIN_RTO = 0.5
+MAX_RTO = 30.0
+MAX_TIMEOUTS = 6 # Consecutive timeouts before the connection is dropped
+SYN_RETRIES = 2
+LINGER = 10 # Seconds a closed connection waits for the FIN of the peer
+BASE_HISTORY = 2 # Minutes of base delay history
+
+MASK16 = 0xffff
+MASK32 = 0xffffffff
+
+
+def _now_us() -> int:
+    return int(time.monotonic() * 1000000) & MASK32
+
+
+def _seq_lt(a: int, b: int) -> bool:
+    """
+    `a` is before `b` in the wrapping 16 bits sequence space
+    """
+    return a != b and ((b - a) & MASK16) < 0x8000
+
+
+def _lt32(a: int, b: int) -> bool:
+    return a != b and ((b - a) & MASK32) < 0x80000000
+
+
+def is_utp_packet(data: bytes) -> bool:
+    """
+    Tells uTP packets from other datagrams sharing the socket (DHT)
+    """
+    return len(data) >= HEADER_SIZE and data[0] & 0x0f == VERSION and \
+        data[0] >> 4 <= ST_SYN
+
+
+def encode_packet(ptype: int, conn_id: int, timestamp: int, ts_diff: int,
+                  wnd_size: int, seq_nr: int, ack_nr: int,
+                  payload: bytes = b'', sack: bytes = None) -> bytes:
+    header = pack(HEADER, ptype << 4 | VERSION, EXT_SACK if sack else 0,
+                  conn_id, timestamp, ts_diff, wnd_size, seq_nr, ack_nr)
+    if sack:
+        header += pack('>BB', 0, len(sack)) + sack
+    return header + payload
+
+
+def decode_packet(data: bytes):
+    """
+    Returns (type, connection id, timestamp, timestamp difference, window,
+    seq_nr, ack_nr, selective ack bitmask, payload) or None
+    """
+    if not is_utp_packet(data):
+        return None
+    ptype_ver, extension, conn_id, timestamp, ts_diff, wnd_size, seq_nr, \
+        ack_nr = unpack_from(HEADER, data)
+    pos = HEADER_SIZE
+    sack = None
+    while extension:
+        if pos + 2 > len(data):
+            return None
+        next_extension, length = data[pos], data[pos + 1]
+        if pos + 2 + length > len(data):
+            return None
+        if extension == EXT_SACK:
+            sack = data[pos + 2:pos + 2 + length]
+        extension = next_extension
+        pos += 2 + length
+    return (ptype_ver >> 4, conn_id, timestamp, ts_diff, wnd_size, seq_nr,
+            ack_nr, sack, data[pos:])
+
+
+class _Packet:
+    def __init__(self, seq_nr: int, ptype: int, payload: bytes):
+        self.seq_nr = seq_nr
+        self.type = ptype
+        self.payload = payload
+        self.sent_at = 0
+        self.transmissions = 0
+        self.need_resend = False
+
+
+class _DelayHistory:
+    """
+    Minimum one-way delay of the last minutes, the base delay LEDBAT
+    measures queuing against. Clocks of both ends are not synchronised,
+    only differences are meaningful.
+    """
+    def __init__(self):
+        self._minima = deque(maxlen=BASE_HISTORY)
+        self._started = 0
+
+    def delay(self, sample: int) -> int:
+        now = time.monotonic()
+        if not self._minima or now - self._started > 60:
+            self._minima.append(sample)
+            self._started = now
+        elif _lt32(sample, self._minima[-1]):
+            self._minima[-1] = sample
+        base = self._minima[0]
+        for value in self._minima:
+            if _lt32(value, base):
+                base = value
+        return (sample - base) & MASK32
+
+
+class UTPConnection:
+    """
+    One uTP connection: reliable ordered delivery with selective acks,
+    retransmission on timeout or after three later packets were acked,
+    and LEDBAT congestion control which shrinks the window as soon as
+    our packets start queuing anywhere on the path.
+    """
+
+    SYN_SENT = 0
+    CONNECTED = 1
+    CLOSED = 2
+
+    def __init__(self, socket, addr, recv_id: int, send_id: int,
+                 seq_nr: int, ack_nr: int = 0, state: int = SYN_SENT):
+        self._socket = socket
+        self._addr = addr
+        self._recv_id = recv_id
+        self._send_id = send_id
+        self._seq_nr = seq_nr # Of the next packet we send
+        self._ack_nr = ack_nr # Last packet received in order
+        self._state = state
+        self.reader = asyncio.StreamReader()
+        self.writer = UTPStreamWriter(self)
+
+        self._send_buffer = bytearray()
+        self._outgoing = dict() # seq_nr => _Packet, in sending order
+        self._in_flight = 0 # Payload bytes sent and not acked
+        self._reorder = dict() # seq_nr => (type, payload) ahead of a hole
+        self._cwnd = INIT_WINDOW
+        self._peer_wnd = RECV_WINDOW
+        self._delays = _DelayHistory()
+        self._reply_micro = 0 # Delay of the last packet the peer sent us
+        self._rtt = None
+        self._rtt_var = 0
+        self._rto = INIT_RTO
+        self._timer = None
+        self._timeouts = 0
+        self._timed_out_at = 0 # Packets sent before can't measure the RTT
+        self._dup_acks = 0
+        self._last_ack = None
+        self._loss_seq = None # Window cut once per round trip
+        self._ack_needed = False
+        self._closing = False
+        self._fin_seq = None # Of the FIN we sent
+        self._eof = False
+        self._linger = None
+        self._connected = asyncio.get_event_loop().create_future()
+        self._drain_waiter = None
+
+    @property
+    def addr(self):
+        return self._addr
+
+    @property
+    def recv_id(self):
+        return self._recv_id
+
+    @property
+    def cwnd(self):
+        return self._cwnd
+
+    @property
+    def rtt(self):
+        return self._rtt
+
+    @property
+    def closed(self):
+        return self._state == self.CLOSED
+
+    async def connect(self):
+        syn = _Packet(self._seq_nr, ST_SYN, b'')
+        self._seq_nr = (self._seq_nr + 1) & MASK16
+        try:
+            for attempt in range(SYN_RETRIES + 1):
+                self._transmit(syn, conn_id=self._recv_id)
+                try:
+                    await asyncio.wait_for(asyncio.shield(self._connected),
+                                           INIT_RTO * 2 ** attempt)
+                    return
+                except asyncio.TimeoutError:
+                    continue
+            raise asyncio.TimeoutError()
+        finally:
+            if self._state == self.SYN_SENT: # Failed or cancelled
+                self._destroy(None)
+
+    def write(self, data: bytes):
+        if self._closing or self._state == self.CLOSED:
+            return
+        self._send_buffer += data
+        self._flush()
+
+    async def drain(self):
+        while len(self._send_buffer) > SEND_BUFFER and \
+                self._state != self.CLOSED:
+            self._drain_waiter = asyncio.get_event_loop().create_future()
+            await self._drain_waiter
+        if self._state == self.CLOSED and not self._closing:
+            raise ConnectionResetError()
+
+    def close(self):
+        # The FIN follows the buffered data
+        if not self._closing and self._state != self.CLOSED:
+            self._closing = True
+            if self._state == self.SYN_SENT:
+                self._destroy(None)
+            else:
+                self._flush()
+
+    def _wake_writer(self):
+        if self._drain_waiter and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    def _window(self) -> int:
+        return min(self._cwnd, self._peer_wnd)
+
+    def _flush(self):
+        if self._state != self.CONNECTED:
+            return
+        for packet in self._outgoing.values():
+            if not packet.need_resend:
+                continue
+            if self._in_flight and \
+                    self._in_flight + len(packet.payload) > self._window():
+                return
+            self._transmit(packet)
+        while self._send_buffer and len(self._outgoing) < MAX_OUTSTANDING:
+            size = min(MSS, len(self._send_buffer))
+            if self._in_flight and self._in_flight + size > self._window():
+                break
+            packet = _Packet(self._seq_nr, ST_DATA,
+                             bytes(self._send_buffer[:size]))
+            del self._send_buffer[:size]
+            self._seq_nr = (self._seq_nr + 1) & MASK16
+            self._outgoing[packet.seq_nr] = packet
+            self._transmit(packet)
+        if len(self._send_buffer) <= SEND_BUFFER:
+            self._wake_writer()
+        if self._closing and not self._send_buffer and self._fin_seq is None:
+            packet = _Packet(self._seq_nr, ST_FIN, b'')
+            self._fin_seq = self._seq_nr
+            self._seq_nr = (self._seq_nr + 1) & MASK16
+            self._outgoing[packet.seq_nr] = packet
+            self._transmit(packet)
+
+    def _sack(self) -> bytes:
+        # Bit i acks ack_nr + 2 + i, in multiples of 32 bits
+        if not self._reorder:
+            return None
+        offsets = [(seq_nr - self._ack_nr - 2) & MASK16
+                   for seq_nr in self._reorder]
+        offsets = [i for i in offsets if i < 256]
+        if not offsets:
+            return None
+        bits = bytearray(4 * (max(offsets) // 32 + 1))
+        for i in offsets:
+            bits[i // 8] |= 1 << (i & 7)
+        return bytes(bits)
+
+    def _transmit(self, packet: _Packet, conn_id: int = None):
+        if packet.transmissions == 0 or packet.need_resend:
+            self._in_flight += len(packet.payload)
+        packet.need_resend = False
+        packet.transmissions += 1
+        packet.sent_at = time.monotonic()
+        self._send(packet.type, packet.seq_nr, packet.payload, conn_id)
+        if self._timer is None:
+            self._arm_timer()
+
+    def _send(self, ptype: int, seq_nr: int, payload: bytes = b'',
+              conn_id: int = None):
+        self._ack_needed = False
+        self._socket._sendto(encode_packet(
+            ptype, self._send_id if conn_id is None else conn_id, _now_us(),
+            self._reply_micro, RECV_WINDOW, seq_nr, self._ack_nr, payload,
+            self._sack()), self._addr)
+
+    def _schedule_ack(self):
+        # Acks are coalesced over the datagrams of one loop iteration
+        if not self._ack_needed:
+            self._ack_needed = True
+            asyncio.get_event_loop().call_soon(self._send_ack)
+
+    def _send_ack(self):
+        if self._ack_needed and self._state == self.CONNECTED:
+            self._send(ST_STATE, self._seq_nr)
+
+    def _arm_timer(self):
+        if self._timer:
+            self._timer.cancel()
+        self._timer = asyncio.get_event_loop().call_later(
+            self._rto, self._on_timeout)
+
+    def _on_timeout(self):
+        self._timer = None
+        if self._state != self.CONNECTED or not self._outgoing:
+            return
+        self._timeouts += 1
+        if self._timeouts > MAX_TIMEOUTS:
+            logging.warning('uTP connection to {} timed out'.format(
+                self._addr))
+            return self._destroy(asyncio.TimeoutError())
+        # Everything in flight is presumed lost, restart from one packet
+        self._timed_out_at = time.monotonic()
+        self._rto = min(self._rto * 2, MAX_RTO)
+        self._cwnd = MSS
+        for packet in self._outgoing.values():
+            if not packet.need_resend:
+                packet.need_resend = True
+                self._in_flight -= len(packet.payload)
+        self._arm_timer()
+        self._flush()
+
+    def packet_received(self, ptype, timestamp, ts_diff, wnd_size, seq_nr,
+                        ack_nr, sack, payload):
+        self._reply_micro = (_now_us() - timestamp) & MASK32
+        self._peer_wnd = wnd_size
+        if ptype == ST_RESET:
+            return self._destroy(ConnectionResetError())
+        if ptype == ST_SYN:
+            # Our SYN-ACK was lost
+            return self._send(ST_STATE, self._seq_nr)
+        if self._state == self.SYN_SENT:
+            if ptype != ST_STATE:
+                return
+            self._state = self.CONNECTED
+            self._ack_nr = (seq_nr - 1) & MASK16
+            if self._timer: # Armed by the SYN
+                self._timer.cancel()
+                self._timer = None
+            if not self._connected.done():
+                self._connected.set_result(None)
+        self._on_ack(ptype, ack_nr, sack, ts_diff, len(payload))
+        if ptype in (ST_DATA, ST_FIN):
+            self._on_data(ptype, seq_nr, payload)
+        if self._state == self.CONNECTED:
+            self._flush()
+            if self._closing and self._fin_seq is not None and \
+                    not self._outgoing: # Our FIN was acked
+                if self._eof:
+                    self._destroy(None)
+                elif self._linger is None:
+                    self._linger = asyncio.get_event_loop().call_later(
+                        LINGER, self._destroy, None)
+
+    def _on_ack(self, ptype, ack_nr, sack, ts_diff, payload_size):
+        acked_bytes = 0
+        rtt_sample = None
+        now = time.monotonic()
+        acked = [seq for seq in self._outgoing
+                 if not _seq_lt(ack_nr, seq)]
+        if sack:
+            for i in range(len(sack) * 8):
+                if sack[i // 8] & (1 << (i & 7)):
+                    seq = (ack_nr + 2 + i) & MASK16
+                    if seq in self._outgoing:
+                        acked.append(seq)
+        for seq in acked:
+            packet = self._outgoing.pop(seq, None)
+            if packet is None:
+                continue
+            if not packet.need_resend:
+                self._in_flight -= len(packet.payload)
+            acked_bytes += len(packet.payload)
+            # Karn's algorithm, and the newest packet acked is the one
+            # which waited the least for a lost ack or a hole to be filled
+            if packet.transmissions == 1 and \
+                    packet.sent_at > self._timed_out_at and \
+                    (rtt_sample is None or now - packet.sent_at < rtt_sample):
+                rtt_sample = now - packet.sent_at
+        if acked:
+            if rtt_sample is not None:
+                self._update_rtt(rtt_sample)
+            # Progress ends the exponential backoff
+            self._rto = self._base_rto()
+            self._timeouts = 0
+            self._dup_acks = 0
+            if ts_diff:
+                self._update_window(acked_bytes,
+                                    self._delays.delay(ts_diff))
+            if self._outgoing:
+                self._arm_timer()
+            elif self._timer:
+                self._timer.cancel()
+                self._timer = None
+        elif ptype == ST_STATE and not payload_size and \
+                ack_nr == self._last_ack and self._outgoing:
+            self._dup_acks += 1
+        self._last_ack = ack_nr
+        if self._outgoing and (self._dup_acks >= 3 or sack):
+            self._fast_retransmit(ack_nr, sack)
+
+    def _fast_retransmit(self, ack_nr, sack):
+        # A packet is lost once three packets sent after it were acked
+        acked_after = 0
+        if sack:
+            acked_after = sum(bin(byte).count('1') for byte in sack)
+        if self._dup_acks < 3 and acked_after < 3:
+            return
+        seq = (ack_nr + 1) & MASK16
+        packet = self._outgoing.get(seq)
+        if packet is None or packet.need_resend or \
+                time.monotonic() - packet.sent_at < (self._rtt or MIN_RTO):
+            return
+        if self._loss_seq is None or not _seq_lt(seq, self._loss_seq):
+            self._cwnd = max(MIN_WINDOW, self._cwnd // 2)
+            self._loss_seq = self._seq_nr
+        self._in_flight -= len(packet.payload)
+        packet.need_resend = True
+        self._dup_acks = 0
+        self._transmit(packet)
+
+    def _update_rtt(self, sample: float):
+        if self._rtt is None:
+            self._rtt = sample
+            self._rtt_var = sample / 2
+        else:
+            self._rtt_var += (abs(self._rtt - sample) - self._rtt_var) / 4
+            self._rtt += (sample - self._rtt) / 8
+
+    def _base_rto(self) -> float:
+        if self._rtt is None:
+            return INIT_RTO
+        return min(MAX_RTO, max(MIN_RTO, self._rtt + 4 * self._rtt_var))
+
+    def _update_window(self, acked_bytes: int, our_delay: int):
+        """
+        LEDBAT: grow while the queuing delay is below target, shrink
+        proportionally above it
+        """
+        off_target = (TARGET_DELAY - our_delay) / TARGET_DELAY
+        window_factor = min(acked_bytes, self._cwnd) / \
+            max(self._cwnd, acked_bytes, 1)
+        self._cwnd = min(MAX_WINDOW, max(MIN_WINDOW, int(
+            self._cwnd + MAX_CWND_INCREASE * off_target * window_factor)))
+
+    def _on_data(self, ptype, seq_nr, payload):
+        expected = (self._ack_nr + 1) & MASK16
+        if seq_nr == expected:
+            self._deliver(ptype, payload)
+            self._ack_nr = seq_nr
+            while (self._ack_nr + 1) & MASK16 in self._reorder:
+                self._ack_nr = (self._ack_nr + 1) & MASK16
+                self._deliver(*self._reorder.pop(self._ack_nr))
+        elif _seq_lt(expected, seq_nr) and \
+                (seq_nr - expected) & MASK16 < REORDER_LIMIT:
+            self._reorder[seq_nr] = (ptype, payload)
+        self._schedule_ack()
+
+    def _deliver(self, ptype, payload):
+        if self._eof:
+            return
+        if ptype == ST_FIN:
+            self._eof = True
+            self.reader.feed_eof()
+        elif payload:
+            self.reader.feed_data(payload)
+
+    def reset(self):
+        self._send(ST_RESET, self._seq_nr)
+        self._destroy(ConnectionResetError())
+
+    def _destroy(self, exc):
+        if self._state == self.CLOSED:
+            return
+        if exc is None and self._ack_needed and \
+                self._state == self.CONNECTED:
+            self._send(ST_STATE, self._seq_nr) # Acks the FIN of the peer
+        self._state = self.CLOSED
+        for timer in (self._timer, self._linger):
+            if timer:
+                timer.cancel()
+        self._timer = self._linger = None
+        if not self._connected.done():
+            self._connected.set_exception(exc or ConnectionResetError())
+            self._connected.exception() # Retrieved by connect() if awaited
+        if not self._eof:
+            self._eof = True
+            if exc:
+                self.reader.set_exception(exc)
+            else:
+                self.reader.feed_eof()
+        self._wake_writer()
+        self._socket._forget(self)
+
+
+class UTPStreamWriter:
+    """
+    The StreamWriter methods used by PeerConnection
+    """
+    def __init__(self, connection: UTPConnection):
+        self._connection = connection
+
+    def write(self, data: bytes):
+        self._connection.write(data)
+
+    async def drain(self):
+        await self._connection.drain()
+
+    def close(self):
+        self._connection.close()
+
+    def is_closing(self) -> bool:
+        return self._connection.closed
+
+    def get_extra_info(self, name, default=None):
+        if name == 'peername':
+            return self._connection.addr
+        return default
+
+
+class _UTPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, socket):
+        self._socket = socket
+
+    def datagram_received(self, data, addr):
+        self._socket.datagram_received(data, addr[:2])
+
+    def error_received(self, exc):
+        # Lost packets are retransmitted
+        pass
+
+
+class UTPSocket:
+    """
+    Multiplexes uTP connections over one UDP socket (BEP 29). Datagrams
+    which are not uTP packets are handed to `fallback`, so the DHT can
+    share the listening port.
+    """
+
+    def __init__(self, port: int = 0, host: str = '0.0.0.0', on_accept=None,
+                 fallback=None):
+        self._port = port
+        self._host = host
+        self.on_accept = on_accept # Coroutine called with (reader, writer)
+        self.fallback = fallback # Called with (data, addr)
+        self._connections = dict() # (address, recv id) => UTPConnection
+        self._transport = None
+
+    @property
+    def transport(self):
+        return self._transport
+
+    @property
+    def port(self) -> int:
+        if self._transport:
+            return self._transport.get_extra_info('sockname')[1]
+        return self._port
+
+    @property
+    def connections(self):
+        return list(self._connections.values())
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        self._transport, _ = await loop.create_datagram_endpoint(
+            lambda: _UTPProtocol(self), local_addr=(self._host, self._port))
+
+    def close(self):
+        for connection in list(self._connections.values()):
+            connection.reset()
+        if self._transport:
+            self._transport.close()
+            self._transport = None
+
+    async def connect(self, addr) -> tuple:
+        """
+        Open a connection, returns a (reader, writer) pair like
+        asyncio.open_connection
+        """
+        if self._transport is None:
+            raise ConnectionRefusedError("uTP socket is not started")
+        addr = (addr[0], addr[1])
+        recv_id = random.getrandbits(16)
+        while (addr, recv_id) in self._connections:
+            recv_id = random.getrandbits(16)
+        connection = UTPConnection(self, addr, recv_id,
+                                   (recv_id + 1) & MASK16, seq_nr=1)
+        self._connections[(addr, recv_id)] = connection
+        await connection.connect()
+        return connection.reader, connection.writer
+
+    def _sendto(self, data: bytes, addr):
+        if self._transport:
+            self._transport.sendto(data, addr)
+
+    def _forget(self, connection: UTPConnection):
+        key = (connection.addr, connection.recv_id)
+        if self._connections.get(key) is connection:
+            del self._connections[key]
+
+    def datagram_received(self, data: bytes, addr):
+        packet = decode_packet(data)
+        if packet is None:
+            if self.fallback:
+                self.fallback(data, addr)
+            return
+        ptype, conn_id, timestamp, ts_diff, wnd_size, seq_nr, ack_nr, \
+            sack, payload = packet
+        if ptype == ST_SYN:
+            key = (addr, (conn_id + 1) & MASK16)
+            if key not in self._connections:
+                if not self.on_accept:
+                    return self._reset(addr, conn_id, seq_nr)
+                self._accept(addr, conn_id, seq_nr)
+        else:
+            key = (addr, conn_id)
+        connection = self._connections.get(key)
+        if connection is None:
+            if ptype not in (ST_RESET, ST_STATE):
+                self._reset(addr, conn_id, seq_nr)
+            return
+        connection.packet_received(ptype, timestamp, ts_diff, wnd_size,
+                                   seq_nr, ack_nr, sack, payload)
+
+    def _accept(self, addr, conn_id: int, seq_nr: int):
+        connection = UTPConnection(self, addr, (conn_id + 1) & MASK16,
+                                   conn_id, random.getrandbits(16),
+                                   ack_nr=seq_nr,
+                                   state=UTPConnection.CONNECTED)
+        self._connections[(addr, connection.recv_id)] = connection
+        asyncio.ensure_future(self.on_accept(connection.reader,
+                                             connection.writer))
+
+    def _reset(self, addr, conn_id: int, seq_nr: int):
+        self._sendto(encode_packet(ST_RESET, conn_id, _now_us(), 0, 0,
+                                   random.getrandbits(16), seq_nr), addr)
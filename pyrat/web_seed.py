@@ -0,0 +1,186 @@
+import asyncio
+from urllib.parse import quote
+
+import aiohttp
+
+from .choker import RateMeter
+from .rate_limiter import Throttle
+from . import metrics
+from .events import BUS
+
+
+
+WEBSEED_CONNECTIONS = 4 # Range requests in flight per web seed and host
+RUN_SIZE = 4 * 2**20 # Bytes asked by one range request at most
+IDLE_DELAY = 1 # Seconds before asking the picker again when it has nothing
+RETRY_DELAY = 5 # Seconds after a failed request, doubled on each failure
+MAX_RETRY_DELAY = 300
+REQUEST_TIMEOUT = 60
+
+
+class WebSeedError(Exception):
+    pass
+
+
+def file_urls(url: str, torrent_info) -> list:
+    """
+    URL of each file of the torrent on a web seed (BEP 19): a single-file
+    torrent names the file unless the URL ends with a slash, a multi-file
+    one names the directory holding the torrent's name directory
+    """
+    name = quote(torrent_info.filename)
+    if not torrent_info.multi_file:
+        return [url + name if url.endswith('/') else url]
+    base = url if url.endswith('/') else url + '/'
+    return [base + name + '/' + '/'.join(quote(part) for part in tfile.path)
+            for tfile in torrent_info.files]
+
+
+class WebSeed:
+    """
+    An HTTP server holding the content, used as a seed which is never
+    choked. Runs of contiguous blocks are taken from the piece manager and
+    fetched with range requests, `connections` at a time through the
+    shared HTTP client, whose keep-alive connections are pooled per host.
+    The blocks go to `on_block` like those of peers, so they are verified
+    and written the same way.
+    """
+
+    def __init__(self, url: str, torrent_info, piece_manager, http_client,
+                 on_block, connections: int = WEBSEED_CONNECTIONS,
+                 download_limits=()):
+        self._url = url
+        self._tinfo = torrent_info
+        self._piece_manager = piece_manager
+        self._http_client = http_client
+        self._on_block = on_block
+        self._connections = connections
+        self._files = [(file_url, tfile.length) for file_url, tfile in
+                       zip(file_urls(url, torrent_info), torrent_info.files)]
+        self._throttle = Throttle(*download_limits)
+        self._downloaded = metrics.BYTES.child(torrent_info.hex_hash,
+                                               'download')
+        self._futures = []
+        self._failures = 0
+        self.peer_id = 'web:' + url # Stands for the seed in the picker
+        self.download_rate = RateMeter()
+
+    @property
+    def url(self) -> str:
+        return self._url
+
+    def start(self):
+        if not self._futures:
+            self._piece_manager.add_seed(self.peer_id)
+            self._futures = [asyncio.ensure_future(self._worker())
+                             for _ in range(self._connections)]
+
+    def stop(self):
+        for future in self._futures:
+            if not future.done():
+                future.cancel()
+        if self._futures:
+            self._piece_manager.remove_peer(self.peer_id)
+        self._futures = []
+
+    def stats(self) -> dict:
+        return {
+            'url': self._url,
+            'downloaded': self.download_rate.total,
+            'download_rate': self.download_rate.rate,
+            'failures': self._failures,
+        }
+
+    async def _worker(self):
+        while True:
+            if self._piece_manager.backpressure:
+                await self._piece_manager.wait_for_room()
+            blocks = self._next_run()
+            if not blocks:
+                await asyncio.sleep(IDLE_DELAY)
+                continue
+            start = blocks[0].piece_idx * self._tinfo.piece_length + \
+                blocks[0].offset
+            length = sum(block.length for block in blocks)
+            try:
+                data = await self._fetch(start, length)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError,
+                    WebSeedError) as e:
+                for block in blocks:
+                    self._piece_manager.request_rejected(
+                        self.peer_id, block.piece_idx, block.offset)
+                self._failures += 1
+                delay = min(MAX_RETRY_DELAY,
+                            RETRY_DELAY * 2 ** (self._failures - 1))
+                BUS.info('webseed.error', url=self._url, error=repr(e),
+                         retry=delay)
+                await asyncio.sleep(delay)
+                continue
+            self._failures = 0
+            self.download_rate.update(length)
+            self._downloaded.value += length
+            view = memoryview(data)
+            pos = 0
+            for block in blocks:
+                self._on_block(peer_id=self.peer_id,
+                               piece_idx=block.piece_idx,
+                               block_offset=block.offset,
+                               data=bytes(view[pos:pos + block.length]))
+                pos += block.length
+
+    def _next_run(self) -> list:
+        # Blocks are handed out in order within a piece, a run ends at the
+        # first block which does not follow the previous one
+        piece_length = self._tinfo.piece_length
+        blocks = []
+        size = 0
+        end = None
+        while size < RUN_SIZE:
+            block = self._piece_manager.next_request(self.peer_id)
+            if block is None:
+                break
+            start = block.piece_idx * piece_length + block.offset
+            if end is not None and start != end:
+                self._piece_manager.request_rejected(
+                    self.peer_id, block.piece_idx, block.offset)
+                break
+            blocks.append(block)
+            size += block.length
+            end = start + block.length
+        return blocks
+
+    async def _fetch(self, start: int, length: int) -> bytes:
+        # One range request per file the run spans
+        await self._throttle.acquire(length)
+        chunks = []
+        file_start = 0
+        for file_url, file_length in self._files:
+            file_end = file_start + file_length
+            if start < file_end and length:
+                size = min(file_end - start, length)
+                chunks.append(await self._get(file_url, start - file_start,
+                                              size, file_length))
+                start += size
+                length -= size
+            file_start = file_end
+        return b''.join(chunks)
+
+    async def _get(self, url: str, offset: int, size: int,
+                   file_length: int) -> bytes:
+        headers = {'Range': 'bytes={}-{}'.format(offset, offset + size - 1)}
+        async with self._http_client.get(
+                url, headers=headers,
+                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)) \
+                as response:
+            if response.status == 206:
+                data = await response.read()
+            elif response.status == 200 and file_length <= RUN_SIZE:
+                # The server ignores ranges, small files are taken whole
+                data = (await response.read())[offset:offset + size]
+            else:
+                raise WebSeedError("HTTP {} for {}".format(response.status,
+                                                           url))
+        if len(data) != size:
+            raise WebSeedError("Got {} bytes of {} from {}".format(
+                len(data), size, url))
+        return data